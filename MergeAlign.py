@@ -5,45 +5,122 @@ MergeAlign algorithm for consensus multiple sequence alignments
 """
 
 import os
+import gc
 import sys
+import json
+import heapq
+import shutil
+import tempfile
 import getopt
+import logging
+import contextlib
+
+import numpy as np
+
+from fasta_reader import read_fasta, read_fasta_matrix, sequences_to_matrix
+from stage_profiler import PROFILE_MODES, StageProfiler, profile_mode_from_env
+from segment_scoring import available_cpus, score_segment, score_segments
+
+logger = logging.getLogger('mergealign')
+
+GRAPH_ENGINES = ('nodes', 'array', 'banded')
+NODE_ORDERS = ('sort', 'topological')
+GAP = ord('-')
+ROW_HASH_SEED = 20120914
+HASH_CHUNK = 1 << 20     # elements per temporary block when hashing coordinate rows
+SHARED_TUPLES_MAX_DISTINCT = 0.5     # coordinates_to_tuples interns columns only below this distinct fraction
+MIN_ANCHOR_FRACTION = 0.75   # create_banded_graph builds the full graph when fewer columns are anchors
+SNAPSHOT_FORMAT = 'mergealign-graph'
+SNAPSHOT_VERSION = 1
+GRAPH_ARRAYS = ('coordinates', 'indptr', 'predecessors', 'counts')
+PATH_ARRAYS = ('path_score', 'path_length', 'best_previous', 'best_count')
 
 class Node:
     """ A position in alignment space with edges to the previous nodes in all alignments """
+
+    # No per-instance __dict__: graphs hold hundreds of thousands of nodes
+    __slots__ = ('coordinate', 'previous_nodes', 'path_score', 'path_length', 'path_average', 'best_previous_node')
     
-    def __init__(self):
-        self.previous_nodes = [] 
+    def __init__(self, coordinate=None):
+        self.coordinate = coordinate        # the tuple keying this node, shared by all edges into it
+        self.previous_nodes = {}    # previous node coordinate -> number of alignments using the edge
         self.path_score = 0
         self.path_length = 0
         self.path_average = 0
         self.best_previous_node = None
 
+class AlignmentGraph:
+    """ Alignment space stored as flat arrays: interned node coordinates and CSR predecessor lists """
+
+    def __init__(self, coordinates, indptr, predecessors, counts):
+        self.coordinates = coordinates      # node id -> coordinate, ids in topological order, start node 0, end node last
+        self.indptr = indptr                # predecessors of node v are predecessors[indptr[v]:indptr[v + 1]]
+        self.predecessors = predecessors    # in order of first appearance, like Node.previous_nodes
+        self.counts = counts                # number of alignments using each edge
+
+    @property
+    def num_nodes(self):
+        return len(self.coordinates)
+
+    @property
+    def num_edges(self):
+        return len(self.predecessors)
+
+class BandedGraph:
+    """ Alignment graph stored only where the alignments disagree; steps every alignment takes are only counted """
+
+    def __init__(self, graph, nodes, coordinates, anchors, agreed, num_alignments):
+        self.graph = graph                  # the disagreeing segments, with ids in global id order
+        self.nodes = nodes                  # subgraph node -> global node id
+        self.coordinates = coordinates      # global node id -> coordinate, as in AlignmentGraph
+        self.anchors = anchors              # global ids of all anchors in path order, start node first
+        self.agreed = agreed                # per anchor: agreed steps from the start node up to it
+        self.num_alignments = num_alignments
+
+    @property
+    def num_agreed(self):
+        return int(self.agreed[-1]) if len(self.agreed) else 0
+
+class MatrixAlignment(list):
+    """ (seq_id, sequence) pairs of an aligned FASTA file that keep the character matrix they were read as """
+
+    def __init__(self, names, matrix):
+        super().__init__((name, row.tobytes().decode('ascii')) for name, row in zip(names, matrix))
+        self.matrix = matrix        # row i holds the i-th sequence, so conversion reorders rows instead of re-encoding
+
+class MergeResult:
+    """ Consensus alignment returned by merge, with its column scores """
+
+    def __init__(self, alignment, scores, num_alignments, profile=None):
+        self.alignment = alignment              # seq_id -> aligned sequence, in input order
+        self.scores = scores                    # fraction of alignments supporting each column
+        self.num_alignments = num_alignments    # alignments that made it into the graph
+        self.profile = profile                  # StageProfiler report when profiling was on
+
 def parse_fasta(filename):
     """Read FASTA file and return list of (seq_id, sequence) tuples"""
     try:
-        with open(filename, 'r') as f:
-            lines = f.readlines()
-    except IOError:
-        print(f"Unable to open file {filename}")
-        sys.exit(2)
-
-    sequences = []
-    seq_id = None
-
-    for line in lines:
-        if line.startswith('>'):
-            seq_id = line.rstrip()[1:]
-            sequences.append((seq_id, ''))
-        elif seq_id is not None:
-            seq = sequences[-1][1] + line.rstrip()
-            sequences[-1] = (seq_id, seq)
+        sequences = list(read_fasta(filename))
+    except IOError as e:
+        raise IOError(f"Unable to open file {filename}") from e
 
     if len(sequences) == 0:
-        print(f"{filename} contains no sequences")
-        sys.exit(2)
+        raise ValueError(f"{filename} contains no sequences")
 
     return sequences
 
+def read_alignment(filename):
+    """Read an aligned FASTA file as a MatrixAlignment"""
+    try:
+        names, matrix = read_fasta_matrix(filename)
+    except IOError as e:
+        raise IOError(f"Unable to open file {filename}") from e
+
+    if len(names) == 0:
+        raise ValueError(f"{filename} contains no sequences")
+
+    return MatrixAlignment(names, matrix)
+
 def convert_to_indices(sequence):
     """Convert sequence to position indices"""
     indices = []
@@ -54,19 +131,188 @@ def convert_to_indices(sequence):
         indices.append(pos)
     return indices
 
+def alignment_to_matrix(alignment, sequence_names):
+    """Convert aligned sequences to a (sequences x columns) uint8 character matrix"""
+    if isinstance(alignment, MatrixAlignment):
+        rows = {name: row for row, (name, _) in enumerate(alignment)}
+        return alignment.matrix[[rows[name] for name in sequence_names]]
+    seq_dict = dict(alignment)
+    return sequences_to_matrix([seq_dict[name] for name in sequence_names])
+
+def matrices_to_coordinates(matrices):
+    """Padded (alignments x columns x sequences) index array of character matrices, and the column count of each"""
+    lengths = np.array([matrix.shape[1] for matrix in matrices])
+    chars = np.full((len(matrices), matrices[0].shape[0], lengths.max()), GAP, dtype=np.uint8)
+    for chars_row, matrix in zip(chars, matrices):
+        chars_row[:, :matrix.shape[1]] = matrix
+
+    indices = np.cumsum(chars != GAP, axis=2, dtype=np.int32)
+    return np.ascontiguousarray(indices.transpose(0, 2, 1)), lengths
+
+def matrix_to_coordinates(matrix):
+    """(columns x sequences) index array of one character matrix"""
+    return np.ascontiguousarray(np.cumsum(matrix != GAP, axis=1, dtype=np.int32).T)
+
+class MatrixCoordinates:
+    """ The coordinates of character matrices, converted one alignment at a time when read """
+
+    def __init__(self, matrices):
+        self.matrices = list(matrices)
+        self.lengths = np.array([matrix.shape[1] for matrix in self.matrices])
+
+    def __len__(self):
+        return len(self.matrices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return MatrixCoordinates(self.matrices[index])
+        return matrix_to_coordinates(self.matrices[index])
+
+def row_chunks(rows):
+    """Row ranges covering about HASH_CHUNK elements each, to bound temporary arrays"""
+    chunk_rows = max(1, HASH_CHUNK // max(1, rows.shape[1]))
+    return [slice(start, start + chunk_rows) for start in range(0, len(rows), chunk_rows)]
+
+def row_hashes(rows):
+    """64-bit hash of each row of a non-negative int array, a wrapping dot product with fixed odd multipliers"""
+    multipliers = np.random.default_rng(ROW_HASH_SEED).integers(1, 2**63, size=rows.shape[1], dtype=np.uint64)
+    multipliers |= np.uint64(1)
+    hashes = np.empty(len(rows), dtype=np.uint64)
+    for chunk in row_chunks(rows):
+        hashes[chunk] = rows[chunk].astype(np.uint64) @ multipliers
+    return hashes
+
+def row_bytes(rows):
+    """The bytes of each row of an int32 coordinate array, as dict keys"""
+    rows = np.ascontiguousarray(rows, dtype=np.int32)
+    return rows.view(np.dtype((np.void, rows.shape[1] * 4))).reshape(-1).tolist()
+
+class CoordinateIndex:
+    """ Distinct coordinate rows, numbered in order of first appearance and looked up by row_hashes
+
+    After a hash collision, rows are looked up by their exact bytes instead.
+    """
+
+    def __init__(self, rows):
+        self._rows = np.array(rows, dtype=np.int32)     # distinct rows, ids 0 .. len(rows) - 1, with spare rows at the end
+        self.num_rows = len(self._rows)
+        hashes = row_hashes(self._rows)
+        self._ids = np.argsort(hashes, kind='stable')   # ids in hash order
+        self._hashes = hashes[self._ids]
+        self._exact = None                              # row bytes -> id, once a collision was found
+        if (np.diff(self._hashes) == 0).any():
+            self._use_exact()
+
+    @property
+    def rows(self):
+        return self._rows[:self.num_rows]
+
+    def add(self, points):
+        """Ids of the rows of an (n x dimensions) array, appending the rows not seen before"""
+        points = np.ascontiguousarray(points, dtype=np.int32)
+        if self._exact is not None:
+            return self._add_exact(points)
+
+        hashes, first_index, inverse = np.unique(row_hashes(points), return_index=True, return_inverse=True)
+        position = np.searchsorted(self._hashes, hashes)
+        found = position < len(self._hashes)
+        found[found] = self._hashes[position[found]] == hashes[found]
+        distinct_ids = np.empty(len(hashes), dtype=np.int64)
+        distinct_ids[found] = self._ids[position[found]]
+        new = np.flatnonzero(~found)
+        distinct_ids[new] = self._append(points[first_index[new]])
+        self._hashes = np.insert(self._hashes, position[new], hashes[new])
+        self._ids = np.insert(self._ids, position[new], distinct_ids[new])
+
+        ids = distinct_ids[inverse.reshape(-1)]
+        if not all(np.array_equal(self._rows[ids[chunk]], points[chunk]) for chunk in row_chunks(points)):
+            # Rows appended so far are distinct; only the mismatched points still need their own ids
+            self._use_exact()
+            return self._add_exact(points)
+        return ids
+
+    def _append(self, rows):
+        """Store new distinct rows; returns their ids"""
+        end = self.num_rows + len(rows)
+        if end > len(self._rows):
+            grown = np.empty((end + end // 2, self._rows.shape[1]), dtype=np.int32)   # half spare, not double
+            grown[:self.num_rows] = self.rows
+            self._rows = grown
+        self._rows[self.num_rows:end] = rows
+        ids = np.arange(self.num_rows, end)
+        self.num_rows = end
+        return ids
+
+    def _use_exact(self):
+        logger.warning("Coordinate hash collision, interning by exact comparison")
+        self._exact = dict(zip(row_bytes(self.rows), range(self.num_rows)))
+
+    def _add_exact(self, points):
+        ids = np.empty(len(points), dtype=np.int64)
+        for i, key in enumerate(row_bytes(points)):
+            row_id = self._exact.get(key)
+            if row_id is None:
+                row_id = self._exact[key] = int(self._append(points[i:i + 1])[0])
+            ids[i] = row_id
+        return ids
+
+    def sorted_by_sum(self):
+        """(rows, new id of each row) with ids renumbered in order of coordinate sum
+
+        Every edge increases the coordinate sum, so the new ids are a topological order.
+        """
+        order = np.argsort(self.rows.sum(axis=1, dtype=np.int64), kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        return self.rows[order], rank
+
+def intern_alignments(coordinates, lengths):
+    """Intern the points of all alignments, one alignment at a time, with the all-zero start node as id 0
+
+    Returns the node coordinates, in order of coordinate sum, and the ids of every alignment's points, concatenated.
+    """
+    index = None
+    ids = []
+    for alignment, length in zip(coordinates, lengths):
+        points = np.asarray(alignment[:length], dtype=np.int32)
+        if index is None:
+            index = CoordinateIndex(np.zeros((1, points.shape[1]), dtype=np.int32))
+        ids.append(index.add(points))
+    node_coords, rank = index.sorted_by_sum()
+    return node_coords, rank[np.concatenate(ids)]
+
+def coordinates_to_tuples(coordinates, lengths):
+    """Coordinate tuples per alignment from the matrices_to_coordinates array, for create_nodes
+
+    Alignments share one tuple per distinct coordinate when most of their columns are shared.
+    """
+    points = np.concatenate([alignment[:length] for alignment, length in zip(coordinates, lengths)])
+    if len(np.unique(row_hashes(points))) > SHARED_TUPLES_MAX_DISTINCT * len(points):
+        ints = np.arange(int(coordinates.max()) + 1).astype(object)
+        return [list(map(tuple, ints[alignment[:length]].tolist())) for alignment, length in zip(coordinates, lengths)]
+
+    node_coords, ids = intern_alignments(coordinates, lengths)
+    ints = np.arange(int(node_coords.max()) + 1).astype(object)
+    node_tuples = []
+    for chunk in row_chunks(node_coords):
+        node_tuples.extend(map(tuple, ints[node_coords[chunk]].tolist()))
+    ids = ids.tolist()
+    ends = np.cumsum(lengths).tolist()
+    return [list(map(node_tuples.__getitem__, ids[end - length:end])) for end, length in zip(ends, lengths)]
+
 def convert_indices_to_sequence(indices, original_sequence):
     """Convert indices back to sequence with gaps"""
-    sequence = ''
+    sequence = []
     prev_i = 0
     
     for i in indices:
         if i != prev_i:
-            sequence += original_sequence[i-1]
+            sequence.append(original_sequence[i-1])
         else:
-            sequence += '-'
+            sequence.append('-')
         prev_i = i
         
-    return sequence
+    return ''.join(sequence)
 
 def create_nodes(coordinates):
     """Create nodes from alignment coordinates"""
@@ -74,39 +320,700 @@ def create_nodes(coordinates):
         raise ValueError("Empty alignments provided")
     
     dimensions = len(coordinates[0][0])
-    print(f"Dimensions: {dimensions}")
+    logger.info(f"Dimensions: {dimensions}")
     
     start_node = tuple([0] * dimensions)
-    nodes = {start_node: Node()}
+    nodes = {start_node: Node(start_node)}
     
     for alignment in coordinates:
         prev_node = start_node
         for point in alignment:
-            if point not in nodes:
-                nodes[point] = Node()
-            
-            prev_nodes_list = nodes[point].previous_nodes
-            for idx, (node, count) in enumerate(prev_nodes_list):
-                if node == prev_node:
-                    prev_nodes_list[idx] = (node, count + 1)
-                    break
+            node = nodes.get(point)
+            if node is None:
+                node = nodes[point] = Node(point)
             else:
-                prev_nodes_list.append((prev_node, 1))
+                point = node.coordinate     # keep one tuple per coordinate, not one per alignment
+            
+            prev_nodes = node.previous_nodes
+            prev_nodes[prev_node] = prev_nodes.get(prev_node, 0) + 1
             
             prev_node = point
                 
     return nodes
 
-def score_nodes(nodes, num_paths=100):
-    """Score nodes and find optimal path"""
+def alignment_lengths(coordinates, lengths=None):
+    """Column count of each alignment: lengths when given, else read off the coordinates"""
+    if lengths is None:
+        if isinstance(coordinates, MatrixCoordinates):
+            return coordinates.lengths
+        lengths = [len(alignment) for alignment in coordinates]
+    return np.asarray(lengths)
+
+def path_edges(dst, lengths):
+    """(dst, src) of every step along the concatenated node ids of alignments, each starting from node 0
+
+    All-gap columns repeat the previous node; they never lie on a consensus path and are dropped.
+    """
+    src = np.empty_like(dst)
+    src[1:] = dst[:-1]
+    src[np.cumsum(lengths) - lengths] = 0
+    keep = src != dst
+    return dst[keep], src[keep]
+
+def unique_edges(dst, src, num_nodes):
+    """Distinct edges of the steps (dst, src), sorted by destination: dst, src, count and first step of each"""
+    keys, first_seen, counts = np.unique(dst * num_nodes + src, return_index=True, return_counts=True)
+    edge_dst, edge_src = np.divmod(keys, num_nodes)
+    return edge_dst, edge_src, counts, first_seen
+
+def edges_to_csr(dst, src, num_nodes):
+    """CSR indptr, predecessors and counts of the steps (dst, src), predecessors in order of first appearance"""
+    edge_dst, edge_src, counts, first_seen = unique_edges(dst, src, num_nodes)
+    order = np.lexsort((first_seen, edge_dst))
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edge_dst, minlength=num_nodes), out=indptr[1:])
+    return indptr, edge_src[order], counts[order]
+
+def create_graph(coordinates, lengths=None):
+    """Create array-backed alignment graph from alignment coordinates
+
+    Takes a list of per-alignment coordinate lists, MatrixCoordinates, or the padded array
+    from matrices_to_coordinates together with the column count of each alignment.
+    """
+    lengths = alignment_lengths(coordinates, lengths)
+    if not len(lengths) or not lengths[0]:
+        raise ValueError("Empty alignments provided")
+
+    # Intern every coordinate to an id; only ids are used from here on
+    node_coords, dst = intern_alignments(coordinates, lengths)
+    num_nodes = len(node_coords)
+    logger.info(f"Dimensions: {node_coords.shape[1]}")
+
+    dst, src = path_edges(dst.astype(np.int64), lengths)
+    return AlignmentGraph(node_coords, *edges_to_csr(dst, src, num_nodes))
+
+def score_graph(graph, num_paths=100, workers=1):
+    """Score array-backed graph and find optimal path
+
+    With workers > 1 the DP is run by segment_scoring.score_segments in a process pool.
+    """
+    if workers > 1:
+        anchor_agreed = np.full(graph.num_nodes, -1, dtype=np.int64)
+        anchor_agreed[0] = 0
+        first_edge = graph.indptr[1]
+        num_alignments = int(graph.counts[first_edge:][graph.predecessors[first_edge:] == 0].sum())    # all leave node 0
+        best_edge = score_segments(graph.indptr, graph.predecessors, graph.counts, anchor_agreed,
+                                   num_alignments, workers)
+        return trace_graph(graph, best_edge.tolist(), num_paths)
+
+    indptr = graph.indptr.tolist()
+    predecessors = graph.predecessors.tolist()
+    counts = graph.counts.tolist()
+
+    num_nodes = graph.num_nodes
+    path_score = [0] * num_nodes
+    path_length = [0] * num_nodes
+    path_average = [0] * num_nodes
+    best_edge = [0] * num_nodes
+
+    for node in range(1, num_nodes):
+        edge = indptr[node]
+        best_value = counts[edge] + path_average[predecessors[edge]]
+        for other in range(edge + 1, indptr[node + 1]):
+            value = counts[other] + path_average[predecessors[other]]
+            if value > best_value:
+                edge, best_value = other, value
+
+        prev_node = predecessors[edge]
+        path_length[node] = path_length[prev_node] + 1
+        path_score[node] = counts[edge] + path_score[prev_node]
+        path_average[node] = path_score[node] / path_length[node]
+        best_edge[node] = edge
+
+    return trace_graph(graph, best_edge, num_paths, predecessors, counts)
+
+def trace_graph(graph, best_edge, num_paths, predecessors=None, counts=None):
+    """Optimal path and column scores of a scored graph, following best_edge back from the end node"""
+    predecessors = graph.predecessors.tolist() if predecessors is None else predecessors
+    counts = graph.counts.tolist() if counts is None else counts
+    path = []
+    scores = []
+    node = graph.num_nodes - 1
+    while node != 0:
+        path.append(node)
+        scores.append(counts[best_edge[node]] / num_paths)
+        node = predecessors[best_edge[node]]
+
+    path.reverse()
+    scores.reverse()
+    return [tuple(coord) for coord in graph.coordinates[path].tolist()], scores
+
+def create_banded_graph(coordinates, lengths=None):
+    """Create a BandedGraph: the array-backed graph of only the segments between anchors where alignments disagree
+
+    Falls back to the full graph when fewer than MIN_ANCHOR_FRACTION of the columns are expected to be anchors.
+    """
+    lengths = alignment_lengths(coordinates, lengths)
+    if not len(lengths) or not lengths[0]:
+        raise ValueError("Empty alignments provided")
+    num_alignments = len(lengths)
+
+    def points_without_gap_columns(alignment, length):
+        """Points and coordinate sums without all-gap columns, which repeat the previous point
+        and never lie on a consensus path"""
+        alignment = np.asarray(alignment[:length], dtype=np.int32)
+        total = alignment.sum(axis=1, dtype=np.int32)
+        keep = np.diff(total, prepend=0) > 0
+        if not keep.all():
+            alignment, total = alignment[keep], total[keep]
+        return alignment, total
+
+    first_points, first_sums = points_without_gap_columns(coordinates[0], lengths[0])
+    dimensions = first_points.shape[1]
+    logger.info(f"Dimensions: {dimensions}")
+
+    # A column of the first alignment is an anchor when every other alignment has a point with its coordinate sum
+    # and coordinate. Only the first alignment's points are kept; the others are read again once the anchors are known
+    columns = np.arange(len(first_points))
+    positions = []
+    for done, (alignment, length) in enumerate(zip(coordinates[1:], lengths[1:]), 1):
+        alignment_points, alignment_sums = points_without_gap_columns(alignment, length)
+        position = np.minimum(np.searchsorted(alignment_sums, first_sums), len(alignment_sums) - 1)
+        same = alignment_sums[position[columns]] == first_sums[columns]
+        columns = columns[same]
+        same = (alignment_points[position[columns]] == first_points[columns]).all(axis=1)
+        columns = columns[same]
+        remaining = len(columns) / len(first_points)
+        if done == 1:
+            first_remaining = remaining     # also drops the columns where the first alignment disagrees
+        elif remaining > 0 and 2 * done >= num_alignments - 1:
+            # Disagreements come in bursts, so only project once half the alignments are in
+            remaining *= (remaining / first_remaining) ** ((num_alignments - 1 - done) / (done - 1))
+        if remaining < MIN_ANCHOR_FRACTION:
+            logger.info(f"Fewer than {MIN_ANCHOR_FRACTION:.0%} of the columns will be anchors, building the full graph")
+            graph = create_graph(coordinates, lengths)
+            return BandedGraph(graph, np.arange(graph.num_nodes), graph.coordinates, np.zeros(1, dtype=np.int64),
+                               np.zeros(1, dtype=np.int64), num_alignments)
+        positions.append(position)
+    positions = [columns] + [position[columns] for position in positions]
+
+    # Anchor 0 is the start node, at position -1 of every alignment
+    num_anchors = len(columns) + 1
+    is_agreed = np.zeros(num_anchors, dtype=bool)
+    is_agreed[1:] = True
+    for position in positions:
+        is_agreed[1:] &= np.diff(position, prepend=-1) == 1
+    agreed = np.cumsum(is_agreed)
+
+    # Anchors keep ids 0 .. num_anchors - 1 and only the points between them are interned;
+    # both share one id space, renumbered in sum order at the end
+    index = CoordinateIndex(np.concatenate([np.zeros((1, dimensions), dtype=np.int32), first_points[columns]]))
+    point_ids = []
+    for i, (alignment, length, position) in enumerate(zip(coordinates, lengths, positions)):
+        alignment_points = first_points if i == 0 else points_without_gap_columns(alignment, length)[0]
+        ids = np.full(len(alignment_points), -1, dtype=np.int64)
+        ids[position] = np.arange(1, num_anchors)
+        inside = ids < 0
+        ids[inside] = index.add(alignment_points[inside])
+        point_ids.append(ids)
+    kept_lengths = np.array([len(ids) for ids in point_ids])
+    point_ids = np.concatenate(point_ids)
+    node_coords, global_ids = index.sorted_by_sum()
+    anchors = global_ids[:num_anchors]
+    num_nodes = len(node_coords)
+
+    # Gap columns were dropped already, so path_edges keeps every step; the start node is id 0 in sum order
+    dst, src = path_edges(global_ids[point_ids], kept_lengths)
+    inside = point_ids >= num_anchors
+
+    # Edges into any node other than an agreed anchor form the disagreeing segments
+    segment = inside | ~is_agreed[np.where(inside, 0, point_ids)]
+    nodes = np.unique(np.concatenate([src[segment], dst[segment]]))
+    graph = AlignmentGraph(node_coords[nodes], *edges_to_csr(np.searchsorted(nodes, dst[segment]),
+                                                             np.searchsorted(nodes, src[segment]), len(nodes)))
+    logger.info(f"{num_anchors} anchors, {int(agreed[-1])} agreed steps, "
+                f"{graph.num_nodes} of {num_nodes} nodes in disagreeing segments")
+    return BandedGraph(graph, nodes, node_coords, anchors, agreed, num_alignments)
+
+def banded_to_graph(banded):
+    """The full AlignmentGraph of a BandedGraph, with an edge from the previous anchor into every agreed anchor
+
+    Only agreed anchors lack their incoming edges in the subgraph, and every alignment
+    takes that one step, so no alignment needs to be interned again.
+    """
+    graph = banded.graph
+    if not banded.num_agreed:
+        return graph
+    num_nodes = len(banded.coordinates)
+    agreed_anchors = np.flatnonzero(np.diff(banded.agreed, prepend=0) > 0)
+    in_degree = np.zeros(num_nodes, dtype=np.int64)
+    in_degree[banded.nodes] = np.diff(graph.indptr)
+    in_degree[banded.anchors[agreed_anchors]] = 1
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(in_degree, out=indptr[1:])
+
+    predecessors = np.empty(indptr[-1], dtype=np.int64)
+    counts = np.empty(indptr[-1], dtype=np.int64)
+    sub_degree = np.diff(graph.indptr)
+    offsets = np.arange(graph.num_edges) - np.repeat(graph.indptr[:-1], sub_degree)
+    edges = np.repeat(indptr[banded.nodes], sub_degree) + offsets
+    predecessors[edges] = banded.nodes[graph.predecessors]
+    counts[edges] = graph.counts
+    predecessors[indptr[banded.anchors[agreed_anchors]]] = banded.anchors[agreed_anchors - 1]
+    counts[indptr[banded.anchors[agreed_anchors]]] = banded.num_alignments
+    return AlignmentGraph(banded.coordinates, indptr, predecessors, counts)
+
+def score_banded(banded, num_paths=100, workers=1):
+    """Score a BandedGraph and find the optimal path; the result equals score_graph on the full graph"""
+    graph = banded.graph
+    if not banded.num_agreed:
+        return score_graph(graph, num_paths, workers)     # nothing was left out: graph is the full graph
+    predecessors = graph.predecessors.tolist()
+    counts = graph.counts.tolist()
+    num_alignments = banded.num_alignments
+
+    # Agreed steps up to each subgraph node that is an anchor, -1 for nodes inside segments
+    rank = np.minimum(np.searchsorted(banded.anchors, banded.nodes), len(banded.anchors) - 1)
+    anchor_agreed = np.where(banded.anchors[rank] == banded.nodes, banded.agreed[rank], -1)
+    if not graph.num_nodes:
+        best_edge = []      # every step agreed
+    else:
+        # Subgraph node 0 is an anchor, reached from the start node by agreed steps only
+        seed = (num_alignments * int(anchor_agreed[0]), int(anchor_agreed[0]))
+        if workers > 1:
+            best_edge = score_segments(graph.indptr, graph.predecessors, graph.counts, anchor_agreed,
+                                       num_alignments, workers, seed).tolist()
+        else:
+            _, _, best_edge = score_segment(graph.indptr.tolist(), predecessors, counts, anchor_agreed.tolist(),
+                                            num_alignments, [seed])
+
+    sub_ids = {node: i for i, node in enumerate(banded.nodes.tolist())}
+    anchors = banded.anchors.tolist()
+    previous_anchor = dict(zip(anchors[1:], anchors[:-1]))
+    nodes = banded.nodes.tolist()
+    path = []
+    scores = []
+    node = len(banded.coordinates) - 1
+    while node != 0:
+        path.append(node)
+        sub = sub_ids.get(node)
+        if sub is None or best_edge[sub] < 0:
+            scores.append(num_alignments / num_paths)
+            node = previous_anchor[node]
+        else:
+            scores.append(counts[best_edge[sub]] / num_paths)
+            node = nodes[predecessors[best_edge[sub]]]
+
+    path.reverse()
+    scores.reverse()
+    return [tuple(coord) for coord in banded.coordinates[path].tolist()], scores
+
+def nodes_to_graph(nodes):
+    """Array-backed graph of the nodes create_nodes builds, keeping predecessor order"""
+    sorted_coords = sorted(nodes)
+    node_ids = {coord: i for i, coord in enumerate(sorted_coords)}
+    indptr = [0]
+    predecessors = []
+    counts = []
+    for coord in sorted_coords:
+        for prev_coord, count in nodes[coord].previous_nodes.items():
+            predecessors.append(node_ids[prev_coord])
+            counts.append(count)
+        indptr.append(len(predecessors))
+    return AlignmentGraph(np.array(sorted_coords, dtype=np.int32).reshape(len(sorted_coords), -1),
+                          np.array(indptr, dtype=np.int64), np.array(predecessors, dtype=np.int64),
+                          np.array(counts, dtype=np.int64))
+
+def graph_to_nodes(graph):
+    """Nodes of an array-backed graph, as create_nodes would have built them"""
+    coords = [tuple(coord) for coord in graph.coordinates.tolist()]
+    indptr = graph.indptr.tolist()
+    predecessors = graph.predecessors.tolist()
+    counts = graph.counts.tolist()
+    nodes = {}
+    for node, coord in enumerate(coords):
+        nodes[coord] = Node(coord)
+        for edge in range(indptr[node], indptr[node + 1]):
+            nodes[coord].previous_nodes[coords[predecessors[edge]]] = counts[edge]
+    return nodes
+
+class GraphSnapshot:
+    """ An alignment graph on disk, memory-mapped on load, with what is needed to score it and write the consensus """
+
+    def __init__(self, graph, original_sequences, num_alignments, sources=None, paths=None):
+        self.graph = graph
+        self.original_sequences = list(original_sequences)    # (seq_id, ungapped sequence) per row
+        self.num_alignments = num_alignments
+        self.sources = list(sources or [])                     # names of the merged alignments, if known
+        self.paths = paths                                     # PATH_ARRAYS of a MergeState, or None
+
+    def score(self, num_paths=None, engine='array', workers=1):
+        """Consensus coordinates and scores; scores are edge counts over num_paths (default: num_alignments)
+
+        The snapshot holds the full graph, so the banded engine scores it like the array engine.
+        """
+        if engine not in GRAPH_ENGINES:
+            raise ValueError(f"Unknown graph engine: {engine}")
+        if workers > 1 and engine == 'nodes':
+            raise ValueError("Parallel scoring needs the array or banded engine")
+        num_paths = num_paths or self.num_alignments
+        if engine in ('array', 'banded'):
+            return score_graph(self.graph, num_paths, workers)
+        return score_nodes(graph_to_nodes(self.graph), num_paths)
+
+    def consensus(self, num_paths=None, engine='array', workers=1):
+        """Consensus alignment and column scores"""
+        final_coordinates, scores = self.score(num_paths, engine, workers)
+        return convert_coordinates_to_sequences(final_coordinates, self.original_sequences), scores
+
+    def save(self, directory):
+        """Write the snapshot, replacing directory only once the write is complete"""
+        parent, name = os.path.split(os.path.abspath(directory))
+        tmp_directory = tempfile.mkdtemp(dir=parent, prefix=f".{name}.tmp")
+        os.chmod(tmp_directory, 0o755)     # mkdtemp makes it private; snapshots are meant to be shared
+        try:
+            arrays = {name: getattr(self.graph, name) for name in GRAPH_ARRAYS}
+            arrays.update(self.paths or {})
+            for array_name, array in arrays.items():
+                np.save(os.path.join(tmp_directory, f"{array_name}.npy"), np.ascontiguousarray(array))
+            header = {
+                'format': SNAPSHOT_FORMAT,
+                'version': SNAPSHOT_VERSION,
+                'num_alignments': self.num_alignments,
+                'names': [seq_id for seq_id, _ in self.original_sequences],
+                'sequences': [seq for _, seq in self.original_sequences],
+                'sources': self.sources,
+                'arrays': sorted(arrays),
+            }
+            with open(os.path.join(tmp_directory, 'header.json'), 'w') as f:
+                json.dump(header, f)
+        except BaseException:
+            shutil.rmtree(tmp_directory)
+            raise
+
+        if os.path.exists(directory):
+            # Move the old snapshot into a fresh folder of its own, so the rename never hits an existing path
+            old_directory = tempfile.mkdtemp(dir=parent, prefix=f".{name}.old")
+            os.replace(directory, os.path.join(old_directory, name))
+            os.replace(tmp_directory, directory)
+            shutil.rmtree(old_directory)
+        else:
+            os.replace(tmp_directory, directory)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Read a snapshot written by save; arrays are memory-mapped unless mmap_mode is None"""
+        with open(os.path.join(directory, 'header.json')) as f:
+            header = json.load(f)
+        if header.get('format') != SNAPSHOT_FORMAT or header.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"{directory} is not a version {SNAPSHOT_VERSION} graph snapshot")
+
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in header['arrays']}
+        graph = AlignmentGraph(*(arrays[name] for name in GRAPH_ARRAYS))
+        paths = {name: arrays[name] for name in PATH_ARRAYS} if set(PATH_ARRAYS) <= set(arrays) else None
+        return cls(graph, zip(header['names'], header['sequences']), header['num_alignments'],
+                   header['sources'], paths)
+
+class MergeState:
+    """ A merge that can take more alignments later: the graph, edge counts and path statistics
+
+    Added alignments count as coming after the earlier ones, and only nodes whose best path changes are rescored.
+    """
+
+    def __init__(self, original_sequences):
+        self.original_sequences = list(original_sequences)     # (seq_id, ungapped sequence) per row
+        self._index = CoordinateIndex(np.zeros((1, len(self.original_sequences)), dtype=np.int32))   # node id -> coordinate
+        self.sums = [0]                                         # coordinate sum per node, increasing along edges
+        self.end_sum = sum(len(seq) for _, seq in self.original_sequences)
+        self.end_node = None                                    # id of the node every alignment ends at
+        self.edge_src = []                                      # per edge, base edges grouped by destination first
+        self.counts = []
+        self.indptr = [0, 0]                                    # in-edges of base node v: indptr[v] .. indptr[v + 1] - 1
+        self.successor_ptr = [0, 0]                             # successors of base node v, as nodes after it
+        self.successors = []
+        self.extra_in = {}                                      # node -> edges added since, in order of first use
+        self.extra_out = {}                                     # node -> destinations of those edges
+        self.extra_dst = []                                     # destination of each added edge
+        self.path_score = [0]
+        self.path_length = [0]
+        self.path_average = [0]
+        self.best_previous = [0]
+        self.best_count = [0]                                   # count of the edge from best_previous
+        self.num_alignments = 0
+        self.sources = []                                       # names of the alignments added so far
+
+    @classmethod
+    def from_alignments(cls, alignments, sources=None):
+        """New state holding parsed alignments; sequence order comes from the first one"""
+        if not alignments:
+            raise ValueError("No valid alignments were read")
+        state = cls([(name, seq.replace('-', '')) for name, seq in alignments[0]])
+        matrices, sources = state._matrices(alignments, sources)
+        if not matrices:
+            return state
+        snapshot = GraphSnapshot(create_graph(MatrixCoordinates(matrices)), state.original_sequences, len(matrices),
+                                 sources)
+        return cls.from_snapshot(snapshot)
+
+    @property
+    def num_nodes(self):
+        return len(self.sums)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_src)
+
+    @property
+    def coordinates(self):
+        return self._index.rows
+
+    def _matrices(self, alignments, sources=None):
+        """Character matrices of the alignments that match the merged sequences, with their sources"""
+        sources = list(sources) if sources is not None else [None] * len(alignments)
+        sequence_names = [name for name, _ in self.original_sequences]
+        end = np.array([len(seq) for _, seq in self.original_sequences], dtype=np.int32)
+        matrices, added = [], []
+        for alignment, source in zip(alignments, sources):
+            try:
+                matrix = alignment_to_matrix(alignment, sequence_names)
+                if not np.array_equal((matrix != GAP).sum(axis=1), end):
+                    raise ValueError("sequences differ from the merged ones")
+            except Exception as e:
+                logger.error(f"Error converting sequences to indices: {e}")
+                continue
+            matrices.append(matrix)
+            added.append(source)
+        return matrices, added
+
+    def add_alignments(self, alignments, sources=None):
+        """Add parsed alignments, updating the graph and rescoring only nodes whose paths change
+
+        Returns the number of alignments added; ones that cannot be converted are logged and skipped.
+        A new alignment raises an edge count at every node on its path, so the rescoring
+        still reaches every node downstream of it whose best path score changes.
+        """
+        matrices, added = self._matrices(alignments, sources)
+        if not matrices:
+            return 0
+
+        coordinates = MatrixCoordinates(matrices)
+        dirty = self._add_edges(self._node_ids(coordinates), coordinates.lengths)
+        self._rescore(dirty)
+
+        self.num_alignments += len(matrices)
+        self.sources.extend(added)
+        return len(matrices)
+
+    def _node_ids(self, coordinates):
+        """Node ids of the points of every alignment, concatenated, adding the new coordinates as nodes
+
+        The index of all coordinates is kept across adds, so only the new points are hashed.
+        """
+        first_new = self.num_nodes
+        ids = np.concatenate([self._index.add(points) for points in coordinates])
+        new_sums = self._index.rows[first_new:].sum(axis=1, dtype=np.int64).tolist()
+        if self.end_sum in new_sums:
+            self.end_node = first_new + new_sums.index(self.end_sum)
+        self.sums.extend(new_sums)
+        for values in (self.path_score, self.path_length, self.path_average, self.best_previous, self.best_count):
+            values.extend([0] * len(new_sums))
+        return ids
+
+    def in_edges(self, node):
+        """Edges into node, in order of first use"""
+        edges = range(self.indptr[node], self.indptr[node + 1]) if node < len(self.indptr) - 1 else ()
+        extra = self.extra_in.get(node)
+        return [*edges, *extra] if extra else edges
+
+    def _add_edges(self, dst, lengths):
+        """Count the edges along the new alignments' node ids; returns the destinations whose incoming edges changed"""
+        edge_dst, edge_src, counts, first_seen = unique_edges(*path_edges(dst, lengths), self.num_nodes)
+        order = np.argsort(first_seen, kind='stable')    # new edges join their node's list in order of first use
+        edge_dst, edge_src, counts = edge_dst[order], edge_src[order], counts[order]
+
+        edge_counts = self.counts
+        for node, prev_node, count in zip(edge_dst.tolist(), edge_src.tolist(), counts.tolist()):
+            for edge in self.in_edges(node):
+                if self.edge_src[edge] == prev_node:
+                    edge_counts[edge] += count
+                    break
+            else:
+                self.extra_in.setdefault(node, []).append(len(self.edge_src))
+                self.extra_out.setdefault(prev_node, []).append(node)
+                self.extra_dst.append(node)
+                self.edge_src.append(prev_node)
+                edge_counts.append(count)
+        return set(edge_dst.tolist())
+
+    def _rescore(self, dirty, everything=False):
+        """Recompute best paths from the dirty nodes onwards, in order of coordinate sum
+
+        Every edge increases the coordinate sum, so a heap keyed by it visits each affected
+        node once, after all its predecessors. A node's successors are only revisited when
+        its path score or length changed. With everything set, all nodes are scored.
+        """
+        num_nodes = self.num_nodes
+        num_base = len(self.indptr) - 1
+        sums, indptr, extra_in = self.sums, self.indptr, self.extra_in
+        successor_ptr, successors, extra_out = self.successor_ptr, self.successors, self.extra_out
+        edge_src, counts = self.edge_src, self.counts
+        path_score, path_length, path_average = self.path_score, self.path_length, self.path_average
+        best_previous, best_count = self.best_previous, self.best_count
+
+        # Heap keys are sum * num_nodes + node: plain ints compare faster than tuples
+        if everything:
+            heap = []
+            nodes = np.argsort(np.array(sums), kind='stable')[1:].tolist()
+        else:
+            heap = [sums[node] * num_nodes + node for node in dirty]
+            heapq.heapify(heap)
+            nodes = ()
+        queued = bytearray(num_nodes)
+        for node in dirty or ():
+            queued[node] = 1
+
+        def pop_dirty():
+            while heap:
+                yield heapq.heappop(heap) % num_nodes
+
+        visited = 0
+        for node in nodes if everything else pop_dirty():
+            visited += 1
+            edges = range(indptr[node], indptr[node + 1]) if node < num_base else ()
+            extra = extra_in.get(node)
+            if extra:
+                edges = [*edges, *extra]
+            best_edge = -1
+            for edge in edges:
+                value = counts[edge] + path_average[edge_src[edge]]
+                if best_edge < 0 or value > best_value:
+                    best_edge, best_value = edge, value
+
+            prev_node = edge_src[best_edge]
+            best_previous[node] = prev_node
+            count = best_count[node] = counts[best_edge]
+            score = count + path_score[prev_node]
+            length = path_length[prev_node] + 1
+            if score != path_score[node] or length != path_length[node]:
+                path_score[node], path_length[node] = score, length
+                path_average[node] = score / length
+                if everything:
+                    continue
+                after = successors[successor_ptr[node]:successor_ptr[node + 1]] if node < num_base else []
+                extra = extra_out.get(node)
+                if extra:
+                    after = after + extra
+                for successor in after:
+                    if not queued[successor]:
+                        queued[successor] = 1
+                        heapq.heappush(heap, sums[successor] * num_nodes + successor)
+        logger.info(f"Rescored {visited} of {num_nodes} nodes")
+
+    def consensus(self):
+        """Consensus alignment and column scores of everything added so far"""
+        if not self.num_alignments:
+            raise ValueError("No alignments have been added")
+        path = []
+        scores = []
+        node = self.end_node
+        while node != 0:
+            path.append(node)
+            scores.append(self.best_count[node] / self.num_alignments)
+            node = self.best_previous[node]
+
+        path.reverse()
+        scores.reverse()
+        return convert_coordinates_to_sequences(self.coordinates[path], self.original_sequences), scores
+
+    def snapshot(self):
+        """GraphSnapshot of the state, with the path statistics so loading skips the rescoring
+
+        Nodes are renumbered in order of coordinate sum, which snapshots need; the state keeps its ids.
+        """
+        num_base = len(self.indptr) - 1
+        order = np.argsort(np.array(self.sums), kind='stable')
+        new_ids = np.empty_like(order)
+        new_ids[order] = np.arange(len(order))
+        edge_dst = new_ids[np.concatenate([np.repeat(np.arange(num_base), np.diff(self.indptr)),
+                                           np.array(self.extra_dst, dtype=np.int64)])]
+        by_destination = np.argsort(edge_dst, kind='stable')    # edge ids follow first use within a node
+        indptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edge_dst, minlength=self.num_nodes), out=indptr[1:])
+        graph = AlignmentGraph(self.coordinates[order], indptr,
+                               new_ids[np.array(self.edge_src, dtype=np.int64)[by_destination]],
+                               np.array(self.counts, dtype=np.int64)[by_destination])
+        paths = {name: np.array(getattr(self, name), dtype=np.int64)[order] for name in PATH_ARRAYS}
+        paths['best_previous'] = new_ids[paths['best_previous']]
+        return GraphSnapshot(graph, self.original_sequences, self.num_alignments, self.sources, paths)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """State continuing the merge a snapshot was taken from
+
+        Only the order of first appearance among a node's predecessors matters for ties,
+        and snapshots keep predecessors in that order, so node and edge ids carry over.
+        """
+        graph = snapshot.graph
+        state = cls(snapshot.original_sequences)
+        state._index = CoordinateIndex(graph.coordinates)
+        sums = state.coordinates.sum(axis=1, dtype=np.int64)
+        state.sums = sums.tolist()
+        state.end_node = int(np.argmax(sums))
+        indptr = np.asarray(graph.indptr, dtype=np.int64)
+        predecessors = np.asarray(graph.predecessors, dtype=np.int64)
+        state.indptr = indptr.tolist()
+        state.edge_src = predecessors.tolist()
+        state.counts = np.asarray(graph.counts, dtype=np.int64).tolist()
+        by_source = np.argsort(predecessors, kind='stable')
+        state.successor_ptr = np.searchsorted(predecessors[by_source], np.arange(graph.num_nodes + 1)).tolist()
+        state.successors = np.repeat(np.arange(graph.num_nodes), np.diff(indptr))[by_source].tolist()
+        state.num_alignments = snapshot.num_alignments
+        state.sources = list(snapshot.sources)
+        if snapshot.paths is not None:
+            for name in PATH_ARRAYS:
+                setattr(state, name, np.asarray(snapshot.paths[name], dtype=np.int64).tolist())
+            path_length = np.asarray(snapshot.paths['path_length'])
+            state.path_average = np.divide(snapshot.paths['path_score'], path_length, out=np.zeros(len(sums)),
+                                           where=path_length > 0).tolist()
+        else:
+            for name in PATH_ARRAYS + ('path_average',):
+                setattr(state, name, [0] * graph.num_nodes)
+            state._rescore(None, everything=True)
+        return state
+
+    def save(self, directory):
+        """Write the state as a graph snapshot directory"""
+        self.snapshot().save(directory)
+
+    @classmethod
+    def load(cls, directory):
+        """Read a state written by save, or continue from any graph snapshot
+
+        Only snapshots that name all their alignments in sources can be continued by update_state.
+        """
+        return cls.from_snapshot(GraphSnapshot.load(directory, mmap_mode=None))
+
+def topological_order(nodes):
+    """Coordinates bucketed by coordinate sum, which increases along every edge, without comparing tuples"""
+    sums = list(map(sum, nodes))
+    buckets = [[] for _ in range(max(sums) + 1)]
+    for coord, total in zip(nodes, sums):
+        buckets[total].append(coord)
+    return [coord for bucket in buckets for coord in bucket]
+
+def score_nodes(nodes, num_paths=100, order='sort'):
+    """Score nodes and find optimal path, visiting nodes in sorted or topological order"""
+    if order not in NODE_ORDERS:
+        raise ValueError(f"Unknown node order: {order}")
     dimensions = len(next(iter(nodes)))
     start_node = tuple([0] * dimensions)
-    sorted_coords = sorted(nodes.keys())
+    sorted_coords = topological_order(nodes) if order == 'topological' else sorted(nodes.keys())
     
     for coord in sorted_coords[1:]:
         current_node = nodes[coord]
         prev_nodes = current_node.previous_nodes 
-        best_node = max(prev_nodes, key=lambda n: n[1] + nodes[n[0]].path_average)
+        best_node = max(prev_nodes.items(), key=lambda n: n[1] + nodes[n[0]].path_average)
         
         prev_node_coord = best_node[0]
         current_node.path_length = nodes[prev_node_coord].path_length + 1
@@ -121,12 +1028,7 @@ def score_nodes(nodes, num_paths=100):
         path.append(coord)
         current_node = nodes[coord]
         prev_node = current_node.best_previous_node
-        for node, count in current_node.previous_nodes:
-            if node == prev_node:
-                break
-        else:
-            count = 0 
-        
+        count = current_node.previous_nodes.get(prev_node, 0)
         scores.append(count / num_paths)
         coord = prev_node
 
@@ -134,74 +1036,284 @@ def score_nodes(nodes, num_paths=100):
     scores.reverse()
     return path, scores
 
+def coordinates_to_matrix(coordinates, original_sequences):
+    """Gather residues for all consensus columns into a (sequences x columns) uint8 matrix"""
+    first_seqs = {}
+    for name, seq in original_sequences:
+        first_seqs.setdefault(name, seq)
+    residues = [first_seqs[name].encode('ascii') for name, _ in original_sequences]
+    buffer = np.frombuffer(b''.join(residues), dtype=np.uint8)
+    offsets = np.cumsum([0] + [len(seq) for seq in residues[:-1]])
+
+    indices = np.asarray(coordinates, dtype=np.int64).reshape(-1, len(residues)).T
+    advanced = np.diff(indices, axis=1, prepend=0) != 0
+    matrix = np.full(indices.shape, GAP, dtype=np.uint8)
+    matrix[advanced] = buffer[(indices + offsets[:, None] - 1)[advanced]]
+    return matrix
+
 def convert_coordinates_to_sequences(coordinates, original_sequences):
     """Convert coordinates to final alignment"""
-    seq_names = [name for name, _ in original_sequences]
+    if not len(coordinates):
+        return {}
+
+    matrix = coordinates_to_matrix(coordinates, original_sequences)
     alignment = {}
-    
-    for idx, sequence_indices in enumerate(zip(*coordinates)):
-        seq_name = seq_names[idx]
-        original_seq = next(seq for name, seq in original_sequences if name == seq_name)
-        alignment[seq_name] = convert_indices_to_sequence(sequence_indices, original_seq)
+    for (name, _), row in zip(original_sequences, matrix):
+        alignment[name] = row.tobytes().decode('ascii')
         
     return alignment
     
-def combine_alignments(alignment_names):
-    """Main function to combine multiple alignments"""
+def read_alignments(alignment_names):
+    """Read alignment files, skipping any that cannot be parsed"""
     alignments = []
     for filename in alignment_names:
         try:
-            aln = parse_fasta(filename)
+            aln = read_alignment(filename)
             if aln:
                 alignments.append(aln)
-                print(f"Successfully read: {filename}")
+                logger.info(f"Successfully read: {filename}")
             else:
-                print(f"Warning: Empty alignment in {filename}")
+                logger.warning(f"Warning: Empty alignment in {filename}")
         except Exception as e:
-            print(f"Error reading {filename}: {e}")
-    
+            logger.error(f"Error reading {filename}: {e}")
+    return alignments
+
+def read_named_alignments(alignment_names, skip=()):
+    """read_alignments, also returning the file name each alignment was read from
+
+    Files whose names are in skip are not read.
+    """
+    alignments, sources = [], []
+    for filename in alignment_names:
+        if os.path.basename(filename) in skip:
+            continue
+        parsed = read_alignments([filename])
+        alignments.extend(parsed)
+        sources.extend([os.path.basename(filename)] * len(parsed))
+    return alignments, sources
+
+@contextlib.contextmanager
+def gc_paused():
+    """Pause cyclic garbage collection while building containers that form no cycles
+
+    Otherwise every few hundred thousand new tuples and dicts trigger a full scan of
+    the graph built so far.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+@contextlib.contextmanager
+def log_level_set(level):
+    """Set the level of the 'mergealign' logger for the duration, then restore the caller's"""
+    previous = logger.level
+    if level is not None:
+        logger.setLevel(level)
+    try:
+        yield
+    finally:
+        logger.setLevel(previous)
+
+def stage(profiler, name):
+    """profiler.stage(name), or a no-op when not profiling"""
+    return profiler.stage(name) if profiler is not None else contextlib.nullcontext()
+
+def merge_alignments(alignments, engine='nodes', profiler=None, snapshot=None, workers=1, sources=None):
+    """Combine parsed alignments; returns the consensus, its scores and the number of alignments used
+
+    With snapshot set to a directory, the graph is also saved there as a GraphSnapshot,
+    with the sources (one name per alignment) of the alignments that were used.
+    With workers > 1 the array and banded engines score the graph in a process pool.
+    """
+    if engine not in GRAPH_ENGINES:
+        raise ValueError(f"Unknown graph engine: {engine}")
+    if workers > 1 and engine == 'nodes':
+        raise ValueError("Parallel scoring needs the array or banded engine")
     if not alignments:
         raise ValueError("No valid alignments were read")
     
-    original_sequences = [(name, seq.replace('-', '')) for name, seq in alignments[0]]
-    sequence_names = [name for name, _ in original_sequences]
-    
-    print(f"Number of sequences: {len(sequence_names)}")
-    print(f"First sequence name: {sequence_names[0] if sequence_names else 'None'}")
-    
-    indices = []
-    for alignment in alignments:
-        try:
-            seq_dict = dict(alignment)
-            index_list = [convert_to_indices(seq_dict[seq]) for seq in sequence_names]
-            indices.append(index_list)
-        except Exception as e:
-            print(f"Error converting sequences to indices: {e}")
+    with stage(profiler, 'index'):
+        original_sequences = [(name, seq.replace('-', '')) for name, seq in alignments[0]]
+        sequence_names = [name for name, _ in original_sequences]
         
-    coordinates = []
-    for alignment in indices:
-        coord = list(zip(*alignment))
-        coordinates.append(coord)
-    
-    if not coordinates:
-        raise ValueError("No valid coordinates were generated")
-    
-    print(f"Number of coordinate sets: {len(coordinates)}")
+        logger.info(f"Number of sequences: {len(sequence_names)}")
+        logger.info(f"First sequence name: {sequence_names[0] if sequence_names else 'None'}")
+        
+        matrices, used_sources = [], []
+        for alignment, source in zip(alignments, sources if sources is not None else [None] * len(alignments)):
+            try:
+                matrices.append(alignment_to_matrix(alignment, sequence_names))
+            except Exception as e:
+                logger.error(f"Error converting sequences to indices: {e}")
+                continue
+            used_sources.append(source)
+        
+        if not matrices:
+            raise ValueError("No valid coordinates were generated")
+        
+        if engine == 'nodes':
+            coordinates, lengths = matrices_to_coordinates(matrices)
+            with gc_paused():
+                tuples = coordinates_to_tuples(coordinates, lengths)
+        else:
+            # Converted one alignment at a time while the graph is built
+            coordinates = MatrixCoordinates(matrices)
+            lengths = coordinates.lengths
+        logger.info(f"Number of coordinate sets: {len(coordinates)}")
     
-    nodes = create_nodes(coordinates)
-    final_coordinates, scores = score_nodes(nodes, len(coordinates))
-    final_alignment = convert_coordinates_to_sequences(final_coordinates, original_sequences)
+    if engine == 'array':
+        with stage(profiler, 'graph'):
+            graph = create_graph(coordinates, lengths)
+        with stage(profiler, 'score'):
+            final_coordinates, scores = score_graph(graph, len(coordinates), workers)
+        num_nodes, num_edges = graph.num_nodes, graph.num_edges
+    elif engine == 'banded':
+        with stage(profiler, 'graph'):
+            banded = create_banded_graph(coordinates, lengths)
+        with stage(profiler, 'score'):
+            final_coordinates, scores = score_banded(banded, len(coordinates), workers)
+        num_nodes, num_edges = banded.graph.num_nodes, banded.graph.num_edges
+    else:
+        with stage(profiler, 'graph'), gc_paused():
+            nodes = create_nodes(tuples)
+            del tuples      # the graph keeps one tuple per node; drop the per-alignment copies
+        with stage(profiler, 'score'):
+            final_coordinates, scores = score_nodes(nodes, len(coordinates))
+        num_nodes, num_edges = len(nodes), sum(len(node.previous_nodes) for node in nodes.values())
+    if snapshot:
+        with stage(profiler, 'snapshot'):
+            if engine == 'nodes':
+                graph = nodes_to_graph(nodes)
+            elif engine == 'banded':
+                graph = banded_to_graph(banded)
+            GraphSnapshot(graph, original_sequences, len(coordinates),
+                          used_sources if sources is not None else None).save(snapshot)
+        logger.info(f"Graph snapshot written to {snapshot}")
+    with stage(profiler, 'reconstruct'):
+        final_alignment = convert_coordinates_to_sequences(final_coordinates, original_sequences)
     
+    if profiler is not None:
+        profiler.count(num_alignments=len(coordinates), num_sequences=len(sequence_names),
+                       max_alignment_length=int(max(lengths)), num_nodes=int(num_nodes), num_edges=int(num_edges),
+                       consensus_columns=len(scores))
+        if engine == 'banded':
+            profiler.count(num_anchors=len(banded.anchors), agreed_steps=banded.num_agreed)
+    return final_alignment, scores, len(coordinates)
+
+def combine_alignments(alignment_names, engine='nodes', profiler=None, snapshot=None, workers=1):
+    """Main function to combine multiple alignments"""
+    with stage(profiler, 'parse'):
+        alignments, sources = read_named_alignments(alignment_names)
+    final_alignment, scores, _ = merge_alignments(alignments, engine, profiler, snapshot, workers, sources)
+    return final_alignment, scores
+
+def rescore_snapshot(directory, num_paths=None, engine='array', profiler=None, workers=1):
+    """Consensus and scores from a saved GraphSnapshot, without reading any alignments"""
+    with stage(profiler, 'load'):
+        snapshot = GraphSnapshot.load(directory)
+    logger.info(f"Loaded graph of {snapshot.graph.num_nodes} nodes from {snapshot.num_alignments} alignments")
+    with stage(profiler, 'score'):
+        final_coordinates, scores = snapshot.score(num_paths, engine, workers)
+    with stage(profiler, 'reconstruct'):
+        final_alignment = convert_coordinates_to_sequences(final_coordinates, snapshot.original_sequences)
+    if profiler is not None:
+        profiler.count(num_alignments=snapshot.num_alignments, num_nodes=snapshot.graph.num_nodes,
+                       num_edges=snapshot.graph.num_edges, consensus_columns=len(scores))
+    return final_alignment, scores
+
+def merge(alignments, *, engine='nodes', return_scores=True, log_level=None, profile=None, workers=1):
+    """Merge alignments in process and return a MergeResult
+
+    alignments is a folder of alignment files or a list whose items are file paths or
+    in-memory alignments, given as lists of (seq_id, sequence) tuples or dicts of
+    seq_id -> sequence. Progress is logged to the 'mergealign' logger; log_level sets its level
+    for this call only.
+    profile is one of PROFILE_MODES (default: $MERGEALIGN_PROFILE); its report is in result.profile.
+    workers > 1 scores the graph in a process pool (array and banded engines).
+    """
+    profile = profile or profile_mode_from_env()
+    profiler = StageProfiler(profile) if profile else None
+
+    with log_level_set(log_level), profiler if profiler is not None else contextlib.nullcontext():
+        with stage(profiler, 'parse'):
+            if isinstance(alignments, (str, os.PathLike)):
+                alignments = [os.path.join(alignments, f) for f in os.listdir(alignments)]
+
+            parsed = []
+            for alignment in alignments:
+                if isinstance(alignment, (str, os.PathLike)):
+                    parsed.extend(read_alignments([alignment]))
+                elif isinstance(alignment, dict):
+                    parsed.append(list(alignment.items()))
+                else:
+                    parsed.append(list(alignment))
+
+        final_alignment, scores, num_alignments = merge_alignments(parsed, engine, profiler, workers=workers)
+    return MergeResult(final_alignment, scores if return_scores else None, num_alignments,
+                       profiler.report() if profiler is not None else None)
+
+def update_state(state_dir, alignment_names, profiler=None):
+    """Add the alignments not yet in the MergeState saved in state_dir to it, creating it if needed
+
+    Alignments are matched by file name, so state_dir must name every alignment it holds;
+    a --save-graph snapshot does. Returns the consensus and scores, and saves the state.
+    """
+    state = MergeState.load(state_dir) if os.path.exists(state_dir) else None
+    if state is not None and (len(state.sources) != state.num_alignments or None in state.sources):
+        named = sum(source is not None for source in state.sources)
+        raise ValueError(f"{state_dir} names {named} of its {state.num_alignments} alignments, "
+                         f"so the ones it already holds cannot be told apart from new ones")
+    known = set(state.sources) if state is not None else set()
+
+    with stage(profiler, 'parse'):
+        alignments, sources = read_named_alignments(alignment_names, known)
+
+    with stage(profiler, 'update'):
+        if state is None:
+            state = MergeState.from_alignments(alignments, sources)
+        elif alignments:
+            state.add_alignments(alignments, sources)
+    logger.info(f"Added {len(alignments)} alignments, {state.num_alignments} in total")
+
+    with stage(profiler, 'reconstruct'):
+        final_alignment, scores = state.consensus()
+    if profiler is not None:
+        profiler.count(num_alignments=state.num_alignments, num_nodes=state.num_nodes, num_edges=state.num_edges,
+                       added_alignments=len(alignments), consensus_columns=len(scores))
+    state.save(state_dir)
     return final_alignment, scores
 
-def write_fasta(filename, alignment, threshold=None, scores=None):
-    """Write alignment to FASTA file"""
+def column_mask(scores, threshold=None):
+    """Boolean mask of the columns whose score is above threshold; all columns when threshold is None"""
+    scores = np.asarray(scores, dtype=float)
+    return scores > threshold if threshold is not None else np.ones(len(scores), dtype=bool)
+
+def write_fasta(filename, alignment, threshold=None, scores=None, mask=None):
+    """Write alignment to FASTA file
+
+    Only the columns scoring above threshold are written, or those set in a column_mask.
+    The mask is applied once to the alignment as a byte matrix, not per sequence.
+    """
+    if mask is None and threshold is not None and scores is not None:
+        mask = column_mask(scores, threshold)
     with open(filename, 'w') as f:
-        for name, sequence in alignment.items():
-            f.write(f">{name}\n")
-            if threshold is not None and scores is not None:
-                sequence = ''.join([aa for aa, score in zip(sequence, scores) if score > threshold])
-            f.write(f"{sequence}\n")
+        if mask is None or not alignment:
+            for name, sequence in alignment.items():
+                f.write(f">{name}\n{sequence}\n")
+            return
+        matrix = sequences_to_matrix(list(alignment.values()))
+        if len(mask) != matrix.shape[1]:
+            raise ValueError(f"Column mask has {len(mask)} columns, alignment has {matrix.shape[1]}")
+        kept = np.compress(mask, matrix, axis=1)     # faster than boolean indexing of a wide matrix
+        f.write(''.join([f">{name}\n{row.tobytes().decode('ascii')}\n" for name, row in zip(alignment, kept)]))
+
+def write_columns(filename, mask):
+    """Write the 0-based indices of the columns set in a column_mask, one per line"""
+    np.savetxt(filename, np.flatnonzero(mask), fmt='%d')
     
 def write_score(filename, scores):
     """Write scores to file"""
@@ -212,8 +1324,10 @@ def write_score(filename, scores):
 if __name__ == '__main__':
     try:
         opts, args = getopt.getopt(sys.argv[1:],
-                                 "ha:f:s:t:",
-                                 ["help", "alignments=", "fasta=", "score=", "threshold="])
+                                 "ha:f:s:t:e:l:p:j:c:",
+                                 ["help", "alignments=", "fasta=", "score=", "threshold=", "engine=",
+                                  "log-level=", "profile=", "state=", "save-graph=",
+                                  "load-graph=", "num-paths=", "workers=", "columns="])
     except getopt.GetoptError:
         print("Error: command line argument not recognised")
         sys.exit(2)
@@ -221,7 +1335,16 @@ if __name__ == '__main__':
     alignment_folder = None
     fasta_output = None
     score_output = None
+    columns_output = None
     threshold = None
+    engine = None       # nodes, or array when rescoring a --load-graph snapshot
+    log_level = 'INFO'
+    profile = profile_mode_from_env()
+    state_dir = None
+    save_graph = None
+    load_graph = None
+    num_paths = None
+    workers = 1
     
     for opt, arg in opts:
         if opt in ("-h", "--help"):
@@ -232,6 +1355,8 @@ if __name__ == '__main__':
             fasta_output = arg
         elif opt in ("-s", "--score"):
             score_output = arg
+        elif opt in ("-c", "--columns"):
+            columns_output = arg
         elif opt in ("-t", "--threshold"):
             try:
                 threshold = float(arg)
@@ -241,16 +1366,99 @@ if __name__ == '__main__':
             except ValueError:
                 print('Error: threshold must be a number')
                 sys.exit(2)
+        elif opt in ("-e", "--engine"):
+            if arg not in GRAPH_ENGINES:
+                print(f"Error: engine must be one of {', '.join(GRAPH_ENGINES)}")
+                sys.exit(2)
+            engine = arg
+        elif opt in ("-l", "--log-level"):
+            log_level = arg.upper()
+            if log_level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR'):
+                print('Error: log level must be DEBUG, INFO, WARNING or ERROR')
+                sys.exit(2)
+        elif opt in ("-p", "--profile"):
+            profile = arg
+        elif opt == "--state":
+            state_dir = arg
+        elif opt == "--save-graph":
+            save_graph = arg
+        elif opt == "--load-graph":
+            load_graph = arg
+        elif opt == "--num-paths":
+            try:
+                num_paths = int(arg)
+                if num_paths < 1:
+                    raise ValueError
+            except ValueError:
+                print('Error: num-paths must be a positive integer')
+                sys.exit(2)
+        elif opt in ("-j", "--workers"):
+            try:
+                workers = int(arg) or available_cpus()
+                if workers < 1:
+                    raise ValueError
+            except ValueError:
+                print('Error: workers must be a positive integer, or 0 for one per core')
+                sys.exit(2)
     
-    if not alignment_folder:
+    if profile is not None and profile not in PROFILE_MODES:
+        print(f"Error: profile must be one of {', '.join(PROFILE_MODES)}")
+        sys.exit(2)
+    
+    if state_dir and (engine is not None or workers > 1):
+        print('Error: --state keeps its own graph and rescores it in one process; -e and -j do not apply')
+        sys.exit(2)
+
+    if save_graph and (state_dir or load_graph):
+        print('Error: --save-graph only applies to a merge with -a; --state and --load-graph keep their own graph')
+        sys.exit(2)
+
+    if state_dir and load_graph:
+        print('Error: --state and --load-graph cannot be combined')
+        sys.exit(2)
+
+    if num_paths is not None and not load_graph:
+        print('Error: --num-paths only applies with --load-graph')
+        sys.exit(2)
+
+    if engine is None:
+        engine = 'array' if load_graph else 'nodes'
+
+    if workers > 1 and engine == 'nodes':
+        print('Error: parallel scoring needs the array or banded engine')
+        sys.exit(2)
+
+    if not alignment_folder and not load_graph:
         print("Error: alignment folder not defined")
         sys.exit(2)
 
-    alignment_names = [os.path.join(alignment_folder, f) 
-                      for f in os.listdir(alignment_folder)]
-    final_alignment, scores = combine_alignments(alignment_names)
+    logging.basicConfig(stream=sys.stdout, level=log_level, format='%(message)s')
+
+    profiler = StageProfiler(profile) if profile else None
+    with profiler if profiler is not None else contextlib.nullcontext():
+        if load_graph:
+            final_alignment, scores = rescore_snapshot(load_graph, num_paths, engine, profiler, workers)
+        else:
+            alignment_names = [os.path.join(alignment_folder, f) 
+                              for f in os.listdir(alignment_folder)]
+            if state_dir:
+                final_alignment, scores = update_state(state_dir, alignment_names, profiler)
+            else:
+                final_alignment, scores = combine_alignments(alignment_names, engine, profiler, save_graph,
+                                                             workers)
+        
+        with stage(profiler, 'write'):
+            mask = column_mask(scores, threshold)
+            if fasta_output:
+                write_fasta(fasta_output, final_alignment, mask=mask if threshold is not None else None)
+            if columns_output:
+                write_columns(columns_output, mask)
+            if score_output:
+                write_score(score_output, scores)
     
-    if fasta_output:
-        write_fasta(fasta_output, final_alignment, threshold, scores)
-    if score_output:
-        write_score(score_output, scores)
+    if profiler is not None:
+        # The report goes next to the output: <output>.profile.json
+        report_file = f"{fasta_output or score_output or columns_output or 'mergealign'}.profile.json"
+        profiler.write(report_file)
+        logger.info(profiler.summary())
+        logger.info(f"Profile written to {report_file}")
@@ -0,0 +1,133 @@
+"""
+Content-addressed on-disk cache of aligner output
+
+Entries are keyed by hashes of the input FASTA bytes, the matrix file bytes and the
+aligner argument list, so changing one matrix only realigns what used that matrix.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+
+DEFAULT_CACHE_DIR = '.mafft_cache'
+DEFAULT_MAX_MB = 2048
+
+def file_digest(path, chunk_size=1 << 20):
+    """sha256 of a file's bytes"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def atomic_copy(source, destination):
+    """Copy via a temporary file in the destination folder so readers never see a partial file"""
+    folder = os.path.dirname(os.path.abspath(destination))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out, open(source, 'rb') as src:
+            shutil.copyfileobj(src, out)
+        os.replace(tmp_path, destination)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+class AlignmentCache:
+    """ Aligner outputs stored under their content hash, evicting least recently used entries past max_bytes """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._digests = {}      # (path, size, mtime) -> digest, so an input is hashed once per run
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes = sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        """(path, size, mtime) for every cached file"""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _digest(self, path):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest is None:
+            digest = file_digest(path)
+            with self._lock:
+                self._digests[key] = digest
+        return digest
+
+    def key(self, input_path, matrix_path, args):
+        """Cache key for aligning input_path with matrix_path using the given argument list"""
+        parts = [self._digest(input_path), self._digest(matrix_path), json.dumps(list(args))]
+        return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def fetch(self, key, output_path):
+        """Copy a cached result to output_path; returns False on a miss"""
+        path = self._path(key)
+        try:
+            atomic_copy(path, output_path)
+        except FileNotFoundError:
+            return False
+        try:
+            os.utime(path)      # mark as recently used
+        except FileNotFoundError:
+            pass
+        return True
+
+    def store(self, key, source_path):
+        """Add a finished output to the cache, then evict old entries if over the size limit"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(source_path)
+        with self._lock:
+            # Re-storing a key (two identical jobs, or a rerun) replaces the entry, so only the difference counts
+            try:
+                old_size = os.path.getsize(path)
+            except FileNotFoundError:
+                old_size = 0
+            atomic_copy(source_path, path)
+            self._total_bytes += size - old_size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._total_bytes = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._total_bytes -= size
+
+def cache_from_env(default_dir=None):
+    """AlignmentCache configured by MAFFT_CACHE_DIR / MAFFT_CACHE_MAX_MB, or None when disabled
+
+    MAFFT_CACHE_DIR=off disables caching; with the variable unset, default_dir is used.
+    """
+    directory = os.environ.get('MAFFT_CACHE_DIR', default_dir)
+    if not directory or directory == 'off':
+        return None
+    max_mb = float(os.environ.get('MAFFT_CACHE_MAX_MB', DEFAULT_MAX_MB))
+    return AlignmentCache(directory, int(max_mb * 1024 * 1024))
@@ -1,73 +1,149 @@
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+from fasta_reader import read_fasta, sequences_to_matrix
+
+GAP = ord('-')
+DEFAULT_INDEX_DIR = '.reference_index'
+
 def parse_fasta(filename):
     """Parse FASTA format alignment with debug output."""
     sequences = {}
-    current_id = None
-    
-    with open(filename) as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith('>'):
-                current_id = line[1:].split()[0]  
-                sequences[current_id] = ''
-            elif current_id is not None:
-                sequences[current_id] += line.replace('.', '-')  
+    for header, sequence in read_fasta(filename, strip_lines=True):
+        sequences[header.split()[0]] = sequence.replace('.', '-')
     
     return sequences
 
+def residue_columns(seqs, ids):
+    """Column of every residue of the given sequences, plus the number of residues per sequence"""
+    mask = sequences_to_matrix([seqs[seq_id] for seq_id in ids]) != GAP
+    _, columns = np.nonzero(mask)    # row-major, so each sequence's residues come out in order
+    return columns, mask.sum(axis=1)
+
+def gather_runs(values, starts, lengths):
+    """Concatenate values[start:start + length] for every (start, length) pair"""
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return values[np.repeat(starts, lengths) + offsets]
+
+def column_pairs(columns):
+    """Number of residue pairs sharing a column: sum of k*(k-1)/2 over column sizes k"""
+    counts = np.bincount(columns).astype(np.int64)
+    return int((counts * (counts - 1) // 2).sum())
+
+class ReferenceIndex:
+    """ A reference alignment parsed once into the column of every residue, reusable across test alignments """
+
+    def __init__(self, ids, columns, lengths, num_columns):
+        self.ids = list(ids)                # sorted sequence ids
+        self.columns = columns              # residue columns, sequence after sequence
+        self.lengths = lengths              # residues per sequence
+        self.num_columns = num_columns
+        self.starts = np.cumsum(lengths) - lengths
+        self.rows = {seq_id: row for row, seq_id in enumerate(self.ids)}
+        self.total_pairs = column_pairs(columns)
+
+    @classmethod
+    def from_sequences(cls, ref_seqs):
+        ids = sorted(ref_seqs.keys())
+        if not ids:
+            return cls([], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), 0)
+        columns, lengths = residue_columns(ref_seqs, ids)
+        return cls(ids, columns, lengths, len(ref_seqs[ids[0]]))
+
+    @classmethod
+    def from_file(cls, ref_file):
+        return cls.from_sequences(parse_fasta(ref_file))
+
+    def save(self, filename):
+        """Write the index as a .npz sidecar, via a temporary file so readers never see a partial one"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, ids=np.array(self.ids, dtype=str), columns=self.columns,
+                         lengths=self.lengths, num_columns=self.num_columns)
+            os.replace(tmp_path, filename)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data['ids'].tolist(), data['columns'], data['lengths'], int(data['num_columns']))
+
+    @classmethod
+    def cached(cls, ref_file, index_dir=DEFAULT_INDEX_DIR):
+        """Index of ref_file from its sidecar in index_dir, rebuilt when missing or older than ref_file"""
+        ref_path = os.path.abspath(ref_file)
+        path_hash = hashlib.sha256(ref_path.encode()).hexdigest()[:16]
+        sidecar = os.path.join(index_dir, f"{os.path.basename(ref_path)}.{path_hash}.npz")
+        if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(ref_path):
+            return cls.load(sidecar)
+        index = cls.from_file(ref_path)
+        os.makedirs(index_dir, exist_ok=True)
+        index.save(sidecar)
+        return index
+
+    def residues(self, ids):
+        """Residue columns and per-sequence residue counts for a subset of sequence ids"""
+        if len(ids) == len(self.ids):
+            return self.columns, self.lengths
+        rows = np.array([self.rows[seq_id] for seq_id in ids], dtype=np.int64)
+        return gather_runs(self.columns, self.starts[rows], self.lengths[rows]), self.lengths[rows]
+
+def count_aligned_pairs(test_seqs, ref):
+    """TP, FP and FN aligned residue pairs of a test alignment against a reference
+
+    A residue is identified by its sequence and position, and a pair is aligned when both
+    residues share a column. Grouping the residues found in both alignments by
+    (test column, ref column) counts the pairs aligned in both without listing any pair.
+    ref is a dict of reference sequences or a ReferenceIndex.
+    """
+    if not isinstance(ref, ReferenceIndex):
+        ref = ReferenceIndex.from_sequences(ref)
+    common_ids = sorted(set(test_seqs.keys()) & ref.rows.keys())
+    if not common_ids:
+        return 0, 0, 0
+    
+    test_columns, test_lengths = residue_columns(test_seqs, common_ids)
+    ref_columns, ref_lengths = ref.residues(common_ids)
+    ref_pairs = ref.total_pairs if len(common_ids) == len(ref.ids) else column_pairs(ref_columns)
+    
+    # Residues at positions present in both versions of each sequence
+    shared = np.minimum(test_lengths, ref_lengths)
+    test_shared = gather_runs(test_columns, np.cumsum(test_lengths) - test_lengths, shared)
+    ref_shared = gather_runs(ref_columns, np.cumsum(ref_lengths) - ref_lengths, shared)
+    
+    codes = test_shared.astype(np.int64) * ref.num_columns + ref_shared
+    _, group_sizes = np.unique(codes, return_counts=True)
+    
+    tp = int((group_sizes * (group_sizes - 1) // 2).sum())
+    return tp, column_pairs(test_columns) - tp, ref_pairs - tp
+
 def calculate_alignment_scores(test_file, ref_file, debug=False):
-    """Calculate alignment scores with debug info."""
+    """Calculate alignment scores with debug info.
+
+    ref_file may be a precomputed ReferenceIndex, so a reference shared by many test
+    alignments is parsed only once.
+    """
     test_seqs = parse_fasta(test_file)
-    ref_seqs = parse_fasta(ref_file)
+    ref = ref_file if isinstance(ref_file, ReferenceIndex) else ReferenceIndex.from_file(ref_file)
     
     if debug:
         print("\nDebug Info:")
         print(f"Test sequences: {len(test_seqs)}")
-        print(f"Ref sequences: {len(ref_seqs)}")
-        print(f"Common IDs: {len(set(test_seqs.keys()) & set(ref_seqs.keys()))}")
+        print(f"Ref sequences: {len(ref.ids)}")
+        print(f"Common IDs: {len(set(test_seqs.keys()) & ref.rows.keys())}")
         if test_seqs:
             first_test = next(iter(test_seqs.values()))
             print(f"Test alignment length: {len(first_test)}")
-        if ref_seqs:
-            first_ref = next(iter(ref_seqs.values()))
-            print(f"Ref alignment length: {len(first_ref)}")
-    
-    test_pairs = set()
-    ref_pairs = set()
-    
-    common_ids = set(test_seqs.keys()) & set(ref_seqs.keys())
-    
-    for id1 in common_ids:
-        for id2 in common_ids:
-            if id1 >= id2:
-                continue
-            
-            seq1_test = test_seqs[id1]
-            seq2_test = test_seqs[id2]
-            seq1_ref = ref_seqs[id1]
-            seq2_ref = ref_seqs[id2]
-            
-            # Get aligned positions
-            pos1, pos2 = 0, 0
-            for i in range(len(seq1_test)):
-                if seq1_test[i] != '-' and seq2_test[i] != '-':
-                    test_pairs.add((f"{id1}_{pos1}", f"{id2}_{pos2}"))
-                if seq1_test[i] != '-':
-                    pos1 += 1
-                if seq2_test[i] != '-':
-                    pos2 += 1
-            
-            pos1, pos2 = 0, 0
-            for i in range(len(seq1_ref)):
-                if seq1_ref[i] != '-' and seq2_ref[i] != '-':
-                    ref_pairs.add((f"{id1}_{pos1}", f"{id2}_{pos2}"))
-                if seq1_ref[i] != '-':
-                    pos1 += 1
-                if seq2_ref[i] != '-':
-                    pos2 += 1
+        if ref.ids:
+            print(f"Ref alignment length: {ref.num_columns}")
     
-    tp = len(test_pairs & ref_pairs)
-    fp = len(test_pairs - ref_pairs)
-    fn = len(ref_pairs - test_pairs)
+    tp, fp, fn = count_aligned_pairs(test_seqs, ref)
     
     precision = tp / (tp + fp) if (tp + fp) > 0 else 0
     recall = tp / (tp + fn) if (tp + fn) > 0 else 0
@@ -1,14 +1,19 @@
 import os
 import random
 from pathlib import Path
-import subprocess
 import re
 import json
 from datetime import datetime
-import time
 import urllib.request
 import urllib.parse
-from alignment_scoring import calculate_alignment_scores
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from alignment_scoring import calculate_alignment_scores, ReferenceIndex, DEFAULT_INDEX_DIR
+from mafft_runner import AlignmentJob, run_job
+from alignment_cache import DEFAULT_CACHE_DIR, cache_from_env
+from matrix_store import MatrixStore
+
+MAFFT_BENCHMARK_COMMAND = ['mafft', '--amino', '--quiet', '--retree', '2', '--maxiterate', '0',
+                           '--aamatrix', '{matrix}', '{input}']
 
 def parse_matrix_list(filename):
     matrices = []
@@ -144,85 +149,145 @@ def fetch_matrix_data(matrix_id):
         print(f"Error fetching matrix {matrix_id}: {e}")
         return None
 
-def run_benchmark(matrix_id, matrix_data, benchmark_msas, output_dir):
-    scores = []
-    
-    matrix_file = create_matrix_file(matrix_id, matrix_data)  
-    
-    for idx, (input_file, ref_file) in enumerate(benchmark_msas):
-        output_file = output_dir / f"{input_file.stem}_{matrix_id}.aln"
-        
-        cmd = [
-            'mafft',
-            '--amino',
-            '--quiet',
-            '--retree', '2',
-            '--maxiterate', '0',
-            '--aamatrix', str(matrix_file),
-            str(input_file)
-        ]
-        
-        try:
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            with open(output_file, 'w') as f:
-                f.write(result.stdout)
-                
-            score = calculate_alignment_scores(output_file, ref_file)
-            scores.append(score)
-            
-        except Exception as e:
-            print(f"Error processing {input_file} with {matrix_id}: {e}")
-    
-    if scores:
-        avg_scores = {
-            'f_score': sum(s['f_score'] for s in scores) / len(scores),
-            'precision': sum(s['precision'] for s in scores) / len(scores),
-            'recall': sum(s['recall'] for s in scores) / len(scores)
-        }
-        return avg_scores
-    return None
+def run_cell(matrix_id, matrix_file, input_file, ref_file, output_dir, cache=None, ref=None):
+    """Align one MSA with one matrix and score it; returns a result record for the grid"""
+    record = {'matrix': matrix_id, 'input': str(input_file), 'ref': str(ref_file)}
+    output_file = Path(output_dir) / f"{Path(input_file).stem}_{matrix_id}.aln"
+    try:
+        job = run_job(AlignmentJob(input_file, matrix_file, output_file), MAFFT_BENCHMARK_COMMAND, cache)
+        if job['returncode'] != 0:
+            raise RuntimeError(f"MAFFT exited with status {job['returncode']}: {job['stderr']}")
+        record.update(calculate_alignment_scores(output_file, ref if ref is not None else ref_file))
+        record['wall_time'] = job['wall_time']
+    except Exception as e:
+        record['error'] = str(e)
+    return record
+
+def average_scores(scores):
+    if not scores:
+        return None
+    return {
+        'f_score': sum(s['f_score'] for s in scores) / len(scores),
+        'precision': sum(s['precision'] for s in scores) / len(scores),
+        'recall': sum(s['recall'] for s in scores) / len(scores)
+    }
+
+def load_grid_results(results_file):
+    """Latest record per (matrix, input) cell from a JSON-lines results file
+
+    A line cut short by a crash is skipped, so that cell simply runs again.
+    """
+    records = {}
+    if not os.path.exists(results_file):
+        return records
+    with open(results_file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[(record['matrix'], record['input'])] = record
+    return records
+
+def scored(records, matrix_id, input_file):
+    """The successful record for a cell, or None if it has not run or failed"""
+    record = records.get((matrix_id, str(input_file)))
+    return record if record is not None and 'error' not in record else None
+
+def run_grid(matrix_files, benchmark_msas, output_dir, results_file, max_workers=None, cache=None, ref_indices=None):
+    """Run every (matrix, MSA) cell not already scored in results_file on a pool of max_workers
+
+    Each finished cell is appended to results_file and flushed straight away, so an
+    interrupted sweep resumes from the cells that are left. Cells that failed are retried.
+    Returns the latest record for every cell.
+    """
+    records = load_grid_results(results_file)
+    pending = [(matrix_id, matrix_file, input_file, ref_file)
+               for matrix_id, matrix_file in matrix_files.items()
+               for input_file, ref_file in benchmark_msas
+               if scored(records, matrix_id, input_file) is None]
+    print(f"{len(pending)} of {len(matrix_files) * len(benchmark_msas)} cells to run")
+
+    max_workers = max_workers or os.cpu_count()
+    with open(results_file, 'a+') as out, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if out.tell() > 0:
+            out.seek(out.tell() - 1)
+            if out.read(1) != '\n':    # end a line cut short by a crash
+                out.write('\n')
+        futures = [executor.submit(run_cell, matrix_id, matrix_file, input_file, ref_file, output_dir, cache,
+                                   ref_indices.get(ref_file) if ref_indices else None)
+                   for matrix_id, matrix_file, input_file, ref_file in pending]
+        for done, future in enumerate(as_completed(futures), 1):
+            record = future.result()
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+            records[(record['matrix'], record['input'])] = record
+            if 'error' in record:
+                print(f"[{done}/{len(pending)}] Error processing {record['input']} with {record['matrix']}: {record['error']}")
+            else:
+                print(f"[{done}/{len(pending)}] {record['matrix']} {Path(record['input']).name}: F-score {record['f_score']:.4f}")
+    return records
+
+def read_benchmark_msas(filename):
+    with open(filename) as f:
+        return [tuple(Path(p) for p in line.rstrip('\n').split('\t')) for line in f if line.strip()]
 
 def main():
-    output_dir = Path(f'benchmark_results_{datetime.now().strftime("%Y%m%d_%H%M%S")}')
+    # BENCHMARK_RESUME=<results dir> continues an interrupted sweep with the same MSAs
+    resume_dir = os.environ.get('BENCHMARK_RESUME')
+    max_workers = int(os.environ.get('BENCHMARK_WORKERS', 0)) or None
+    output_dir = Path(resume_dir or f'benchmark_results_{datetime.now().strftime("%Y%m%d_%H%M%S")}')
     output_dir.mkdir(exist_ok=True)
     
-    all_msas = collect_all_msas()
-    if len(all_msas) < 10:
-        print("Warning: Found fewer than 10 MSAs")
-        benchmark_msas = all_msas
+    if (output_dir / 'benchmark_msas.txt').exists():
+        benchmark_msas = read_benchmark_msas(output_dir / 'benchmark_msas.txt')
     else:
-        benchmark_msas = random.sample(all_msas, 10)
+        all_msas = collect_all_msas()
+        if len(all_msas) < 10:
+            print("Warning: Found fewer than 10 MSAs")
+            benchmark_msas = all_msas
+        else:
+            benchmark_msas = random.sample(all_msas, 10)
+        
+        with open(output_dir / 'benchmark_msas.txt', 'w') as f:
+            for input_file, ref_file in benchmark_msas:
+                f.write(f"{input_file}\t{ref_file}\n")
         
     print(f"Selected {len(benchmark_msas)} MSAs for benchmarking")
     
+    # Each reference is scored against every matrix; parse it once, or load it from an earlier run
+    ref_indices = {ref_file: ReferenceIndex.cached(ref_file, DEFAULT_INDEX_DIR) for _, ref_file in benchmark_msas}
+    
     matrices = parse_matrix_list('list_of_matrices.txt')
     print(f"Testing {len(matrices)} matrices")
     
-    results = {}
+    cache = cache_from_env(DEFAULT_CACHE_DIR)
+    # Parsed matrices come from aaindex_matrices.npz or a local aaindex2 file; genome.jp is only
+    # queried (one request per second) for matrices neither of them has
+    store = MatrixStore(parse=parse_matrix_raw, fetch=fetch_matrix_data)
     
-    for matrix_idx, matrix_id in enumerate(matrices, 1):
-        print(f"\nProcessing matrix {matrix_idx}/{len(matrices)}: {matrix_id}")
-        
-        matrix_text = fetch_matrix_data(matrix_id)
-        if not matrix_text:
-            print(f"Failed to fetch matrix {matrix_id}")
-            continue
-            
+    matrix_files = {}
+    for matrix_id in matrices:
         try:
-            matrix_data = parse_matrix_raw(matrix_text)
-            scores = run_benchmark(matrix_id, matrix_data, benchmark_msas, output_dir)
-            if scores:
-                results[matrix_id] = scores
-                print(f"Average F-score: {scores['f_score']:.4f}")
-            
-            time.sleep(1) 
-            
+            matrix_data = store.get(matrix_id)
+            if matrix_data is None:
+                print(f"Failed to fetch matrix {matrix_id}")
+                continue
+            matrix_files[matrix_id] = create_matrix_file(matrix_id, matrix_data)
         except Exception as e:
             print(f"Error processing matrix {matrix_id}: {e}")
+    store.save()
     
-    with open(output_dir / 'benchmark_msas.txt', 'w') as f:
-        for input_file, ref_file in benchmark_msas:
-            f.write(f"{input_file}\t{ref_file}\n")
+    records = run_grid(matrix_files, benchmark_msas, output_dir, output_dir / 'grid_results.jsonl',
+                       max_workers, cache, ref_indices)
+    
+    results = {}
+    for matrix_id in matrix_files:
+        scores = [scored(records, matrix_id, input_file) for input_file, _ in benchmark_msas]
+        scores = [s for s in scores if s is not None]
+        if scores:
+            results[matrix_id] = average_scores(scores)
     
     sorted_matrices = sorted(results.items(), 
                            key=lambda x: x[1]['f_score'], 
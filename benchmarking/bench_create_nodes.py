@@ -0,0 +1,74 @@
+import sys
+import os
+import time
+import logging
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from MergeAlign import (Node, parse_fasta, alignment_to_matrix, matrices_to_coordinates, coordinates_to_tuples,
+                        create_nodes, create_graph)
+
+REPEATS = 5
+
+def create_nodes_list_scan(coordinates):
+    """create_nodes as it was before predecessors were hash-indexed, kept for comparison"""
+    dimensions = len(coordinates[0][0])
+    start_node = tuple([0] * dimensions)
+    nodes = {start_node: Node()}
+    for node in nodes.values():
+        node.previous_nodes = []
+
+    for alignment in coordinates:
+        prev_node = start_node
+        for point in alignment:
+            if point not in nodes:
+                nodes[point] = Node()
+                nodes[point].previous_nodes = []
+
+            prev_nodes_list = nodes[point].previous_nodes
+            for idx, (node, count) in enumerate(prev_nodes_list):
+                if node == prev_node:
+                    prev_nodes_list[idx] = (node, count + 1)
+                    break
+            else:
+                prev_nodes_list.append((prev_node, 1))
+
+            prev_node = point
+
+    return nodes
+
+def load_coordinates(alignments_dir):
+    """Coordinate tuples for every alignment in a folder, in the form create_nodes takes"""
+    alignments = [parse_fasta(os.path.join(alignments_dir, f)) for f in sorted(os.listdir(alignments_dir))]
+    sequence_names = [name for name, _ in alignments[0]]
+    coordinates, lengths = matrices_to_coordinates([alignment_to_matrix(a, sequence_names) for a in alignments])
+    tuples = coordinates_to_tuples(coordinates, lengths)
+    return tuples, coordinates, lengths
+
+def best_time(func, *args):
+    """Best wall time of REPEATS calls"""
+    times = []
+    for _ in range(REPEATS):
+        start_time = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+if __name__ == "__main__":
+    ALIGNMENTS_DIR = sys.argv[1] if len(sys.argv) > 1 else "../mafft_alignments"
+
+    logging.getLogger('mergealign').setLevel(logging.WARNING)
+    tuples, coordinates, lengths = load_coordinates(ALIGNMENTS_DIR)
+    nodes = create_nodes(tuples)
+    num_edges = sum(len(node.previous_nodes) for node in nodes.values())
+    most_edges = max(len(node.previous_nodes) for node in nodes.values())
+    print(f"{ALIGNMENTS_DIR}: {len(tuples)} alignments, {len(nodes)} nodes, {num_edges} edges, "
+          f"up to {most_edges} predecessors per node")
+
+    list_time = best_time(create_nodes_list_scan, tuples)
+    dict_time = best_time(create_nodes, tuples)
+    graph_time = best_time(create_graph, coordinates, lengths)
+
+    print(f"create_nodes, list scan:    {list_time:.3f}s")
+    print(f"create_nodes, hash indexed: {dict_time:.3f}s ({list_time / dict_time:.2f}x)")
+    print(f"create_graph, arrays:       {graph_time:.3f}s ({list_time / graph_time:.2f}x)")
@@ -1,21 +1,15 @@
 import os
-import subprocess
+import sys
 from pathlib import Path
 import time
-import psutil
-from openpyxl import Workbook, load_workbook
 
-def load_processed_entries(excel_file):
-    processed_entries = set()
-    if os.path.exists(excel_file):
-        wb = load_workbook(excel_file)
-        sheet = wb.active
-        for row in sheet.iter_rows(min_row=2, values_only=True):
-            input_file, matrix_file = row[0], row[1]
-            processed_entries.add((input_file, matrix_file))
-    return processed_entries
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from mafft_runner import MAFFT_COMMAND, AlignmentJob, run_alignment_jobs
+from alignment_cache import cache_from_env
+from measure import ChildUsage, open_sheet, record_row, format_record
 
-def run_mafft_alignments(input_fasta, matrices_dir, output_dir, input_filename, excel_sheet, processed_entries, wb, excel_file):
+def run_mafft_alignments(input_fasta, matrices_dir, output_dir, input_filename, excel_sheet, wb, excel_file,
+                         max_workers=None, aligner=MAFFT_COMMAND, cache=None):
     file_output_dir = os.path.join(output_dir, input_filename)
     Path(file_output_dir).mkdir(parents=True, exist_ok=True)
     
@@ -24,69 +18,59 @@ def run_mafft_alignments(input_fasta, matrices_dir, output_dir, input_filename,
         if line.startswith('>'):
             num_sequences += 1
 
-    total_time = 0
-    total_memory_usage = 0
+    jobs = []
     for matrix_file in os.listdir(matrices_dir):
         output_path = os.path.join(file_output_dir, f"{matrix_file}.aln")
         
-        if (input_filename, matrix_file) in processed_entries or Path(output_path).exists():
+        if Path(output_path).exists():
             print(f"Alignment {matrix_file} for file {input_filename} already processed. Skipping.")
             continue
         
-        print(f"Processing matrix: {matrix_file} for file {input_filename}")
-        matrix_path = os.path.join(matrices_dir, matrix_file)
+        jobs.append(AlignmentJob(input_fasta, os.path.join(matrices_dir, matrix_file), output_path))
 
-        start_time = time.time()
-        process = psutil.Process(os.getpid())
-        start_memory = process.memory_info().rss / (1024 * 1024)
-        
-        cmd = f"mafft --quiet --auto --amino --aamatrix {matrix_path} {input_fasta} > {output_path}"
-        
-        try:
-            subprocess.run(cmd, shell=True, check=True)
-            print(f"Completed alignment with matrix {matrix_file} for file {input_filename}")
-        except subprocess.CalledProcessError as e:
-            print(f"Error with matrix {matrix_file} for file {input_filename}: {e}")
-            continue
-        
-        end_time = time.time()
-        end_memory = process.memory_info().rss / (1024 * 1024)
-
-        total_time += end_time - start_time
-        total_memory_usage += end_memory - start_memory
+    # Wall time of the whole ensemble, CPU time of all MAFFT runs, and peak memory summed
+    # over the MAFFT processes running at the same time
+    failed = 0
+    with ChildUsage() as usage:
+        for record in run_alignment_jobs(jobs, max_workers, aligner, cache):
+            if record['cached']:
+                print(f"Reused cached alignment with matrix {record['matrix']} for file {input_filename}")
+            elif record['returncode'] == 0:
+                print(f"Completed alignment with matrix {record['matrix']} for file {input_filename} "
+                      f"in {record['wall_time']:.2f}s")
+            else:
+                failed += 1
+                print(f"Error with matrix {record['matrix']} for file {input_filename} "
+                      f"(exit status {record['returncode']}): {record['stderr']}")
 
-    excel_sheet.append([
-        input_filename, total_time, total_memory_usage, num_sequences
-    ])
+    measurement = usage.record('MAFFT', input_filename, 1 if failed else 0,
+                               f"{failed} of {len(jobs)} alignments failed" if failed else None)
+    print(format_record(measurement))
+    excel_sheet.append(record_row(measurement, num_sequences))
 
     wb.save(excel_file)
 
-def process_all_files_in_directory(input_dir, matrices_dir, output_dir, excel_sheet, processed_entries, wb, excel_file):
+def process_all_files_in_directory(input_dir, matrices_dir, output_dir, excel_sheet, wb, excel_file,
+                                   max_workers=None, cache=None):
     input_files = [f for f in Path(input_dir).glob("*") if f.is_file() and not f.suffix]
     
     for input_file in input_files:
         if input_file.name != ".DS_Store":
             print(f"\nProcessing file: {input_file.name}")
-            run_mafft_alignments(str(input_file), matrices_dir, output_dir, input_file.stem, excel_sheet, processed_entries, wb, excel_file)
+            run_mafft_alignments(str(input_file), matrices_dir, output_dir, input_file.stem, excel_sheet, wb, excel_file,
+                                 max_workers, cache=cache)
 
 if __name__ == "__main__":
     INPUT_DIR = "bali_in"
     MATRICES_DIR = "mergealign_matrices_true"
     OUTPUT_DIR = "mafft_alignments"
     EXCEL_FILE = "mafft_speed.xlsx"
+    MAX_WORKERS = int(sys.argv[1]) if len(sys.argv) > 1 else None   # concurrent MAFFT runs, default one per core
+    CACHE = cache_from_env()    # off unless MAFFT_CACHE_DIR is set; cached alignments would skew the timings
     
-    processed_entries = load_processed_entries(EXCEL_FILE)
-    
-    if os.path.exists(EXCEL_FILE):
-        wb = load_workbook(EXCEL_FILE)
-        sheet = wb.active
-    else:
-        wb = Workbook()
-        sheet = wb.active
-        sheet.title = "Alignment Metrics"
-        sheet.append(["Input File", "Total Time Taken (s)", "Total Memory Usage (MB)", "Number of Sequences"])
+    wb, sheet = open_sheet(EXCEL_FILE, "Measurements", ["Number of Sequences"])
 
     start_time = time.time()
-    process_all_files_in_directory(INPUT_DIR, MATRICES_DIR, OUTPUT_DIR, sheet, processed_entries, wb, EXCEL_FILE)
+    process_all_files_in_directory(INPUT_DIR, MATRICES_DIR, OUTPUT_DIR, sheet, wb, EXCEL_FILE, MAX_WORKERS, CACHE)
     
     print(f"\nTotal time taken for all alignments: {time.time() - start_time:.2f} seconds")
@@ -1,44 +1,70 @@
-import subprocess
+import sys
 from pathlib import Path
-import time
-import psutil
-from openpyxl import Workbook, load_workbook
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from MergeAlign import merge, write_fasta
+from measure import measure_call, make_record, open_sheet, record_row, format_record
+
+def merge_and_write(alignments_dir, output_file):
+    result = merge(alignments_dir, return_scores=False)
+    write_fasta(output_file, result.alignment)
+
+def merge_folder(alignments_dir, output_file):
+    """Merge one folder of alignments; returns a measurement record and never raises
+
+    Peak RSS is the worker's high-water mark, so this runs in a fresh process per folder.
+    """
+    _, record = measure_call('MergeAlign', Path(alignments_dir).name, merge_and_write, alignments_dir, output_file)
+    return record
+
+def merge_folder_in_fresh_process(alignments_dir, output_file):
+    """merge_folder in a single-use process, for Python before 3.11 where pools lack max_tasks_per_child"""
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(merge_folder, alignments_dir, output_file).result()
+
+def folder_executor(workers):
+    """Executor and task that run every folder in a fresh process, workers at a time"""
+    if sys.version_info >= (3, 11):
+        return ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1), merge_folder
+    return ThreadPoolExecutor(max_workers=workers), merge_folder_in_fresh_process
+
+def record_result(record, output_file, excel_sheet, wb, excel_file):
+    if record['error']:
+        print(f"Error for {record['name']}: {record['error']}")
+    else:
+        print(f"Successful for {record['name']}")
+        print(f"Output saved to: {output_file}")
+        print(format_record(record))
+    
+    excel_sheet.append(record_row(record))
+    wb.save(excel_file)
+
+def measure_folders(folders, workers=1):
+    """Yield (alignments_dir, output_file, record) as merges finish, each folder in its own worker process"""
+    executor, task = folder_executor(workers)
+    with executor:
+        futures = {executor.submit(task, alignments_dir, output_file): (alignments_dir, output_file)
+                   for alignments_dir, output_file in folders}
+        for future in as_completed(futures):
+            alignments_dir, output_file = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:  # worker process died, e.g. out of memory
+                record = make_record('MergeAlign', Path(alignments_dir).name, 0.0, 0.0, 0.0, 0.0, None,
+                                     f"worker failed: {e!r}")
+            yield alignments_dir, output_file, record
 
 def run_mergealign(alignments_dir, output_file, excel_sheet, wb, excel_file):
     if not Path(alignments_dir).exists():
         raise ValueError(f"Alignments directory not found: {alignments_dir}")
     
-    start_time = time.time()
-    process = psutil.Process(os.getpid())
-    start_memory = process.memory_info().rss / (1024 * 1024)
-    
-    cmd = f"python3 mergealign.py -a {alignments_dir} -f {output_file}"
-    try:
-        result = subprocess.run(cmd, shell=True, check=True, capture_output=True, text=True)
-        print(result.stdout)
-        print(f"Successful for {alignments_dir}")
-        print(f"Output saved to: {output_file}")
-        
-    except subprocess.CalledProcessError as e:
-        print(f"Error for {alignments_dir}: {e}")
-        if e.stdout:
-            print("stdout:", e.stdout)
-        if e.stderr:
-            print("stderr:", e.stderr)
-    
-    end_time = time.time()
-    end_memory = process.memory_info().rss / (1024 * 1024)
-    
-    total_time = end_time - start_time
-    total_memory_usage = end_memory - start_memory
-    
-    excel_sheet.append([alignments_dir.name, total_time, total_memory_usage])
-    wb.save(excel_file)
+    for _, _, record in measure_folders([(alignments_dir, output_file)]):
+        record_result(record, output_file, excel_sheet, wb, excel_file)
 
 def check_setup():
     required_files = {
-        'mergealign.py': 'MergeAlign implementation file',
         'mafft_alignments': 'Directory containing MAFFT alignments'
     }
     
@@ -54,7 +80,7 @@ def check_setup():
         return False
     return True
 
-def process_alignment_folders(alignments_dir, output_dir, excel_sheet, wb, excel_file):
+def process_alignment_folders(alignments_dir, output_dir, excel_sheet, wb, excel_file, workers=1):
     alignments_path = Path(alignments_dir)
     if not alignments_path.exists() or not alignments_path.is_dir():
         raise ValueError(f"Invalid alignments directory: {alignments_dir}")
@@ -62,27 +88,23 @@ def process_alignment_folders(alignments_dir, output_dir, excel_sheet, wb, excel
     output_path = Path(output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
     
-    for subfolder in alignments_path.iterdir():
-        if subfolder.is_dir():
-            print(f"Processing {subfolder.name}...")
-            output_file = output_path / f"merged_{subfolder.name}.fasta"
-            run_mergealign(subfolder, output_file, excel_sheet, wb, excel_file)
+    subfolders = [subfolder for subfolder in alignments_path.iterdir() if subfolder.is_dir()]
+    folders = [(subfolder, output_path / f"merged_{subfolder.name}.fasta") for subfolder in subfolders]
+    print(f"Merging {len(folders)} folders with {workers} workers")
+    
+    # Each folder is an independent merge; results are recorded in completion order
+    for _, output_file, record in measure_folders(folders, workers):
+        record_result(record, output_file, excel_sheet, wb, excel_file)
 
 def load_or_create_excel(excel_file):
-    if Path(excel_file).exists():
-        wb = load_workbook(excel_file)
-        sheet = wb.active
-    else:
-        wb = Workbook()
-        sheet = wb.active
-        sheet.title = "MergeAlign Metrics"
-        sheet.append(["Input File", "Total Time Taken (s)", "Total Memory Usage (MB)"])
+    wb, sheet = open_sheet(excel_file, "Measurements")
     return sheet, wb
 
 if __name__ == "__main__":
     ALIGNMENTS_DIR = "mafft_alignments"
     OUTPUT_DIR = "merge_alignments"
     EXCEL_FILE = "merge_speed.xlsx"
+    WORKERS = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()   # 1 runs folders one at a time
     
     print("Checking setup...")
     if not check_setup():
@@ -93,7 +115,7 @@ if __name__ == "__main__":
     
     print(f"Running MergeAlign for each subfolder and saving outputs to '{OUTPUT_DIR}'...")
     try:
-        process_alignment_folders(ALIGNMENTS_DIR, OUTPUT_DIR, excel_sheet, wb, EXCEL_FILE)
+        process_alignment_folders(ALIGNMENTS_DIR, OUTPUT_DIR, excel_sheet, wb, EXCEL_FILE, WORKERS)
     except Exception as e:
         print(f"Error during processing: {e}")
     
@@ -1,8 +1,6 @@
 import os
-import subprocess
-import time
-import psutil
 from openpyxl import Workbook
+from measure import RECORD_HEADER, run_command, record_row, format_record
 
 muscle_executable = '/Users/gavinzhou/opt/anaconda3/bin/muscle' # NOTE: Change this to path to MUSCLE executable before running
 input_folder = 'bali_in' # can modify before running
@@ -13,12 +11,8 @@ os.makedirs(output_folder, exist_ok=True)
 
 wb = Workbook()
 ws = wb.active
-ws.append(['File Name', 'Runtime (s)', 'Memory Usage (MB)', 'Peak Memory Usage (MB)'])
-
-def get_memory_usage():
-    process = psutil.Process(os.getpid())
-    mem_info = process.memory_info()
-    return mem_info.rss / 1024 / 1024
+ws.title = 'Measurements'
+ws.append(RECORD_HEADER)
 
 for file_name in os.listdir(input_folder):
     file_path = os.path.join(input_folder, file_name)
@@ -27,17 +21,12 @@ for file_name in os.listdir(input_folder):
     #if os.path.isfile(file_path) and file_name.endswith('.tfa'):
         output_file = os.path.join(output_folder, f"{file_name}.aligned.fasta")
         
-        start_time = time.time()
-        start_memory = get_memory_usage()
-
-        try:
-            subprocess.run([muscle_executable, '-align', file_path, '-output', output_file], check=True)
-            runtime = time.time() - start_time
-            peak_memory = get_memory_usage() - start_memory
-            print(f"Success, {file_name} completed in {runtime:.2f}s, peak memory usage of {peak_memory:.2f}MB.")
-            ws.append([file_name, f"{runtime:.2f}", f"{start_memory:.2f}", f"{peak_memory:.2f}"])
-        
-        except subprocess.CalledProcessError as e:
-            print(f"Error, {file_name}: {e}")
+        # wall time, CPU time and peak RSS of the MUSCLE process itself, from wait4
+        record = run_command([muscle_executable, '-align', file_path, '-output', output_file], 'MUSCLE', file_name)
+        if record['error']:
+            print(f"Error, {file_name}: {record['error']}")
+        else:
+            print(f"Success, {format_record(record)}")
+        ws.append(record_row(record))
         
 wb.save(excel_file)
@@ -0,0 +1,132 @@
+"""
+Memory per graph node for the MergeAlign node layouts
+
+Three builds of the same graph are traced with tracemalloc:
+
+    dict    Node objects with a per-instance __dict__, one coordinate tuple per alignment
+            and a boxed int per index, as create_nodes built them before __slots__
+    slots   the current create_nodes: __slots__ Node objects fed by coordinates_to_tuples,
+            which interns columns so every alignment shares one tuple per coordinate
+    array   create_graph: interned coordinates and CSR predecessor arrays
+
+Each build starts from the int32 coordinate array and converts it to tuples inside the
+traced region, as merge_alignments does, so `peak` covers the whole graph stage and
+`retained` is what the finished graph keeps once the per-alignment tuples are dropped.
+
+    python bench_node_memory.py --size 100x1500 --alignments 20 --rate 0.3
+    python bench_node_memory.py --folder ../mafft_alignments
+"""
+
+import os
+import sys
+import argparse
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from MergeAlign import (Node, parse_fasta, alignment_to_matrix, matrices_to_coordinates, coordinates_to_tuples,
+                        create_nodes, create_graph)
+from ensemble_generator import random_seed, generate_ensemble, parse_size
+
+LAYOUTS = ['dict', 'slots', 'array']
+
+class DictNode:
+    """ Node as it was before __slots__, kept for comparison """
+
+    def __init__(self):
+        self.previous_nodes = {}
+        self.path_score = 0
+        self.path_length = 0
+        self.path_average = 0
+        self.best_previous_node = None
+
+def create_nodes_dict(coordinates):
+    """create_nodes as it was before __slots__ and coordinate sharing, kept for comparison"""
+    dimensions = len(coordinates[0][0])
+    start_node = tuple([0] * dimensions)
+    nodes = {start_node: DictNode()}
+
+    for alignment in coordinates:
+        prev_node = start_node
+        for point in alignment:
+            if point not in nodes:
+                nodes[point] = DictNode()
+
+            prev_nodes = nodes[point].previous_nodes
+            prev_nodes[prev_node] = prev_nodes.get(prev_node, 0) + 1
+
+            prev_node = point
+
+    return nodes
+
+def build(layout, coordinates, lengths):
+    """Graph in the given layout; tuples are made here so they count towards the peak"""
+    if layout == 'array':
+        graph = create_graph(coordinates, lengths)
+        return graph, graph.num_nodes, graph.num_edges
+
+    if layout == 'dict':
+        tuples = [list(map(tuple, alignment[:length].tolist())) for alignment, length in zip(coordinates, lengths)]
+        nodes = create_nodes_dict(tuples)
+    else:
+        tuples = coordinates_to_tuples(coordinates, lengths)
+        nodes = create_nodes(tuples)
+    del tuples
+    return nodes, len(nodes), sum(len(node.previous_nodes) for node in nodes.values())
+
+def measure(layout, coordinates, lengths):
+    """(nodes, edges, retained bytes, peak bytes) of one traced build"""
+    tracemalloc.start()
+    graph, num_nodes, num_edges = build(layout, coordinates, lengths)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del graph
+    return num_nodes, num_edges, retained, peak
+
+def instance_bytes(node_class, count=10000):
+    """Traced bytes per instance, with its attributes set as create_nodes and score_nodes set them"""
+    tracemalloc.start()
+    nodes = [node_class() for _ in range(count)]
+    for node in nodes:
+        node.path_average = 0.5     # attribute writes are what make an instance __dict__ grow
+    size = tracemalloc.get_traced_memory()[0] / count
+    tracemalloc.stop()
+    return size
+
+def folder_coordinates(folder):
+    alignments = [parse_fasta(os.path.join(folder, f)) for f in sorted(os.listdir(folder))]
+    sequence_names = [name for name, _ in alignments[0]]
+    return matrices_to_coordinates([alignment_to_matrix(a, sequence_names) for a in alignments])
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-node memory of the MergeAlign graph layouts")
+    parser.add_argument('--folder', help="ensemble folder to merge instead of a synthetic one")
+    parser.add_argument('--size', type=parse_size, default=(100, 1500), help="SEQUENCESxCOLUMNS")
+    parser.add_argument('--alignments', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=0.3, help="fraction of columns perturbed in the synthetic ensemble")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--layout', choices=LAYOUTS, action='append', help="layouts to measure (default: all)")
+    args = parser.parse_args()
+
+    if args.folder:
+        coordinates, lengths = folder_coordinates(args.folder)
+        label = args.folder
+    else:
+        rng = np.random.default_rng(args.seed)
+        _, seed_matrix = random_seed(*args.size, rng)
+        coordinates, lengths = matrices_to_coordinates(generate_ensemble(seed_matrix, args.alignments, args.rate, rng))
+        label = f"{args.size[0]}x{args.size[1]}x{args.alignments} rate {args.rate}"
+
+    print(f"{label}: {coordinates.shape[2]} sequences, {len(coordinates)} alignments")
+    print(f"Node object: {instance_bytes(DictNode):.0f} bytes with __dict__, "
+          f"{instance_bytes(Node):.0f} bytes with __slots__ (excluding previous_nodes contents)")
+    print(f"{'layout':8s}{'nodes':>10s}{'edges':>10s}{'retained MB':>14s}{'peak MB':>10s}{'bytes/node':>12s}")
+    for layout in args.layout or LAYOUTS:
+        num_nodes, num_edges, retained, peak = measure(layout, coordinates, lengths)
+        print(f"{layout:8s}{num_nodes:10d}{num_edges:10d}{retained / 2**20:14.1f}{peak / 2**20:10.1f}"
+              f"{retained / num_nodes:12.0f}")
+
+if __name__ == "__main__":
+    main()
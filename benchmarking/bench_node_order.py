@@ -0,0 +1,106 @@
+"""
+Sorted versus topological node order for score_nodes on wide inputs
+
+score_nodes visits nodes in sorted(nodes) order, comparing N-length coordinate tuples.
+The sort-free alternative buckets nodes by coordinate sum, which strictly increases
+along every edge, so it is a valid processing order built in linear time. Both orders
+are timed on the same Node graph for every case. score_nodes sorts by default, since
+this benchmark has not found inputs where bucketing is faster; order='topological'
+selects the bucketed order.
+
+Cases are ensemble folders (bench_mafft.py output, e.g. for ../bench1.0/prefab4/in),
+bench1.0 reference alignments turned into perturbed ensembles, and wide synthetic ensembles.
+
+    python bench_node_order.py
+    python bench_node_order.py --case ../bench1.0/ox/ref/12t119 --synthetic 400x300x10
+"""
+
+import os
+import sys
+import csv
+import time
+import argparse
+import tempfile
+import logging
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from MergeAlign import (read_alignments, alignment_to_matrix, matrices_to_coordinates, coordinates_to_tuples, create_nodes,
+                        topological_order)
+from bench_stages import prepare_cases, parse_size
+
+REPEATS = 3
+SYNTHETIC_CASES = [(100, 500, 10), (400, 300, 10)]     # sequences, columns, alignments
+FIXED_CASES = [ROOT / 'mafft_alignments'] + [ROOT / 'bench1.0' / name / 'ref' / case
+                                              for name, case in (('bali3', 'BB30003'), ('ox', '12t119'))]
+
+def is_topological(nodes, order):
+    """True when every node comes after all of its previous nodes"""
+    position = {coord: i for i, coord in enumerate(order)}
+    return all(position[prev] < position[coord] for coord in order for prev in nodes[coord].previous_nodes)
+
+def load_nodes(folder):
+    """Node graph of every alignment in a folder, as the nodes engine builds it"""
+    alignments = read_alignments(sorted(os.path.join(folder, f) for f in os.listdir(folder)))
+    sequence_names = [name for name, _ in alignments[0]]
+    coordinates, lengths = matrices_to_coordinates([alignment_to_matrix(a, sequence_names) for a in alignments])
+    return create_nodes(coordinates_to_tuples(coordinates, lengths)), len(alignments), len(sequence_names)
+
+def best_time(func, *args):
+    """Best wall time of REPEATS calls"""
+    times = []
+    for _ in range(REPEATS):
+        start_time = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+def benchmark_case(name, folder):
+    nodes, num_alignments, num_sequences = load_nodes(folder)
+    if not is_topological(nodes, topological_order(nodes)):
+        print(f"Warning: bucketed order of {name} is not topological")
+    sort_time = best_time(sorted, nodes)
+    topo_time = best_time(topological_order, nodes)
+    return [name, num_alignments, num_sequences, len(nodes), sort_time, topo_time]
+
+def find_ensembles(roots):
+    """Ensemble folders: a folder of alignment files, or a folder of such folders (bench_mafft.py output)"""
+    ensembles = {}
+    for root in map(Path, roots):
+        if not root.is_dir():
+            print(f"Skipping missing folder: {root}")
+            continue
+        subfolders = sorted(p for p in root.iterdir() if p.is_dir())
+        ensembles.update((str(p), str(p)) for p in subfolders or [root])
+    return ensembles
+
+def main():
+    parser = argparse.ArgumentParser(description="Sorted versus topological node order")
+    parser.add_argument('--ensembles', action='append', help="ensemble folder, or folder of ensemble folders (repeatable)")
+    parser.add_argument('--case', action='append', help="reference alignment to perturb into an ensemble (repeatable)")
+    parser.add_argument('--synthetic', type=parse_size, action='append',
+                        help="synthetic case as SEQUENCESxCOLUMNSxALIGNMENTS (repeatable)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='node_order_benchmark.csv')
+    args = parser.parse_args()
+
+    logging.getLogger('mergealign').setLevel(logging.WARNING)
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        cases = find_ensembles(args.ensembles or [])
+        cases.update(prepare_cases(folder, args.synthetic or SYNTHETIC_CASES, args.case or FIXED_CASES, args.seed))
+        for name, case_folder in cases.items():
+            row = benchmark_case(name, case_folder)
+            rows.append(row)
+            print(f"{name}: {row[1]} alignments of {row[2]} sequences, {row[3]} nodes: "
+                  f"sort {row[4]:.3f}s, topological {row[5]:.3f}s ({row[4] / max(row[5], 1e-9):.2f}x)")
+
+    with open(args.output, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["Case", "Alignments", "Sequences", "Nodes", "Sort (s)", "Topological (s)"])
+        writer.writerows(rows)
+    print(f"Results saved to: {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Scaling curves for MergeAlign graph construction and scoring on synthetic ensembles
+
+Ensembles come from ensemble_generator in memory, so sizes far beyond BAliBASE need
+no MAFFT runs or files. Every combination of the listed sizes is timed and written
+as one CSV row per (size, engine), ready to plot.
+
+    python bench_scaling.py --sequences 100,250,500,1000 --columns 1000 --alignments 50
+    python bench_scaling.py --sequences 200 --alignments 10,50,100,250,500 --engine array
+    python bench_scaling.py --sequences 2000 --columns 2000 --engine array --workers 1,2,4,8
+
+used_workers is how many processes scoring actually ran in: fewer than asked on a
+machine with fewer CPUs or for a graph too small to split, and 1 when it ran serially.
+"""
+
+import sys
+import csv
+import time
+import argparse
+import itertools
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from MergeAlign import (GRAPH_ENGINES, MatrixCoordinates, matrices_to_coordinates, coordinates_to_tuples, create_nodes,
+                        score_nodes, create_graph, score_graph, create_banded_graph, score_banded)
+from segment_scoring import parallel_workers
+from ensemble_generator import random_seed, generate_ensemble
+
+FIELDS = ['engine', 'workers', 'used_workers', 'sequences', 'columns', 'alignments', 'rate', 'nodes', 'edges',
+          'index_time', 'graph_time', 'score_time', 'total_time']
+
+def time_merge(matrices, engine, workers=1):
+    """One timed run of index conversion, graph construction and scoring"""
+    start_time = time.perf_counter()
+    if engine == 'nodes':
+        coordinates, lengths = matrices_to_coordinates(matrices)
+        tuples = coordinates_to_tuples(coordinates, lengths)
+    else:
+        coordinates = MatrixCoordinates(matrices)     # converted while the graph is built, as in merge_alignments
+        lengths = coordinates.lengths
+    index_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    if engine == 'array':
+        graph = create_graph(coordinates, lengths)
+        num_nodes, num_edges = graph.num_nodes, graph.num_edges
+    elif engine == 'banded':
+        graph = create_banded_graph(coordinates, lengths)
+        num_nodes, num_edges = graph.graph.num_nodes, graph.graph.num_edges
+    else:
+        graph = create_nodes(tuples)
+        num_nodes, num_edges = len(graph), sum(len(node.previous_nodes) for node in graph.values())
+    graph_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    if engine == 'array':
+        score_graph(graph, len(coordinates), workers)
+    elif engine == 'banded':
+        score_banded(graph, len(coordinates), workers)
+    else:
+        score_nodes(graph, len(coordinates))
+    score_time = time.perf_counter() - start_time
+    return num_nodes, num_edges, index_time, graph_time, score_time
+
+def parse_list(kind):
+    return lambda text: [kind(value) for value in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description="MergeAlign scaling on synthetic ensembles")
+    parser.add_argument('--sequences', type=parse_list(int), default=[50, 100, 250, 500, 1000])
+    parser.add_argument('--columns', type=parse_list(int), default=[500])
+    parser.add_argument('--alignments', type=parse_list(int), default=[20])
+    parser.add_argument('--rate', type=parse_list(float), default=[0.01],
+                        help="fractions of columns perturbed in each alignment")
+    parser.add_argument('--engine', choices=GRAPH_ENGINES, action='append', help="default: nodes and array")
+    parser.add_argument('--workers', type=parse_list(int), default=[1],
+                        help="scoring processes for the array and banded engines")
+    parser.add_argument('--repeats', type=int, default=3, help="the median of this many runs is reported")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='scaling.csv')
+    args = parser.parse_args()
+
+    engines = args.engine or ['nodes', 'array']
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        for num_sequences, num_columns, num_alignments, rate in itertools.product(
+                args.sequences, args.columns, args.alignments, args.rate):
+            rng = np.random.default_rng(args.seed)
+            _, seed_matrix = random_seed(num_sequences, num_columns, rng)
+            matrices = generate_ensemble(seed_matrix, num_alignments, rate, rng)
+            for engine, workers in itertools.product(engines, args.workers):
+                if workers > 1 and engine == 'nodes':
+                    continue
+                runs = [time_merge(matrices, engine, workers) for _ in range(args.repeats)]
+                num_nodes, num_edges = runs[0][:2]
+                used_workers = parallel_workers(num_edges, workers) if engine != 'nodes' else 1
+                index_time, graph_time, score_time = np.median([run[2:] for run in runs], axis=0)
+                row = {'engine': engine, 'workers': workers, 'used_workers': used_workers, 'sequences': num_sequences, 'columns': num_columns,
+                       'alignments': num_alignments, 'rate': rate, 'nodes': num_nodes, 'edges': num_edges,
+                       'index_time': f"{index_time:.4f}", 'graph_time': f"{graph_time:.4f}",
+                       'score_time': f"{score_time:.4f}", 'total_time': f"{index_time + graph_time + score_time:.4f}"}
+                writer.writerow(row)
+                f.flush()
+                print(f"{engine:6s} x{workers} (ran on {used_workers}) {num_sequences}x{num_columns}x{num_alignments} rate {rate}: "
+                      f"{num_nodes} nodes, {num_edges} edges, graph {graph_time:.3f}s, score {score_time:.3f}s")
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
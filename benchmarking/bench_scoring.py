@@ -0,0 +1,74 @@
+import sys
+import os
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from alignment_scoring import parse_fasta, count_aligned_pairs, ReferenceIndex, DEFAULT_INDEX_DIR
+
+def count_aligned_pairs_pairwise(test_seqs, ref_seqs):
+    """The original string-set scorer, timed against count_aligned_pairs"""
+    test_pairs = set()
+    ref_pairs = set()
+
+    common_ids = set(test_seqs.keys()) & set(ref_seqs.keys())
+
+    for id1 in common_ids:
+        for id2 in common_ids:
+            if id1 >= id2:
+                continue
+
+            for seqs, pairs in ((test_seqs, test_pairs), (ref_seqs, ref_pairs)):
+                seq1, seq2 = seqs[id1], seqs[id2]
+                pos1, pos2 = 0, 0
+                for i in range(len(seq1)):
+                    if seq1[i] != '-' and seq2[i] != '-':
+                        pairs.add((f"{id1}_{pos1}", f"{id2}_{pos2}"))
+                    if seq1[i] != '-':
+                        pos1 += 1
+                    if seq2[i] != '-':
+                        pos2 += 1
+
+    tp = len(test_pairs & ref_pairs)
+    return tp, len(test_pairs - ref_pairs), len(ref_pairs - test_pairs)
+
+def compare_scorers(test_dir, ref_dir, limit=None, index_dir=None):
+    """Score every merged_<case>.fasta against <case> with both scorers; returns mismatches and times
+
+    With index_dir the vectorized scorer reads each reference through its ReferenceIndex sidecar,
+    and its time includes loading (or on the first run building) the sidecar.
+    """
+    cases = sorted(f for f in os.listdir(ref_dir) if os.path.exists(os.path.join(test_dir, f"merged_{f}.fasta")))
+    mismatches = []
+    pairwise_time = vectorized_time = 0.0
+    for case in cases[:limit]:
+        test_seqs = parse_fasta(os.path.join(test_dir, f"merged_{case}.fasta"))
+        ref_seqs = parse_fasta(os.path.join(ref_dir, case))
+
+        start_time = time.perf_counter()
+        expected = count_aligned_pairs_pairwise(test_seqs, ref_seqs)
+        pairwise_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        if index_dir is None:
+            counts = count_aligned_pairs(test_seqs, ref_seqs)
+        else:
+            counts = count_aligned_pairs(test_seqs, ReferenceIndex.cached(os.path.join(ref_dir, case), index_dir))
+        vectorized_time += time.perf_counter() - start_time
+
+        if counts != expected:
+            mismatches.append((case, expected, counts))
+    return len(cases[:limit]), mismatches, pairwise_time, vectorized_time
+
+if __name__ == "__main__":
+    TEST_DIR = "merge_alignments"
+    REF_DIR = "bali_ref"
+    LIMIT = int(sys.argv[1]) if len(sys.argv) > 1 else None   # the pairwise scorer is slow on large cases
+
+    num_cases, mismatches, pairwise_time, vectorized_time = compare_scorers(TEST_DIR, REF_DIR, LIMIT, DEFAULT_INDEX_DIR)
+    for case, expected, counts in mismatches:
+        print(f"Mismatch for {case}: pairwise TP/FP/FN {expected}, vectorized {counts}")
+    print(f"{num_cases} cases, {len(mismatches)} mismatches")
+    print(f"Pairwise scorer:   {pairwise_time:.2f}s")
+    print(f"Vectorized scorer: {vectorized_time:.2f}s ({pairwise_time / max(vectorized_time, 1e-9):.0f}x)")
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,175 @@
+"""
+Per-stage MergeAlign benchmark with repeats, dispersion and baseline comparison
+
+Each case is merged `repeats` times after `warmup` untimed runs, timing every stage
+separately: parse, index conversion, graph construction (create_nodes / create_graph /
+create_banded_graph), scoring and reconstruction. Cases are synthetic ensembles
+of a chosen size (sequences x columns x alignments) and fixed ensembles: the MAFFT
+ensemble in ../mafft_alignments and perturbed bench1.0 references.
+
+    python bench_stages.py --output stages.json
+    python bench_stages.py --baseline stages.json     # exits 1 if any stage regressed
+"""
+
+import os
+import sys
+import json
+import argparse
+import platform
+import tempfile
+import logging
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from MergeAlign import GRAPH_ENGINES, combine_alignments
+from stage_profiler import StageProfiler
+from ensemble_generator import read_seed, random_seed, generate_ensemble, write_ensemble
+
+STAGES = ['parse', 'index', 'graph', 'score', 'reconstruct']
+SYNTHETIC_CASES = [(20, 200, 10), (50, 500, 20), (100, 1000, 40)]     # sequences, columns, alignments
+FIXED_CASES = [ROOT / 'mafft_alignments'] + [ROOT / 'bench1.0' / 'bali3' / 'ref' / name
+                                              for name in ('BB11020', 'BB12001', 'BB20001')]
+FIXED_ALIGNMENTS = 20
+FIXED_RATE = 0.1
+MIN_DELTA = 0.002     # seconds; smaller median changes are never flagged
+
+def prepare_cases(folder, synthetic_cases, fixed_cases, seed):
+    """Write every case as a folder of alignment files under folder; returns {case name: folder}"""
+    cases = {}
+    rng = np.random.default_rng(seed)
+    for num_sequences, num_columns, num_alignments in synthetic_cases:
+        name = f"synthetic_{num_sequences}x{num_columns}x{num_alignments}"
+        names, seed_matrix = random_seed(num_sequences, num_columns, rng)
+        cases[name] = os.path.join(folder, name)
+        write_ensemble(cases[name], names, generate_ensemble(seed_matrix, num_alignments, FIXED_RATE, rng))
+
+    for path in map(Path, fixed_cases):
+        if path.is_dir():
+            cases[path.name] = str(path)
+        elif path.is_file():
+            # A single reference alignment becomes a fixed-seed perturbed ensemble
+            name = f"{path.name}_x{FIXED_ALIGNMENTS}"
+            names, seed_matrix = read_seed(path)
+            cases[name] = os.path.join(folder, name)
+            write_ensemble(cases[name], names, generate_ensemble(seed_matrix, FIXED_ALIGNMENTS, FIXED_RATE, seed))
+        else:
+            print(f"Skipping missing case: {path}")
+    return cases
+
+def run_stages(alignment_files, engine):
+    """One merge with every stage timed; returns {stage: seconds}
+
+    The merge goes through combine_alignments with a StageProfiler, so each stage is
+    timed exactly as the CLI runs it, garbage collection pauses included.
+    """
+    profiler = StageProfiler('stages')
+    with profiler:
+        combine_alignments(alignment_files, engine, profiler=profiler)
+    return {entry['stage']: entry['time'] for entry in profiler.stages}
+
+def summarize(samples):
+    q1, median, q3 = np.percentile(samples, [25, 50, 75])
+    return {'median': median, 'q1': q1, 'q3': q3, 'iqr': q3 - q1, 'min': min(samples), 'repeats': len(samples)}
+
+def benchmark_case(folder, engine, warmup, repeats):
+    """{stage: summary} over repeats timed runs of one case"""
+    alignment_files = sorted(os.path.join(folder, f) for f in os.listdir(folder))
+    for _ in range(warmup):
+        run_stages(alignment_files, engine)
+    samples = {stage: [] for stage in STAGES + ['total']}
+    for _ in range(repeats):
+        times = run_stages(alignment_files, engine)
+        times['total'] = sum(times.values())
+        for stage, seconds in times.items():
+            samples[stage].append(seconds)
+    return {stage: summarize(values) for stage, values in samples.items()}
+
+def compare(results, baseline, tolerance, min_delta=MIN_DELTA):
+    """(case/engine, stage, ratio, verdict) for every stage in both runs
+
+    A stage counts as changed only when its median moved by more than tolerance and by
+    at least min_delta seconds, and the interquartile ranges of the two runs do not
+    overlap, so noisy or sub-millisecond stages are not flagged.
+    """
+    rows = []
+    for key, stages in results['cases'].items():
+        base_stages = baseline.get('cases', {}).get(key)
+        if base_stages is None:
+            continue
+        for stage, new in stages.items():
+            old = base_stages.get(stage)
+            if old is None:
+                continue
+            ratio = new['median'] / old['median'] if old['median'] > 0 else float('inf')
+            verdict = 'ok'
+            if abs(new['median'] - old['median']) < min_delta:
+                pass
+            elif ratio > 1 + tolerance and new['q1'] > old['q3']:
+                verdict = 'REGRESSION'
+            elif ratio < 1 - tolerance and new['q3'] < old['q1']:
+                verdict = 'faster'
+            rows.append((key, stage, ratio, verdict))
+    return rows
+
+def parse_size(text):
+    num_sequences, num_columns, num_alignments = map(int, text.lower().split('x'))
+    return num_sequences, num_columns, num_alignments
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage MergeAlign benchmark")
+    parser.add_argument('--engine', choices=GRAPH_ENGINES, action='append',
+                        help="graph engine(s) to time (default: nodes and array)")
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=7)
+    parser.add_argument('--synthetic', type=parse_size, action='append',
+                        help="synthetic case as SEQUENCESxCOLUMNSxALIGNMENTS (repeatable)")
+    parser.add_argument('--case', action='append', help="ensemble folder or single reference alignment (repeatable)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--baseline', help="compare against a results JSON written by an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.10, help="relative median change to flag")
+    args = parser.parse_args()
+
+    logging.getLogger('mergealign').setLevel(logging.WARNING)
+    engines = args.engine or ['nodes', 'array']
+    results = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.platform(),
+        'warmup': args.warmup,
+        'repeats': args.repeats,
+        'seed': args.seed,
+        'cases': {},
+    }
+
+    with tempfile.TemporaryDirectory() as folder:
+        cases = prepare_cases(folder, args.synthetic or SYNTHETIC_CASES, args.case or FIXED_CASES, args.seed)
+        for name, case_folder in cases.items():
+            for engine in engines:
+                summary = benchmark_case(case_folder, engine, args.warmup, args.repeats)
+                results['cases'][f"{name}/{engine}"] = summary
+                print(f"{name} [{engine}]  " + "  ".join(
+                    f"{stage} {summary[stage]['median'] * 1000:.1f}ms" for stage in STAGES)
+                    + f"  total {summary['total']['median'] * 1000:.1f}ms (IQR {summary['total']['iqr'] * 1000:.1f}ms)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline, args.tolerance)
+        print(f"\nComparison with {args.baseline} (tolerance {args.tolerance:.0%}):")
+        for key, stage, ratio, verdict in rows:
+            if verdict != 'ok' or stage == 'total':
+                print(f"{key:40s} {stage:12s} {ratio:6.2f}x  {verdict}")
+        if any(verdict == 'REGRESSION' for *_, verdict in rows):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
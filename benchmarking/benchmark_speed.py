@@ -1,49 +1,23 @@
 import sys
-import time
-import psutil
-import subprocess
 import csv
 from pathlib import Path
+from measure import run_command, format_record, append_csv
 
-def run_script_and_benchmark(script_path, args, tool_name):
-    """Run a script and benchmark its performance as given by: Runtime, peak memory usage."""
+def run_script_and_benchmark(script_path, args, tool_name, name=None):
+    """Run a script and measure it: wall time, CPU time and peak memory of the script and the tools it starts."""
     if not Path(script_path).exists():
         raise ValueError(f"Script not found: {script_path}")
     
     cmd = ["python3", script_path] + args
     
-    start_time = time.time()
-    
-    # Track memory usage over time
-    peak_memory = 0
-    mem_usage_before = psutil.Process().memory_info().rss  # Initial memory usage
-    
-    try:
-        result = subprocess.run(
-            cmd, 
-            check=True, 
-            text=True
-        )
-        print(f"{tool_name} completed successfully:\n{result.stdout}")
-        if result.stderr:
-            print(f"Error: {result.stderr}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error running {tool_name}: {e.stderr}")
-    
-    end_time = time.time()
-    
-    runtime = end_time - start_time  # Total runtime in seconds
-    
-    # Monitor memory usage during execution
-    mem_after = psutil.Process().memory_info().rss
-    peak_memory = max(peak_memory, mem_after)  # Peak memory (RSS)
-    
-    # Convert memory to MB
-    mem_usage_before_MB = mem_usage_before / (1024 * 1024)  
-    mem_after_MB = mem_after / (1024 * 1024)
-    peak_memory_MB = peak_memory / (1024 * 1024)  # Peak memory in MB? I'll come back to this
+    # The scripts may run several tool processes at once, so the process tree is sampled too
+    record = run_command(cmd, tool_name, name or script_path, sample_tree=True)
+    if record['error']:
+        print(f"Error running {tool_name}: {record['error']}")
+    else:
+        print(f"{tool_name} completed successfully")
     
-    return runtime, mem_usage_before_MB, mem_after_MB, peak_memory_MB
+    return record
 
 def write_to_csv(csv_file, runtime_mafft, runtime_mergealign, runtime_bioalign, runtime_mcoffee, tool_args):
     """Write the results of the benchmark to a CSV file."""
@@ -69,6 +43,7 @@ def benchmark_tools(file, run_rv, arg=None):
     mcoffee_args = [str(file), "m_coffee_out"]
     # Output CSV file to store results
     csv_output_file = "speed_benchmark_results.csv"
+    measurements_file = "speed_benchmark_measurements.csv"   # full record per tool run, see measure.py
     if run_rv:
         rvfile = (str(file))[9:]
     else:
@@ -77,26 +52,27 @@ def benchmark_tools(file, run_rv, arg=None):
 
     # Benchmark MAFFT
     print("Running MAFFT...")
-    mafft_runtime, mafft_mem_before, mafft_mem_after, mafft_peak_memory = run_script_and_benchmark(mafft_script, mafft_args, "MAFFT")
-    print(f"MAFFT: Runtime = {mafft_runtime:.2f}s, Memory Before = {mafft_mem_before:.2f}MB, Memory After = {mafft_mem_after:.2f}MB, Peak Memory = {mafft_peak_memory:.2f}MB")
+    mafft = run_script_and_benchmark(mafft_script, mafft_args, "MAFFT", rvfile)
+    print(format_record(mafft))
     
     # Benchmark MergeAlign
     print("Running MergeAlign...")
-    mergealign_runtime, mergealign_mem_before, mergealign_mem_after, mergealign_peak_memory = run_script_and_benchmark(mergealign_script, mergealign_args, "MergeAlign")
-    print(f"MergeAlign: Runtime = {mergealign_runtime:.2f}s, Memory Before = {mergealign_mem_before:.2f}MB, Memory After = {mergealign_mem_after:.2f}MB, Peak Memory = {mergealign_peak_memory:.2f}MB")
+    mergealign = run_script_and_benchmark(mergealign_script, mergealign_args, "MergeAlign", rvfile)
+    print(format_record(mergealign))
 
     # Benchmark BIOAlign
     print("Running BioAlign...")
-    bioalign_runtime, bioalign_mem_before, bioalign_mem_after, bioalign_peak_memory = run_script_and_benchmark(bioalign_script, bioalign_args, "BioAlign")
-    print(f"BioAlign: Runtime = {mergealign_runtime:.2f}s, Memory Before = {bioalign_mem_before:.2f}MB, Memory After = {bioalign_mem_after:.2f}MB, Peak Memory = {bioalign_peak_memory:.2f}MB")
+    bioalign = run_script_and_benchmark(bioalign_script, bioalign_args, "BioAlign", rvfile)
+    print(format_record(bioalign))
     print(file)
 
     # Benchmark M-coffee
     print("Running M-Coffee...")
-    m_coffee_runtime, mem_before, mem_after, peak_memory = run_script_and_benchmark(mcoffee_script, mcoffee_args, "M-COFFEE")
-    print(f"MCOFFEE: Runtime = {m_coffee_runtime:.2f}s, Memory Before = {mem_before:.2f}MB, Memory After = {mem_after:.2f}MB, Peak Memory = {peak_memory:.2f}MB")
+    m_coffee = run_script_and_benchmark(mcoffee_script, mcoffee_args, "M-COFFEE", rvfile)
+    print(format_record(m_coffee))
 
-    write_to_csv(csv_output_file, mafft_runtime, mergealign_runtime, bioalign_runtime, m_coffee_runtime, rvfile)
+    write_to_csv(csv_output_file, mafft['wall_time'], mergealign['wall_time'], bioalign['wall_time'], m_coffee['wall_time'], rvfile)
+    append_csv(measurements_file, [mafft, mergealign, bioalign, m_coffee])
     
     print("Speed benchmarking complete!")
 
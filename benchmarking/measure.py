@@ -0,0 +1,188 @@
+"""
+Shared resource measurement for the speed benchmarks
+
+Every measurement is a record with RECORD_FIELDS: wall time, user and system CPU time
+and peak resident memory of the measured tool, not of the benchmark harness. Single
+commands are measured through wait4; blocks that run several tool processes at once
+sample the summed RSS of the process tree from a background thread.
+"""
+
+import os
+import sys
+import csv
+import time
+import resource
+import threading
+import subprocess
+import psutil
+
+RECORD_FIELDS = ['tool', 'name', 'wall_time', 'user_time', 'sys_time', 'peak_rss_mb', 'returncode', 'error']
+RECORD_HEADER = ['Tool', 'Input File', 'Wall Time (s)', 'User CPU (s)', 'System CPU (s)', 'Peak RSS (MB)',
+                 'Exit Status', 'Error']
+SAMPLE_INTERVAL = 0.05
+
+def maxrss_mb(ru_maxrss):
+    """ru_maxrss in MB; Linux reports kilobytes, macOS bytes"""
+    return ru_maxrss / (1024 * 1024) if sys.platform == 'darwin' else ru_maxrss / 1024
+
+def make_record(tool, name, wall_time, user_time, sys_time, peak_rss_mb, returncode=0, error=None):
+    return {
+        'tool': tool,
+        'name': str(name),
+        'wall_time': wall_time,
+        'user_time': user_time,
+        'sys_time': sys_time,
+        'peak_rss_mb': peak_rss_mb,
+        'returncode': returncode,
+        'error': error,
+    }
+
+def format_record(record):
+    return (f"{record['tool']} {record['name']}: wall {record['wall_time']:.2f}s, "
+            f"CPU {record['user_time']:.2f}s user + {record['sys_time']:.2f}s sys, "
+            f"peak RSS {record['peak_rss_mb']:.1f}MB")
+
+class TreeSampler:
+    """ Peak of the summed RSS of a process and its descendants, polled from a background thread """
+
+    def __init__(self, pid, interval=SAMPLE_INTERVAL, include_root=True):
+        self.pid = pid
+        self.interval = interval
+        self.include_root = include_root
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        try:
+            root = psutil.Process(self.pid)
+            processes = root.children(recursive=True) + ([root] if self.include_root else [])
+        except psutil.Error:
+            return 0
+        total = 0
+        for process in processes:
+            try:
+                total += process.memory_info().rss
+            except psutil.Error:    # exited between listing and sampling
+                pass
+        return total
+
+    def _run(self):
+        while True:
+            self.peak_bytes = max(self.peak_bytes, self._sample())
+            if self._stop.wait(self.interval):
+                break
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop sampling; returns the peak in MB"""
+        self._stop.set()
+        self._thread.join()
+        return self.peak_bytes / (1024 * 1024)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def run_command(cmd, tool, name, sample_tree=False, interval=SAMPLE_INTERVAL, **popen_kwargs):
+    """Run cmd to completion and measure it
+
+    CPU times and ru_maxrss come from wait4 and cover the command and any descendants
+    it waited for. ru_maxrss is the largest single process, so with sample_tree the
+    summed RSS of the whole tree is also sampled and the larger peak is kept; use it for
+    scripts that run several tool processes at once.
+    """
+    start_time = time.perf_counter()
+    try:
+        process = subprocess.Popen(cmd, **popen_kwargs)
+    except OSError as e:
+        return make_record(tool, name, 0.0, 0.0, 0.0, 0.0, None, str(e))
+
+    sampler = TreeSampler(process.pid, interval).start() if sample_tree else None
+    _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status)
+    sampled_mb = sampler.stop() if sampler else 0.0
+
+    error = f"exited with status {process.returncode}" if process.returncode != 0 else None
+    return make_record(tool, name, wall_time, usage.ru_utime, usage.ru_stime,
+                       max(maxrss_mb(usage.ru_maxrss), sampled_mb), process.returncode, error)
+
+class ChildUsage:
+    """ Measure a block of code that starts and waits for tool processes, e.g. from a thread pool
+
+    CPU times are the RUSAGE_CHILDREN difference across the block and peak RSS is the
+    sampled sum over this process's descendants, so concurrent tools add up.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+
+    def __enter__(self):
+        self._usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._sampler = TreeSampler(os.getpid(), self.interval, include_root=False).start()
+        self._start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall_time = time.perf_counter() - self._start_time
+        self.peak_rss_mb = self._sampler.stop()
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.user_time = usage.ru_utime - self._usage.ru_utime
+        self.sys_time = usage.ru_stime - self._usage.ru_stime
+
+    def record(self, tool, name, returncode=0, error=None):
+        return make_record(tool, name, self.wall_time, self.user_time, self.sys_time, self.peak_rss_mb,
+                           returncode, error)
+
+def measure_call(tool, name, func, *args, **kwargs):
+    """Call func in this process; returns (result, record), with any exception in the record
+
+    Peak RSS is this process's high-water mark, so it only describes func when the
+    process is fresh, e.g. a ProcessPoolExecutor worker with max_tasks_per_child=1.
+    """
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start_time = time.perf_counter()
+    result, returncode, error = None, 0, None
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        returncode, error = 1, str(e) or type(e).__name__
+    wall_time = time.perf_counter() - start_time
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return result, make_record(tool, name, wall_time, usage.ru_utime - usage_before.ru_utime,
+                               usage.ru_stime - usage_before.ru_stime, maxrss_mb(usage.ru_maxrss),
+                               returncode, error)
+
+def record_row(record, *extra):
+    """Spreadsheet row in RECORD_HEADER order, followed by any tool-specific columns"""
+    return [record[field] for field in RECORD_FIELDS] + list(extra)
+
+def open_sheet(excel_file, title, extra_header=()):
+    """Workbook and sheet for records, creating the sheet with its header if needed"""
+    from openpyxl import Workbook, load_workbook
+    if os.path.exists(excel_file):
+        wb = load_workbook(excel_file)
+        if title in wb.sheetnames:
+            return wb, wb[title]
+        sheet = wb.create_sheet(title)    # older reports keep their own sheets untouched
+    else:
+        wb = Workbook()
+        sheet = wb.active
+        sheet.title = title
+    sheet.append(RECORD_HEADER + list(extra_header))
+    return wb, sheet
+
+def append_csv(csv_file, records):
+    """Append records to a CSV file with a RECORD_FIELDS header"""
+    file_exists = os.path.exists(csv_file)
+    with open(csv_file, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS)
+        if not file_exists:
+            writer.writeheader()
+        writer.writerows(records)
@@ -1,8 +1,12 @@
-import os
 import sys
-import subprocess
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from mafft_runner import ensemble_jobs, run_alignment_jobs
+from alignment_cache import cache_from_env
+
+MAFFT_SPEED_COMMAND = ['mafft', '--quiet', '--retree', '2', '--amino', '--aamatrix', '{matrix}', '{input}']
+
 def select_test_case(run_rv = "True", input_fasta=None):
     """List and select test cases from RV100 folder"""
     test_cases = []
@@ -33,25 +37,17 @@ def select_test_case(run_rv = "True", input_fasta=None):
         except ValueError:
             print("Please enter a valid number!")
 
-def run_mafft_alignments(input_fasta, matrices_dir, output_dir):
+def run_mafft_alignments(input_fasta, matrices_dir, output_dir, cache=None):
     """Run MAFFT for each matrix"""
-    # Create output directory if it doesn't exist
-    Path(output_dir).mkdir(exist_ok=True)
-    
-    # For each matrix file
-    for matrix_file in os.listdir(matrices_dir):
-        print(f"Processing matrix: {matrix_file}")
-        matrix_path = os.path.join(matrices_dir, matrix_file)
-        output_path = os.path.join(output_dir, f"{matrix_file}.aln")
-        
-        # Run MAFFT with this matrix
-        # Note the changed --aamatrix option and added --auto for better accuracy
-        cmd = f"mafft --quiet --retree 2 --amino --aamatrix {matrix_path} {input_fasta} > {output_path}"
-        try:
-            subprocess.run(cmd, shell=True, check=True)
-            print(f"✓ Completed alignment with matrix {matrix_file}")
-        except subprocess.CalledProcessError as e:
-            print(f"✗ Error running MAFFT with matrix {matrix_file}: {e}")
+    # One job at a time, so the speed benchmark keeps measuring sequential MAFFT runs
+    jobs = ensemble_jobs(input_fasta, matrices_dir, output_dir)
+    for record in run_alignment_jobs(jobs, max_workers=1, aligner=MAFFT_SPEED_COMMAND, cache=cache):
+        if record['cached']:
+            print(f"✓ Reused cached alignment for matrix {record['matrix']}")
+        elif record['returncode'] == 0:
+            print(f"✓ Completed alignment with matrix {record['matrix']}")
+        else:
+            print(f"✗ Error running MAFFT with matrix {record['matrix']}: {record['stderr']}")
 
 if __name__ == "__main__":
     # Set your paths here
@@ -78,7 +74,7 @@ if __name__ == "__main__":
         proceed = input("\nProceed with MAFFT alignments? (y/n): ")
     if proceed.lower() == 'y':
         print("\nRunning MAFFT alignments...")
-        run_mafft_alignments(INPUT_FASTA, MATRICES_DIR, OUTPUT_DIR)
+        run_mafft_alignments(INPUT_FASTA, MATRICES_DIR, OUTPUT_DIR, cache_from_env())
         print("\nDone! Alignments are saved in:", OUTPUT_DIR)
         print("\nYou can now run MergeAlign on these alignments using:")
         print(f"python3 template.py -a {OUTPUT_DIR} -f final_alignment.fasta")
@@ -0,0 +1,153 @@
+"""
+Synthetic MergeAlign ensembles without running an aligner
+
+A seed alignment (a reference FASTA file or a random alignment of any size) is copied
+num_alignments times, and in each copy gap blocks are shifted past neighbouring
+residues, the way different aligners place the same indel differently. The
+disagreement rate is the fraction of columns perturbed, fixed or drawn per alignment
+from a range: every gap block starting in a perturbed column moves, so the number of
+places the copies disagree grows with the columns but not with the number of rows.
+Ensembles are returned as uint8 matrices (rows in seed order), which
+MergeAlign.matrices_to_coordinates takes directly, or written as FASTA files.
+
+    python ensemble_generator.py OUTPUT_DIR --size 1000x2000 --alignments 500 --rate 0.05:0.2
+    python ensemble_generator.py OUTPUT_DIR --seed-alignment bench1.0/bali3/ref/BB11001
+"""
+
+import os
+import argparse
+
+import numpy as np
+
+from fasta_reader import read_fasta, sequences_to_matrix
+
+AMINO_ACIDS = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', dtype=np.uint8)
+GAP = ord('-')
+
+def read_seed(filename):
+    """(names, uint8 matrix) of an aligned FASTA file; '.' gaps become '-' and residues upper case"""
+    records = [(header.split()[0], seq.replace('.', '-').upper()) for header, seq in read_fasta(filename)]
+    return [name for name, _ in records], sequences_to_matrix([seq for _, seq in records])
+
+def random_seed(num_sequences, num_columns, rng, gap_rate=0.2, mean_gap_length=4):
+    """(names, uint8 matrix) of random residues with gap blocks covering about gap_rate of each row"""
+    matrix = rng.choice(AMINO_ACIDS, size=(num_sequences, num_columns))
+    num_blocks = rng.poisson(gap_rate * num_columns / mean_gap_length, size=num_sequences)
+    for row, blocks in zip(matrix, num_blocks):
+        starts = rng.integers(0, num_columns, size=blocks)
+        lengths = rng.geometric(1 / mean_gap_length, size=blocks)
+        for start, length in zip(starts, lengths):
+            row[start:start + length] = GAP
+        if (row == GAP).all():
+            row[rng.integers(num_columns)] = rng.choice(AMINO_ACIDS)
+    return [f"seq{i}" for i in range(num_sequences)], drop_gap_columns(matrix)
+
+def drop_gap_columns(matrix):
+    """Remove columns that are gaps in every row, as aligners never emit them"""
+    return matrix[:, (matrix != GAP).any(axis=0)]
+
+def shift_gap_blocks(matrix, rate, rng, max_shift=3):
+    """Copy of an alignment with the gap blocks starting in a fraction rate of its columns moved past up to max_shift residues
+
+    Each row is held as the number of gaps before each of its residues plus its trailing
+    gaps (its slots); moving a block adds its gaps to a slot up to max_shift residues
+    away in the same row, so residue order and row length are unchanged. The slots of
+    all rows are concatenated so the whole alignment is shifted at once.
+    """
+    num_columns = matrix.shape[1]
+    is_residue = matrix != GAP
+    rows, columns = np.nonzero(is_residue)
+    residues_per_row = is_residue.sum(axis=1)
+    slot_starts = np.concatenate(([0], np.cumsum(residues_per_row + 1)))
+
+    # Residue columns with num_columns appended to each row; gaps in a slot are the distance to the previous column
+    ends = np.insert(columns, np.cumsum(residues_per_row), num_columns)
+    previous = np.concatenate(([-1], ends[:-1]))
+    previous[slot_starts[:-1]] = -1
+    slots = ends - previous - 1
+
+    # A non-empty slot is a gap block starting in the column after the previous residue;
+    # the blocks starting in one perturbed column all move by that column's shift
+    column_shifts = rng.integers(1, max_shift + 1, size=num_columns) * rng.choice([-1, 1], size=num_columns)
+    column_shifts[rng.random(num_columns) >= rate] = 0
+    blocks = np.flatnonzero(slots > 0)
+    shifts = column_shifts[previous[blocks] + 1]
+    blocks, shifts = blocks[shifts != 0], shifts[shifts != 0]
+    if len(blocks):
+        block_rows = np.searchsorted(slot_starts, blocks, side='right') - 1
+        targets = np.clip(blocks + shifts, slot_starts[block_rows], slot_starts[block_rows + 1] - 1)
+        moved = slots[blocks]
+        slots[blocks] = 0
+        np.add.at(slots, targets, moved)
+
+    # Column of residue j in row r: gaps in slots 0..j of that row plus j
+    total = np.cumsum(slots)
+    gaps_before = total - np.repeat(total[slot_starts[:-1]] - slots[slot_starts[:-1]], residues_per_row + 1)
+    residue_slots = np.delete(np.arange(len(slots)), slot_starts[1:] - 1)
+    residue_index = residue_slots - np.repeat(slot_starts[:-1], residues_per_row)
+    shifted = np.full_like(matrix, GAP)
+    shifted[rows, gaps_before[residue_slots] + residue_index] = matrix[rows, columns]
+    return shifted
+
+def perturb(matrix, rate, rng, max_shift=3):
+    """One ensemble member: gap blocks shifted at the given rate, all-gap columns dropped"""
+    return drop_gap_columns(shift_gap_blocks(matrix, rate, rng, max_shift))
+
+def generate_ensemble(matrix, num_alignments, rate=0.1, seed=0, max_shift=3):
+    """num_alignments perturbed copies of matrix
+
+    rate is the fraction of columns perturbed in each copy, or a (low, high) range each
+    alignment draws its rate from;
+    seed is anything np.random.default_rng takes, including a Generator.
+    """
+    rng = np.random.default_rng(seed)
+    low, high = rate if isinstance(rate, (tuple, list)) else (rate, rate)
+    return [perturb(matrix, rng.uniform(low, high), rng, max_shift) for _ in range(num_alignments)]
+
+def ensemble_alignments(names, matrices):
+    """Matrices as lists of (seq_id, sequence), the in-memory form MergeAlign.merge accepts"""
+    return [[(name, row.tobytes().decode('ascii')) for name, row in zip(names, matrix)] for matrix in matrices]
+
+def write_ensemble(folder, names, matrices):
+    """Write one FASTA file per alignment, a000.aln, a001.aln, ..."""
+    os.makedirs(folder, exist_ok=True)
+    for i, matrix in enumerate(matrices):
+        with open(os.path.join(folder, f"a{i:03d}.aln"), 'w') as f:
+            for name, row in zip(names, matrix):
+                f.write(f">{name}\n{row.tobytes().decode('ascii')}\n")
+
+def parse_rate(text):
+    """'0.1' or '0.05:0.2'"""
+    if ':' in text:
+        low, high = map(float, text.split(':'))
+        return low, high
+    return float(text)
+
+def parse_size(text):
+    """'SEQUENCESxCOLUMNS'"""
+    num_sequences, num_columns = map(int, text.lower().split('x'))
+    return num_sequences, num_columns
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic alignment ensemble as FASTA files")
+    parser.add_argument('output_dir')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--seed-alignment', help="aligned FASTA file to perturb")
+    source.add_argument('--size', type=parse_size, default=(100, 500), help="random seed alignment, SEQUENCESxCOLUMNS")
+    parser.add_argument('--alignments', type=int, default=50)
+    parser.add_argument('--rate', type=parse_rate, default=0.1, help="fraction of columns perturbed, or LOW:HIGH per alignment")
+    parser.add_argument('--max-shift', type=int, default=3)
+    parser.add_argument('--gap-rate', type=float, default=0.2, help="gapped fraction of a random seed alignment")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.seed_alignment:
+        names, matrix = read_seed(args.seed_alignment)
+    else:
+        names, matrix = random_seed(*args.size, np.random.default_rng(args.seed), args.gap_rate)
+    matrices = generate_ensemble(matrix, args.alignments, args.rate, args.seed + 1, args.max_shift)
+    write_ensemble(args.output_dir, names, matrices)
+    print(f"Wrote {len(matrices)} alignments of {len(names)} sequences to {args.output_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Streaming FASTA reader shared by MergeAlign and alignment_scoring
+"""
+
+import numpy as np
+
+CHUNK_SIZE = 1 << 20
+
+def read_fasta(filename, chunk_size=CHUNK_SIZE, strip_lines=False):
+    """Yield (header, sequence) pairs, reading the file through a large buffer
+
+    Sequence lines are collected in a list and joined once per record, so wrapped
+    FASTA is parsed in linear time. Lines before the first header are ignored.
+    Trailing whitespace is always dropped; with strip_lines leading whitespace is
+    too, so indented headers and sequence lines still parse.
+    """
+    header = None
+    parts = []
+    with open(filename, 'r', buffering=chunk_size) as f:
+        for line in f:
+            if strip_lines:
+                line = line.strip()
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, ''.join(parts)
+                header = line[1:].rstrip()
+                parts = []
+            elif header is not None:
+                parts.append(line.rstrip())
+    if header is not None:
+        yield header, ''.join(parts)
+
+def sequences_to_matrix(sequences):
+    """Stack equal-length aligned sequences into a (sequences x columns) uint8 matrix"""
+    rows = [seq.encode('ascii') for seq in sequences]
+    if len(set(map(len, rows))) > 1:
+        raise ValueError("Aligned sequences differ in length")
+    return np.frombuffer(b''.join(rows), dtype=np.uint8).reshape(len(rows), -1)
+
+def read_fasta_matrix(filename, chunk_size=CHUNK_SIZE):
+    """Read an aligned FASTA file as (headers, uint8 character matrix)"""
+    records = list(read_fasta(filename, chunk_size))
+    if not records:
+        return [], np.zeros((0, 0), dtype=np.uint8)
+    return [header for header, _ in records], sequences_to_matrix([seq for _, seq in records])
@@ -0,0 +1,108 @@
+"""
+Concurrent MAFFT runner for building MergeAlign ensembles
+
+The aligner command is a list of arguments with {matrix} and {input} placeholders,
+so a stand-in such as ['cat', '{input}'] can replace MAFFT when it is not installed.
+"""
+
+import os
+import csv
+import time
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+MAFFT_COMMAND = ['mafft', '--quiet', '--auto', '--amino', '--aamatrix', '{matrix}', '{input}']
+NOT_STARTED = -1     # returncode of a job whose aligner could not be started or whose files could not be read
+
+class AlignmentJob:
+    """ One aligner run: an input FASTA file aligned with one matrix into output_path """
+
+    def __init__(self, input_fasta, matrix_path, output_path):
+        self.input_fasta = str(input_fasta)
+        self.matrix_path = str(matrix_path)
+        self.output_path = str(output_path)
+
+    @property
+    def matrix_name(self):
+        return os.path.basename(self.matrix_path)
+
+def build_command(aligner, job):
+    """Fill the {matrix} and {input} placeholders of an aligner command"""
+    return [arg.format(matrix=job.matrix_path, input=job.input_fasta) for arg in aligner]
+
+def ensemble_jobs(input_fasta, matrices_dir, output_dir):
+    """One job per matrix file, writing <output_dir>/<matrix>.aln"""
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    return [AlignmentJob(input_fasta, os.path.join(matrices_dir, matrix_file),
+                         os.path.join(output_dir, f"{matrix_file}.aln"))
+            for matrix_file in sorted(os.listdir(matrices_dir))]
+
+def run_job(job, aligner=MAFFT_COMMAND, cache=None):
+    """Run one job; returns a record with wall time and exit status
+
+    Output goes to a temporary file that replaces output_path only on success, so a
+    failed run never leaves a truncated alignment behind. With an AlignmentCache, a
+    previously computed alignment is copied instead of rerunning the aligner.
+    """
+    command = build_command(aligner, job)
+    tmp_path = f"{job.output_path}.tmp{os.getpid()}"
+    start_time = time.perf_counter()
+
+    try:
+        for path in (job.input_fasta, job.matrix_path):
+            with open(path, 'rb'):
+                pass
+        key = cache.key(job.input_fasta, job.matrix_path, aligner) if cache is not None else None
+    except OSError as e:    # a missing or unreadable input fails this job, not the whole pool
+        return job_record(job, NOT_STARTED, time.perf_counter() - start_time, str(e))
+    if key is not None and cache.fetch(key, job.output_path):
+        return job_record(job, 0, time.perf_counter() - start_time, '', cached=True)
+
+    try:
+        with open(tmp_path, 'wb') as out:
+            result = subprocess.run(command, stdout=out, stderr=subprocess.PIPE)
+        returncode, stderr = result.returncode, result.stderr.decode(errors='replace').strip()
+    except OSError as e:
+        returncode, stderr = NOT_STARTED, str(e)
+    wall_time = time.perf_counter() - start_time
+
+    if returncode == 0:
+        os.replace(tmp_path, job.output_path)
+        if key is not None:
+            try:
+                cache.store(key, job.output_path)
+            except OSError as e:    # the alignment itself is fine; only reuse is lost
+                stderr = f"{stderr}\ncache store failed: {e}".strip()
+    elif os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    return job_record(job, returncode, wall_time, stderr)
+
+def job_record(job, returncode, wall_time, stderr, cached=False):
+    return {
+        'input': job.input_fasta,
+        'matrix': job.matrix_name,
+        'output': job.output_path,
+        'returncode': returncode,
+        'wall_time': wall_time,
+        'cached': cached,
+        'stderr': stderr,
+    }
+
+def run_alignment_jobs(jobs, max_workers=None, aligner=MAFFT_COMMAND, cache=None):
+    """Run jobs with at most max_workers aligner processes at once, yielding records as they finish"""
+    max_workers = max_workers or os.cpu_count()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_job, job, aligner, cache) for job in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+def write_job_log(records, filename):
+    """Write job records as a tab-separated table"""
+    fields = ['input', 'matrix', 'output', 'returncode', 'wall_time', 'cached', 'stderr']
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, delimiter='\t')
+        writer.writeheader()
+        for record in records:
+            writer.writerow({**record, 'wall_time': f"{record['wall_time']:.3f}"})
@@ -0,0 +1,156 @@
+"""
+Local store of AAindex2 substitution matrices
+
+Matrices are looked up in a compact .npz cache of parsed 20x20 arrays first, then in
+an AAindex2 flat file (https://www.genome.jp/ftp/db/community/aaindex/aaindex2), and
+only fetched over the network when neither has them. save() writes everything found
+back to the cache, so later runs start without parsing or network access; callers
+save once after a batch of lookups, since each save rewrites the whole file.
+"""
+
+import os
+import time
+import tempfile
+import numpy as np
+
+AMINO_ACIDS = 'ARNDCQEGHILKMFPSTWYV'
+DEFAULT_STORE_FILE = 'aaindex_matrices.npz'
+DEFAULT_AAINDEX_FILE = 'aaindex2'
+FETCH_INTERVAL = 1.0
+
+def read_aaindex2(filename):
+    """Matrix text of every entry in an AAindex2 flat file, keyed by accession number
+
+    The text holds the value lines between the 'M rows = ..., cols = ...' line and the
+    closing '//', the same text fetch_matrix_data scrapes from a genome.jp entry page.
+    """
+    entries = {}
+    matrix_id, lines, in_matrix = None, [], False
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith('//'):
+                if matrix_id is not None and lines:
+                    entries[matrix_id] = ''.join(lines)
+                matrix_id, lines, in_matrix = None, [], False
+            elif line.startswith('H '):
+                matrix_id = line[2:].strip()
+            elif line.startswith('M ') and 'rows = ' in line and 'cols = ' in line:
+                in_matrix = True
+            elif in_matrix:
+                cleaned = line.strip()
+                if cleaned and any(c.isdigit() or c in '.-' for c in cleaned):
+                    lines.append(cleaned + '\n')
+    return entries
+
+def data_to_array(matrix_data):
+    """parse_matrix_raw output (amino acid -> row) as a 20x20 array"""
+    return np.array([matrix_data[aa] for aa in AMINO_ACIDS], dtype=np.float64)
+
+def array_to_data(matrix):
+    """20x20 array back to the amino acid -> row dict create_matrix_file writes"""
+    return {aa: row.tolist() for aa, row in zip(AMINO_ACIDS, matrix)}
+
+class MatrixStore:
+    """ Parsed matrices backed by an .npz cache, an optional AAindex2 file and an optional fetcher
+
+    parse turns matrix text into an amino acid -> row dict (parse_matrix_raw); fetch
+    returns the matrix text for an accession number or None (fetch_matrix_data).
+    """
+
+    def __init__(self, store_file=DEFAULT_STORE_FILE, aaindex_file=DEFAULT_AAINDEX_FILE,
+                 parse=None, fetch=None, fetch_interval=FETCH_INTERVAL):
+        self.store_file = store_file
+        self.aaindex_file = aaindex_file
+        self.parse = parse
+        self.fetch = fetch
+        self.fetch_interval = fetch_interval
+        self._aaindex = None
+        self._last_fetch = None
+        self.matrices = self._load()
+        self.changed = False        # matrices were added since loading or the last save
+
+    def _load(self):
+        if not self.store_file or not os.path.exists(self.store_file):
+            return {}
+        with np.load(self.store_file) as data:
+            return dict(zip(data['ids'].tolist(), data['matrices']))
+
+    def save(self):
+        """Write all matrices to store_file, replacing it atomically; does nothing when none were added"""
+        if not self.store_file or not self.changed:
+            return
+        ids = sorted(self.matrices)
+        matrices = np.stack([self.matrices[i] for i in ids]) if ids else np.zeros((0, 20, 20))
+        folder = os.path.dirname(os.path.abspath(self.store_file))
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.tmp', suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, ids=np.array(ids, dtype=str), matrices=matrices)
+            os.replace(tmp_path, self.store_file)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.changed = False
+
+    def _aaindex_entries(self):
+        """AAindex2 entries, read on first use so a warm cache never touches the flat file"""
+        if self._aaindex is None:
+            exists = self.aaindex_file and os.path.exists(self.aaindex_file)
+            self._aaindex = read_aaindex2(self.aaindex_file) if exists else {}
+        return self._aaindex
+
+    def _matrix_text(self, matrix_id):
+        """Matrix text from the AAindex2 file, falling back to a rate-limited fetch"""
+        entries = self._aaindex_entries()
+        if matrix_id in entries:
+            return entries[matrix_id]
+        if self.fetch is None:
+            return None
+
+        if self._last_fetch is not None:
+            wait = self.fetch_interval - (time.monotonic() - self._last_fetch)
+            if wait > 0:
+                time.sleep(wait)
+        try:
+            return self.fetch(matrix_id)
+        finally:
+            self._last_fetch = time.monotonic()
+
+    def get_array(self, matrix_id):
+        """20x20 array for matrix_id, or None when it cannot be found; new matrices are kept until save"""
+        if matrix_id not in self.matrices:
+            matrix_text = self._matrix_text(matrix_id)
+            if not matrix_text:
+                return None
+            self.matrices[matrix_id] = data_to_array(self.parse(matrix_text))
+            self.changed = True
+        return self.matrices[matrix_id]
+
+    def get(self, matrix_id):
+        """Amino acid -> row dict for matrix_id, or None when it cannot be found"""
+        matrix = self.get_array(matrix_id)
+        return array_to_data(matrix) if matrix is not None else None
+
+    def missing(self, matrix_ids):
+        """Matrices that are neither cached nor in the AAindex2 file"""
+        return [i for i in matrix_ids if i not in self.matrices and i not in self._aaindex_entries()]
+
+if __name__ == "__main__":
+    import sys
+    from benchmark_substitutionmatrices import parse_matrix_list, parse_matrix_raw
+
+    # Build the cache from a local AAindex2 file: python matrix_store.py [aaindex2] [store.npz]
+    aaindex_file = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_AAINDEX_FILE
+    store_file = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_STORE_FILE
+    store = MatrixStore(store_file, aaindex_file, parse=parse_matrix_raw)
+
+    matrix_ids = parse_matrix_list('list_of_matrices.txt')
+    for matrix_id in store.missing(matrix_ids):
+        print(f"Not in {aaindex_file}: {matrix_id}")
+    for matrix_id in matrix_ids:
+        try:
+            store.get_array(matrix_id)
+        except ValueError as e:
+            print(f"Error parsing matrix {matrix_id}: {e}")
+    store.save()
+    print(f"{len(store.matrices)} matrices in {store_file}")
@@ -1,7 +1,9 @@
 import os
-import subprocess
+import shlex
 from pathlib import Path
 import time
+from mafft_runner import MAFFT_COMMAND, ensemble_jobs, run_alignment_jobs, write_job_log
+from alignment_cache import DEFAULT_CACHE_DIR, cache_from_env
 
 def select_test_case():
     """List and select test cases from RV100 folder"""
@@ -25,21 +27,22 @@ def select_test_case():
         except ValueError:
             print("Please enter a valid number!")
 
-def run_mafft_alignments(input_fasta, matrices_dir, output_dir):
-    """Run MAFFT for each matrix"""
-    Path(output_dir).mkdir(exist_ok=True)
+def run_mafft_alignments(input_fasta, matrices_dir, output_dir, max_workers=None, aligner=MAFFT_COMMAND, cache=None):
+    """Run MAFFT for each matrix, keeping up to max_workers alignments running at once"""
+    jobs = ensemble_jobs(input_fasta, matrices_dir, output_dir)
+    print(f"Running {len(jobs)} alignments with up to {max_workers or os.cpu_count()} at a time")
     
-    for matrix_file in os.listdir(matrices_dir):
-        print(f"Processing matrix: {matrix_file}")
-        matrix_path = os.path.join(matrices_dir, matrix_file)
-        output_path = os.path.join(output_dir, f"{matrix_file}.aln")
-        
-        cmd = f"mafft --quiet --auto --amino --aamatrix {matrix_path} {input_fasta} > {output_path}"
-        try:
-            subprocess.run(cmd, shell=True, check=True)
-            print(f"✓ Completed alignment with matrix {matrix_file}")
-        except subprocess.CalledProcessError as e:
-            print(f"✗ Error running MAFFT with matrix {matrix_file}: {e}")
+    records = []
+    for record in run_alignment_jobs(jobs, max_workers, aligner, cache):
+        records.append(record)
+        if record['cached']:
+            print(f"✓ Reused cached alignment for matrix {record['matrix']}")
+        elif record['returncode'] == 0:
+            print(f"✓ Completed alignment with matrix {record['matrix']} ({record['wall_time']:.2f}s)")
+        else:
+            print(f"✗ Error running MAFFT with matrix {record['matrix']} "
+                  f"(exit status {record['returncode']}): {record['stderr']}")
+    return records
 
 if __name__ == "__main__":
     print("First, select your test sequence file:")
@@ -47,6 +50,10 @@ if __name__ == "__main__":
     
     MATRICES_DIR = "mergealign_matrices"
     OUTPUT_DIR = "mafft_alignments"
+    JOB_LOG = "mafft_jobs.tsv"
+    MAX_WORKERS = int(os.environ.get("MAFFT_WORKERS", 0)) or None    # default: one per core
+    ALIGNER = shlex.split(os.environ["MAFFT_ALIGNER"]) if "MAFFT_ALIGNER" in os.environ else MAFFT_COMMAND
+    CACHE = cache_from_env(DEFAULT_CACHE_DIR)     # MAFFT_CACHE_DIR=off to always realign
     
     print(f"\nWill use:")
     print(f"Input sequences: {INPUT_FASTA}")
@@ -57,7 +64,10 @@ if __name__ == "__main__":
     if proceed.lower() == 'y':
         start_time = time.time()
         print("\nRunning MAFFT alignments...")
-        run_mafft_alignments(INPUT_FASTA, MATRICES_DIR, OUTPUT_DIR)
+        records = run_mafft_alignments(INPUT_FASTA, MATRICES_DIR, OUTPUT_DIR, MAX_WORKERS, ALIGNER, CACHE)
+        write_job_log(records, JOB_LOG)
+        failed = sum(record['returncode'] != 0 for record in records)
+        print(f"\n{len(records) - failed} alignments succeeded, {failed} failed; job log saved in {JOB_LOG}")
         print("\nDone! Alignments are saved in:", OUTPUT_DIR)
         print("\nYou can now run MergeAlign on these alignments using:")
         print(f"python mergealign.py -a {OUTPUT_DIR} -f mergealign_output.fasta")
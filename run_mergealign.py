@@ -1,30 +1,24 @@
-import subprocess
 from pathlib import Path
 import time
+from MergeAlign import merge, write_fasta
 
 def run_mergealign(alignments_dir, output_file):
     """Run MergeAlign on the MAFFT outputs"""
     if not Path(alignments_dir).exists():
         raise ValueError(f"Alignments directory not found: {alignments_dir}")
         
-    cmd = f"python3 mergealign.py -a {alignments_dir} -f {output_file}"
     try:
-        result = subprocess.run(cmd, shell=True, check=True, 
-                              capture_output=True, text=True)
-        print(result.stdout)
-        print(f"MergeAlign completed successfully")
+        result = merge(alignments_dir, return_scores=False)
+        write_fasta(output_file, result.alignment)
+        print(f"MergeAlign completed successfully ({result.num_alignments} alignments merged)")
         print(f"Output saved to: {output_file}")
-    except subprocess.CalledProcessError as e:
+    except Exception as e:
         print(f"Error running MergeAlign: {e}")
-        if e.stdout:
-            print("stdout:", e.stdout)
-        if e.stderr:
-            print("stderr:", e.stderr)
 
 def check_setup():
     """Check if all required files and directories exist"""
     required_files = {
-        'mergealign.py': 'MergeAlign implementation file',
+        'MergeAlign.py': 'MergeAlign implementation file',
         'mafft_alignments': 'Directory containing MAFFT alignments'
     }
     
@@ -0,0 +1,274 @@
+"""
+Segment-parallel scoring of a MergeAlign alignment graph
+
+Node ids are in topological order, so the graph is cut into stretches of consecutive
+ids with about equal edge counts. The best-path DP inside a stretch only needs the
+path score and length of its frontier: the nodes before it with edges into it, plus
+the last anchor before it. Stretches are scored concurrently in a process pool over
+CSR arrays held in shared memory, each from guessed frontier values, and every node
+records the frontier node its best path starts from and what the path adds after it.
+
+The stretches are then stitched in order. Once the frontier values of a stretch are
+known, each path score and length is its frontier value plus what the path adds, and
+one vectorized pass checks that every node still takes the first predecessor edge
+with the highest count + path average, as the DP does. Stretches that fail are scored
+again from the stitched values, which are exact for the first of them, so each round
+settles at least one more stretch; after SPECULATION_ROUNDS the rest are scored
+serially. The result is exactly that of the serial DP.
+"""
+
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger('mergealign')
+
+INPUT_ARRAYS = ('indptr', 'predecessors', 'counts', 'anchor_agreed')
+NODE_ARRAYS = ('guess_score', 'guess_length', 'increment_score', 'increment_length', 'origin', 'best_edge')
+TASKS_PER_WORKER = 4        # more, smaller stretches even out the work of the pool
+SPECULATION_ROUNDS = 3      # parallel rounds before the remaining stretches are scored serially
+WARMUP = 0.5                # nodes scored before a stretch, as a fraction of its nodes
+MIN_STRETCH_EDGES = 50000   # smaller graphs are scored serially: starting the pool would cost more
+
+_shared = {}    # name -> array in the shared memory a pool worker is attached to
+
+def score_segment(indptr, predecessors, counts, anchor_agreed, num_alignments, seeds):
+    """(path_score, path_length, best_edge) of a graph whose first nodes have the given (score, length)
+
+    Nodes 0 .. len(seeds) - 1 are seeds: their paths are given and their edges ignored.
+    anchor_agreed is the number of agreed steps up to each anchor and -1 for the other
+    nodes. A node without predecessors is an anchor reached from the last anchor by
+    agreed steps, each worth num_alignments. best_edge is -1 for seeds and those nodes.
+    """
+    num_nodes = len(indptr) - 1
+    path_score = [0] * num_nodes
+    path_length = [0] * num_nodes
+    path_average = [0] * num_nodes
+    best_edge = [-1] * num_nodes
+    last_anchor = 0
+    for node, (score, length) in enumerate(seeds):
+        path_score[node], path_length[node] = score, length
+        if length:
+            path_average[node] = score / length
+        if anchor_agreed[node] >= 0:
+            last_anchor = node
+
+    for node in range(len(seeds), num_nodes):
+        edge = indptr[node]
+        if edge == indptr[node + 1]:
+            steps = anchor_agreed[node] - anchor_agreed[last_anchor]
+            score = path_score[last_anchor] + num_alignments * steps
+            length = path_length[last_anchor] + steps
+        else:
+            best_value = counts[edge] + path_average[predecessors[edge]]
+            for other in range(edge + 1, indptr[node + 1]):
+                value = counts[other] + path_average[predecessors[other]]
+                if value > best_value:
+                    edge, best_value = other, value
+            prev_node = predecessors[edge]
+            score, length = counts[edge] + path_score[prev_node], path_length[prev_node] + 1
+            best_edge[node] = edge
+
+        path_score[node], path_length[node] = score, length
+        if length:
+            path_average[node] = score / length
+        if anchor_agreed[node] >= 0:
+            last_anchor = node
+
+    return path_score, path_length, best_edge
+
+def frontier(arrays, start, stop):
+    """Sorted ids of the nodes before start that nodes start .. stop - 1 depend on"""
+    predecessors = arrays['predecessors'][arrays['indptr'][start]:arrays['indptr'][stop]]
+    last_anchor = np.flatnonzero(arrays['anchor_agreed'][:start] >= 0)[-1]
+    return np.unique(np.append(predecessors[predecessors < start], last_anchor))
+
+def run_stretch(arrays, start, stop, num_alignments, seeds, warmup=0):
+    """Score nodes start .. stop - 1 into the node arrays, from the values seeds of the frontier of warmup .. stop - 1
+
+    Nodes warmup .. start - 1 are scored too but only so that paths entering the
+    stretch have consistent values; origins are the nodes before start.
+    """
+    warmup = warmup or start
+    front = frontier(arrays, warmup, stop)
+    num_seeds = len(front)
+    first_edge, last_edge = arrays['indptr'][warmup], arrays['indptr'][stop]
+    predecessors = arrays['predecessors'][first_edge:last_edge]
+    # Frontier nodes come first, then warmup .. stop - 1; local edge e is global edge first_edge + e
+    local_predecessors = np.where(predecessors < warmup, np.searchsorted(front, predecessors),
+                                  predecessors - warmup + num_seeds)
+    indptr = np.concatenate((np.zeros(num_seeds, dtype=np.int64), arrays['indptr'][warmup:stop + 1] - first_edge))
+    anchor_agreed = np.concatenate((arrays['anchor_agreed'][front], arrays['anchor_agreed'][warmup:stop]))
+    path_score, path_length, best_edge = score_segment(
+        indptr.tolist(), local_predecessors.tolist(), arrays['counts'][first_edge:last_edge].tolist(),
+        anchor_agreed.tolist(), num_alignments, seeds)
+
+    # Follow every best path back to the first node before start on it, by pointer doubling
+    num_before = num_seeds + start - warmup
+    best_edge = np.array(best_edge, dtype=np.int64)
+    node_ids = np.arange(len(best_edge))
+    last_anchor = np.maximum.accumulate(np.where(anchor_agreed >= 0, node_ids, 0))
+    parent = np.where(best_edge >= 0, np.append(local_predecessors, 0)[best_edge],
+                      np.concatenate(([0], last_anchor[:-1])))
+    parent[:num_before] = node_ids[:num_before]
+    while True:
+        grandparent = parent[parent]
+        if (grandparent == parent).all():
+            break
+        parent = grandparent
+
+    global_ids = np.concatenate((front, np.arange(warmup, stop)))
+    path_score, path_length = np.array(path_score), np.array(path_length)
+    arrays['increment_score'][start:stop] = (path_score - path_score[parent])[num_before:]
+    arrays['increment_length'][start:stop] = (path_length - path_length[parent])[num_before:]
+    arrays['origin'][start:stop] = global_ids[parent[num_before:]]
+    arrays['best_edge'][start:stop] = np.where(best_edge[num_before:] >= 0, best_edge[num_before:] + first_edge, -1)
+
+def settle(arrays, values, start, stop):
+    """Set the values of nodes start .. stop - 1 from their frontier; False if a stored choice is no longer the DP's"""
+    origin = arrays['origin'][start:stop]
+    values['score'][start:stop] = values['score'][origin] + arrays['increment_score'][start:stop]
+    values['length'][start:stop] = values['length'][origin] + arrays['increment_length'][start:stop]
+
+    indptr = arrays['indptr'][start:stop + 1]
+    degrees = np.diff(indptr)
+    has_edges = degrees > 0
+    if not has_edges.any():
+        return True
+    edges = np.arange(indptr[0], indptr[-1])
+    predecessors = arrays['predecessors'][edges]
+    lengths = values['length'][predecessors]
+    averages = np.zeros(len(edges))
+    np.divide(values['score'][predecessors], lengths, out=averages, where=lengths > 0)
+    edge_values = arrays['counts'][edges] + averages
+    offsets = indptr[:-1][has_edges] - indptr[0]
+    best_value = np.maximum.reduceat(edge_values, offsets)
+    is_best = edge_values == np.repeat(best_value, degrees[has_edges])
+    first_best = np.minimum.reduceat(np.where(is_best, edges, indptr[-1]), offsets)
+    return bool((first_best == arrays['best_edge'][start:stop][has_edges]).all())
+
+def stitch(arrays, values, bounds, first, num_alignments, serial=False):
+    """Settle stretches first.. in order; returns those that failed, or rescores them here when serial"""
+    failed = []
+    for k in range(first, len(bounds) - 1):
+        start, stop = bounds[k], bounds[k + 1]
+        if settle(arrays, values, start, stop):
+            continue
+        if not serial:
+            failed.append(k)
+            continue
+        front = frontier(arrays, start, stop)
+        run_stretch(arrays, start, stop, num_alignments,
+                    list(zip(values['score'][front].tolist(), values['length'][front].tolist())))
+        settle(arrays, values, start, stop)
+    return failed
+
+def attach(specs):
+    """Pool initializer: map the shared arrays into this worker"""
+    for name, (block_name, length) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared[name] = np.ndarray(length, dtype=np.int64, buffer=block.buf)
+        _shared[name + ':block'] = block     # the mapping must outlive the array
+
+def run_shared_stretch(start, stop, warmup, num_alignments):
+    """Pool task: score a stretch from the guessed values of the frontier of its warm-up"""
+    front = frontier(_shared, warmup, stop)
+    seeds = list(zip(_shared['guess_score'][front].tolist(), _shared['guess_length'][front].tolist()))
+    run_stretch(_shared, start, stop, num_alignments, seeds, warmup)
+
+def available_cpus():
+    """CPUs this process may run on: its affinity mask where the platform has one"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def parallel_workers(num_edges, workers):
+    """Processes worth using for a graph of num_edges edges; 1 means score serially
+
+    Never more than the CPUs available, since extra processes on a busy CPU only add
+    overhead, and only as many as there are stretches of MIN_STRETCH_EDGES edges.
+    """
+    workers = min(workers, available_cpus(), num_edges // MIN_STRETCH_EDGES)
+    return workers if workers > 1 else 1
+
+def stretch_bounds(indptr, num_stretches):
+    """First node of each stretch, and the node count last, splitting nodes 1.. by edge count"""
+    targets = np.linspace(indptr[1], indptr[-1], max(num_stretches, 1) + 1)
+    bounds = np.searchsorted(indptr, targets[1:-1])
+    return np.unique(np.concatenate(([1], np.clip(bounds, 1, len(indptr) - 1), [len(indptr) - 1]))).tolist()
+
+def initial_guess(indptr, counts, anchor_agreed, num_alignments, seed):
+    """(score, length) guessed for every node before any stretch is scored
+
+    A path gains num_alignments and 1 per agreed step, and elsewhere one step per node
+    at the rate alignments visit nodes, each worth the mean highest count into a node.
+    """
+    num_nodes = len(indptr) - 1
+    agreed = np.maximum.accumulate(np.maximum(anchor_agreed, 0)) - max(anchor_agreed[0], 0)
+    degrees = np.diff(indptr)
+    has_edges = degrees > 0
+    mean_best = np.maximum.reduceat(counts, indptr[:-1][has_edges]).mean() if has_edges.any() else num_alignments
+    steps = np.arange(num_nodes) * (counts.sum() / num_alignments / num_nodes)
+    score = seed[0] + num_alignments * agreed + np.round(mean_best * steps).astype(np.int64)
+    length = seed[1] + agreed + np.round(steps).astype(np.int64)
+    return score, length
+
+def score_segments(indptr, predecessors, counts, anchor_agreed, num_alignments, workers, seed=(0, 0)):
+    """best_edge per node as score_segment finds it from the seed of node 0, scored by stretches in a process pool
+
+    anchor_agreed is as for score_segment, and node 0 is an anchor. Returns global edge
+    ids, -1 for node 0 and for anchors reached by agreed steps.
+    """
+    indptr, predecessors, counts = np.asarray(indptr), np.asarray(predecessors), np.asarray(counts)
+    anchor_agreed = np.asarray(anchor_agreed)
+    num_nodes = len(indptr) - 1
+    requested, workers = workers, parallel_workers(int(indptr[-1]), workers)
+    if workers < requested:
+        logger.info(f"Using {workers} of {requested} workers: {available_cpus()} CPUs available, "
+                    f"{int(indptr[-1])} edges")
+    bounds = stretch_bounds(indptr, min(workers * TASKS_PER_WORKER, int(indptr[-1]) // MIN_STRETCH_EDGES))
+    if workers == 1 or len(bounds) < 3:
+        return np.array(score_segment(indptr.tolist(), predecessors.tolist(), counts.tolist(),
+                                      anchor_agreed.tolist(), num_alignments, [seed])[2], dtype=np.int64)
+
+    score, length = initial_guess(indptr, counts, anchor_agreed, num_alignments, seed)
+    values = {'score': score, 'length': length}
+    arrays = {'indptr': indptr, 'predecessors': predecessors, 'counts': counts, 'anchor_agreed': anchor_agreed}
+    blocks, specs = [], {}
+    try:
+        for name in INPUT_ARRAYS + NODE_ARRAYS:
+            size = len(arrays[name]) if name in arrays else num_nodes
+            block = shared_memory.SharedMemory(create=True, size=max(size, 1) * 8)
+            blocks.append(block)
+            shared = np.ndarray(size, dtype=np.int64, buffer=block.buf)
+            shared[:] = arrays[name] if name in arrays else 0
+            arrays[name] = shared
+            specs[name] = (block.name, size)
+        del shared
+        arrays['best_edge'][0] = -1
+
+        pending = list(range(len(bounds) - 1))
+        rounds = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=attach, initargs=(specs,)) as executor:
+            while pending and rounds < SPECULATION_ROUNDS:
+                arrays['guess_score'][:] = values['score']
+                arrays['guess_length'][:] = values['length']
+                for future in [executor.submit(run_shared_stretch, bounds[k], bounds[k + 1],
+                                               max(1, bounds[k] - int(WARMUP * (bounds[k + 1] - bounds[k]))),
+                                               num_alignments) for k in pending]:
+                    future.result()
+                pending = stitch(arrays, values, bounds, pending[0], num_alignments)
+                rounds += 1
+        if pending:
+            stitch(arrays, values, bounds, pending[0], num_alignments, serial=True)
+        logger.info(f"Scored {len(bounds) - 1} stretches on {workers} workers in {rounds} rounds"
+                    + (f", {len(pending)} left for a serial pass" if pending else ""))
+        return arrays['best_edge'].copy()
+    finally:
+        arrays.clear()
+        for block in blocks:
+            block.close()
+            block.unlink()
@@ -0,0 +1,131 @@
+"""
+Per-stage timing and memory instrumentation for MergeAlign
+
+A StageProfiler is passed through the merge and records wall time and memory for
+each stage, plus counters such as graph nodes and edges. Modes:
+
+    stages       wall time per stage, the process peak RSS after it and how much the stage raised it (cheap)
+    tracemalloc  also the peak of Python allocations within each stage
+    cprofile     also a cProfile of the whole merge, saved next to the report
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import tracemalloc
+import contextlib
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+PROFILE_MODES = ('stages', 'tracemalloc', 'cprofile')
+PROFILE_ENV = 'MERGEALIGN_PROFILE'
+TOP_FUNCTIONS = 25
+
+def peak_rss_mb():
+    """High-water resident memory of this process in MB, or None where unavailable"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def profile_mode_from_env():
+    """Profiling mode named by MERGEALIGN_PROFILE, or None when unset"""
+    mode = os.environ.get(PROFILE_ENV, '').strip().lower()
+    if not mode or mode in ('0', 'off'):
+        return None
+    return 'stages' if mode in ('1', 'on') else mode
+
+class StageProfiler:
+    """ Records a timing entry per stage of one merge; use as a context manager around the merge """
+
+    def __init__(self, mode='stages'):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.mode = mode
+        self.stages = []
+        self.counts = {}
+        self.total_time = None
+        self._profile = None
+        self._stats = None
+
+    def __enter__(self):
+        if self.mode == 'tracemalloc':
+            tracemalloc.start()
+        elif self.mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.total_time = time.perf_counter() - self._start_time
+        if self.mode == 'tracemalloc':
+            tracemalloc.stop()
+        elif self.mode == 'cprofile':
+            self._profile.disable()
+            self._stats = pstats.Stats(self._profile)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed block as one stage"""
+        if self.mode == 'tracemalloc':
+            tracemalloc.reset_peak()
+        start_peak = peak_rss_mb()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            # ru_maxrss is the high-water mark of the whole process, not of this stage; the
+            # growth is how far the stage pushed it up, 0 when an earlier stage peaked higher
+            end_peak = peak_rss_mb()
+            entry = {'stage': name, 'time': time.perf_counter() - start_time, 'process_peak_rss_mb': end_peak,
+                     'rss_growth_mb': end_peak - start_peak if end_peak is not None else None}
+            if self.mode == 'tracemalloc':
+                entry['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            self.stages.append(entry)
+
+    def count(self, **counts):
+        """Record counters such as graph nodes and edges"""
+        self.counts.update(counts)
+
+    def top_functions(self, limit=TOP_FUNCTIONS):
+        """Functions with the most cumulative time, from the cProfile capture"""
+        if self._stats is None:
+            return []
+        rows = []
+        for (filename, line, function), (_, calls, tottime, cumtime, _) in self._stats.stats.items():
+            rows.append({'function': f"{os.path.basename(filename)}:{line}({function})",
+                         'calls': calls, 'tottime': tottime, 'cumtime': cumtime})
+        return sorted(rows, key=lambda row: row['cumtime'], reverse=True)[:limit]
+
+    def report(self):
+        report = {'mode': self.mode, 'total_time': self.total_time, 'stages': self.stages, 'counts': self.counts}
+        if self._stats is not None:
+            report['top_functions'] = self.top_functions()
+        return report
+
+    def write(self, filename):
+        """Write the report as JSON; in cprofile mode the raw profile goes next to it as .prof"""
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        if self._stats is not None:
+            self._stats.dump_stats(os.path.splitext(filename)[0] + '.prof')
+
+    def summary(self):
+        """One line per stage for logging"""
+        stream = io.StringIO()
+        for entry in self.stages:
+            stream.write(f"{entry['stage']:12s} {entry['time']:8.3f}s")
+            if entry.get('process_peak_rss_mb') is not None:
+                stream.write(f"  RSS growth {entry['rss_growth_mb']:.1f}MB (process peak {entry['process_peak_rss_mb']:.1f}MB)")
+            if 'peak_traced_mb' in entry:
+                stream.write(f"  traced peak {entry['peak_traced_mb']:.1f}MB")
+            stream.write('\n')
+        return stream.getvalue().rstrip('\n')
@@ -0,0 +1,70 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from alignment_cache import AlignmentCache
+from mafft_runner import AlignmentJob, run_job
+
+class AlignmentCacheTest(unittest.TestCase):
+    """Hits, least recently used eviction and re-stored keys, with cat standing in for MAFFT"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = Path(self.directory.name)
+        self.runs = self.root / "runs"
+        self.aligner = ['sh', '-c', f'echo run >> {self.runs}; cat "$0"', '{input}']
+        self.matrix = self.root / "BLOSUM62"
+        self.matrix.write_text("matrix")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def fasta(self, name, size=100):
+        path = self.root / name
+        path.write_text(">s0\n" + name[0].upper() * (size - 5) + "\n")
+        return path
+
+    def store(self, cache, name, mtime):
+        """Store a file as the output for input `name` and date its entry mtime"""
+        key = cache.key(self.fasta(name), self.matrix, self.aligner)
+        cache.store(key, self.fasta(name))
+        os.utime(cache._path(key), (mtime, mtime))
+        return key
+
+    def test_hit_skips_aligner(self):
+        cache = AlignmentCache(self.root / "cache")
+        job = AlignmentJob(self.fasta("input"), self.matrix, self.root / "first.aln")
+        self.assertFalse(run_job(job, self.aligner, cache)['cached'])
+        job.output_path = str(self.root / "second.aln")
+        self.assertTrue(run_job(job, self.aligner, cache)['cached'])
+        self.assertEqual(self.runs.read_text(), "run\n")
+        self.assertEqual((self.root / "second.aln").read_text(), (self.root / "input").read_text())
+
+    def test_evicts_least_recently_used(self):
+        cache = AlignmentCache(self.root / "cache", max_bytes=250)
+        first = self.store(cache, "a", 1000)
+        second = self.store(cache, "b", 2000)
+        self.assertTrue(cache.fetch(first, self.root / "out"))     # marks the first entry as the most recent
+        third = self.store(cache, "c", 3000)
+        self.assertTrue(os.path.exists(cache._path(first)))
+        self.assertFalse(os.path.exists(cache._path(second)))
+        self.assertTrue(os.path.exists(cache._path(third)))
+        self.assertEqual(cache._total_bytes, 200)
+
+    def test_restore_key_counts_once(self):
+        cache = AlignmentCache(self.root / "cache", max_bytes=250)
+        key = self.store(cache, "a", 1000)
+        for _ in range(3):
+            cache.store(key, self.fasta("a"))
+        self.assertEqual(cache._total_bytes, 100)
+        self.store(cache, "b", 2000)
+        self.assertEqual(cache._total_bytes, 200)
+        self.assertTrue(cache.fetch(key, self.root / "out"))
+        self.assertEqual(AlignmentCache(self.root / "cache")._total_bytes, 200)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from alignment_scoring import ReferenceIndex, count_aligned_pairs, parse_fasta
+
+def count_aligned_pairs_pairwise(test_seqs, ref_seqs):
+    """The original string-set scorer, kept as the reference for count_aligned_pairs"""
+    test_pairs = set()
+    ref_pairs = set()
+
+    common_ids = set(test_seqs.keys()) & set(ref_seqs.keys())
+
+    for id1 in common_ids:
+        for id2 in common_ids:
+            if id1 >= id2:
+                continue
+
+            for seqs, pairs in ((test_seqs, test_pairs), (ref_seqs, ref_pairs)):
+                seq1, seq2 = seqs[id1], seqs[id2]
+                pos1, pos2 = 0, 0
+                for i in range(len(seq1)):
+                    if seq1[i] != '-' and seq2[i] != '-':
+                        pairs.add((f"{id1}_{pos1}", f"{id2}_{pos2}"))
+                    if seq1[i] != '-':
+                        pos1 += 1
+                    if seq2[i] != '-':
+                        pos2 += 1
+
+    tp = len(test_pairs & ref_pairs)
+    return tp, len(test_pairs - ref_pairs), len(ref_pairs - test_pairs)
+
+def random_alignment(ids, lengths, num_columns, rng):
+    """Place each sequence's residues in random columns of a gapped row"""
+    seqs = {}
+    for seq_id, length in zip(ids, lengths):
+        columns = set(rng.sample(range(num_columns), length))
+        seqs[seq_id] = ''.join('A' if column in columns else '-' for column in range(num_columns))
+    return seqs
+
+class CountAlignedPairsTest(unittest.TestCase):
+    """count_aligned_pairs must give the TP/FP/FN of the original pairwise scorer"""
+
+    def assert_matches_pairwise(self, test_seqs, ref_seqs):
+        expected = count_aligned_pairs_pairwise(test_seqs, ref_seqs)
+        self.assertEqual(count_aligned_pairs(test_seqs, ref_seqs), expected)
+        index = ReferenceIndex.from_sequences(ref_seqs)
+        self.assertEqual(count_aligned_pairs(test_seqs, index), expected)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "ref.npz")
+            index.save(filename)
+            self.assertEqual(count_aligned_pairs(test_seqs, ReferenceIndex.load(filename)), expected)
+
+    def test_cached_sidecar(self):
+        ref = {"a": "AC-GT", "b": "A-CGT"}
+        test = {"a": "ACG-T", "b": "-ACGT"}
+        with tempfile.TemporaryDirectory() as directory:
+            ref_file = os.path.join(directory, "ref.fasta")
+            with open(ref_file, "w") as f:
+                f.write("".join(f">{seq_id}\n{seq}\n" for seq_id, seq in ref.items()))
+            index_dir = os.path.join(directory, "index")
+            first = ReferenceIndex.cached(ref_file, index_dir)
+            self.assertEqual(len(os.listdir(index_dir)), 1)
+            second = ReferenceIndex.cached(ref_file, index_dir)
+            expected = count_aligned_pairs_pairwise(test, ref)
+            self.assertEqual(count_aligned_pairs(test, first), expected)
+            self.assertEqual(count_aligned_pairs(test, second), expected)
+
+    def test_identical(self):
+        seqs = {"a": "AC-GT", "b": "A-CGT", "c": "ACG-T"}
+        self.assert_matches_pairwise(seqs, seqs)
+
+    def test_shifted_residues(self):
+        ref = {"a": "ACGT-", "b": "-ACGT", "c": "AC-GT"}
+        test = {"a": "ACGT-", "b": "ACGT-", "c": "A-CGT"}
+        self.assert_matches_pairwise(test, ref)
+
+    def test_mismatched_residue_counts(self):
+        ref = {"a": "ACGT--", "b": "AC-GTA", "c": "--ACGT"}
+        test = {"a": "ACGTAC", "b": "A---C-", "c": "ACGT--"}
+        self.assert_matches_pairwise(test, ref)
+
+    def test_partial_id_overlap(self):
+        ref = {"a": "AC-GT", "b": "A-CGT", "x": "ACGT-"}
+        test = {"a": "ACG-T", "b": "-ACGT", "y": "ACGTA"}
+        self.assert_matches_pairwise(test, ref)
+
+    def test_no_common_ids(self):
+        self.assert_matches_pairwise({"a": "AC"}, {"b": "AC"})
+
+    def test_underscores_in_ids(self):
+        ref = {"a_1": "AC-GT", "a": "A-CGT", "a_1_2": "ACGT-", "_": "-ACGT"}
+        test = {"a_1": "ACG-T", "a": "-ACGT", "a_1_2": "ACGT-", "_": "AC-GT"}
+        self.assert_matches_pairwise(test, ref)
+
+    def test_random_alignments(self):
+        rng = random.Random(11)
+        for _ in range(200):
+            ids = rng.sample(["s1", "s_2", "s_2_1", "t", "t_10", "u", "v_"], rng.randint(2, 7))
+            ref_ids = [seq_id for seq_id in ids if rng.random() < 0.85]
+            test_ids = [seq_id for seq_id in ids if rng.random() < 0.85]
+            ref_columns = rng.randint(1, 12)
+            test_columns = rng.randint(1, 12)
+            ref_lengths = [rng.randint(0, ref_columns) for _ in ref_ids]
+            # Mostly the same residue counts as the reference, sometimes not
+            test_lengths = [
+                rng.randint(0, test_columns) if seq_id not in ref_ids or rng.random() < 0.2
+                else min(ref_lengths[ref_ids.index(seq_id)], test_columns)
+                for seq_id in test_ids
+            ]
+            ref = random_alignment(ref_ids, ref_lengths, ref_columns, rng)
+            test = random_alignment(test_ids, test_lengths, test_columns, rng)
+            self.assert_matches_pairwise(test, ref)
+
+class ParseFastaTest(unittest.TestCase):
+    """parse_fasta strips both ends of every line, as it always has"""
+
+    def test_indented_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "indented.fasta")
+            with open(filename, "w") as f:
+                f.write(">a first\n  AC.\n GT \n  >b\nA--\n\tCGT\n")
+            self.assertEqual(parse_fasta(filename), {"a": "AC-GT", "b": "A--CGT"})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from mafft_runner import NOT_STARTED, AlignmentJob, ensemble_jobs, run_alignment_jobs, run_job
+
+STAND_IN = ['cat', '{input}']
+FASTA = ">s0\nACDE\n>s1\nACE\n"
+
+class RunnerTest(unittest.TestCase):
+    """run_alignment_jobs with cat standing in for MAFFT"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        root = Path(self.directory.name)
+        self.input_fasta = root / "input"
+        self.input_fasta.write_text(FASTA)
+        self.matrices = root / "matrices"
+        self.matrices.mkdir()
+        for name in ("BLOSUM62", "PAM250", "VTML200"):
+            (self.matrices / name).write_text(name)
+        self.output_dir = root / "out"
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_records(self):
+        jobs = ensemble_jobs(self.input_fasta, self.matrices, self.output_dir)
+        records = sorted(run_alignment_jobs(jobs, 2, STAND_IN), key=lambda record: record['matrix'])
+        self.assertEqual([record['matrix'] for record in records], ["BLOSUM62", "PAM250", "VTML200"])
+        for record in records:
+            self.assertEqual(record['returncode'], 0)
+            self.assertFalse(record['cached'])
+            self.assertEqual(record['output'], str(self.output_dir / f"{record['matrix']}.aln"))
+            self.assertEqual(Path(record['output']).read_text(), FASTA)
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ["BLOSUM62.aln", "PAM250.aln", "VTML200.aln"])
+
+    def test_missing_binary(self):
+        job = ensemble_jobs(self.input_fasta, self.matrices, self.output_dir)[0]
+        record = run_job(job, ['no-such-aligner', '{input}'])
+        self.assertEqual(record['returncode'], NOT_STARTED)
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    def test_unreadable_input(self):
+        job = AlignmentJob(self.input_fasta.with_name("missing"), self.matrices / "PAM250", self.output_dir / "x.aln")
+        self.output_dir.mkdir()
+        record = run_job(job, STAND_IN)
+        self.assertEqual(record['returncode'], NOT_STARTED)
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    def test_failed_job_leaves_no_output(self):
+        job = ensemble_jobs(self.input_fasta, self.matrices, self.output_dir)[0]
+        record = run_job(job, ['sh', '-c', 'cat "$0"; echo failed >&2; exit 3', '{input}'])
+        self.assertEqual(record['returncode'], 3)
+        self.assertEqual(record['stderr'], "failed")
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,239 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+import MergeAlign
+import segment_scoring
+from MergeAlign import (GraphSnapshot, MergeState, alignment_to_matrix, combine_alignments, create_graph,
+                        column_mask, matrices_to_coordinates, merge_alignments, read_alignments, score_graph,
+                        update_state, write_columns, write_fasta)
+from ensemble_generator import ensemble_alignments, generate_ensemble, random_seed
+
+MAFFT_ALIGNMENTS = ROOT / "mafft_alignments"
+
+def random_alignment(sequences, extra_columns, rng):
+    """Place each sequence's residues in random columns, dropping columns that are all gaps"""
+    num_columns = max(map(len, sequences)) + extra_columns
+    rows = []
+    for seq in sequences:
+        columns = dict(zip(sorted(rng.sample(range(num_columns), len(seq))), seq))
+        rows.append([columns.get(column, "-") for column in range(num_columns)])
+    kept = [column for column in range(num_columns) if any(row[column] != "-" for row in rows)]
+    return [(f"s{i}", "".join(row[column] for column in kept)) for i, row in enumerate(rows)]
+
+def random_ensembles():
+    """Small ensembles: unrelated random alignments, full of ties, and perturbed copies of one alignment"""
+    rng = random.Random(5)
+    for _ in range(60):
+        sequences = ["".join(rng.choice("ACDE") for _ in range(rng.randint(1, 8))) for _ in range(rng.randint(1, 6))]
+        yield [random_alignment(sequences, rng.randint(0, 5), rng) for _ in range(rng.randint(1, 6))]
+    np_rng = np.random.default_rng(5)
+    for rate in (0, 0.02, 0.1, 0.5):
+        names, matrix = random_seed(int(np_rng.integers(2, 10)), int(np_rng.integers(20, 120)), np_rng)
+        yield ensemble_alignments(names, generate_ensemble(matrix, int(np_rng.integers(2, 9)), rate, np_rng))
+
+def graph_of(alignments):
+    sequence_names = [name for name, _ in alignments[0]]
+    coordinates, lengths = matrices_to_coordinates([alignment_to_matrix(a, sequence_names) for a in alignments])
+    return create_graph(coordinates, lengths)
+
+class MatchesNodeEngine:
+    """Checks that every other way of merging gives the consensus and scores of the Node engine"""
+
+    def assert_engines_match(self, alignments, expected):
+        for engine in ("array", "banded"):
+            self.assertEqual(merge_alignments(alignments, engine)[:2], expected, engine)
+
+    def assert_state_matches(self, alignments, expected):
+        state = MergeState.from_alignments(alignments[:1])
+        for alignment in alignments[1:]:
+            state.add_alignments([alignment])
+        self.assertEqual(state.consensus(), expected)
+
+        half = max(1, len(alignments) // 2)
+        state = MergeState.from_alignments(alignments[:half])
+        state.add_alignments(alignments[half:])
+        self.assertEqual(state.consensus(), expected)
+
+    def assert_saved_state_matches(self, alignments, expected):
+        with tempfile.TemporaryDirectory() as directory:
+            state_dir = os.path.join(directory, "state")
+            MergeState.from_alignments(alignments[:1]).save(state_dir)
+            for alignment in alignments[1:]:
+                state = MergeState.load(state_dir)
+                state.add_alignments([alignment])
+                state.save(state_dir)
+            self.assertEqual(MergeState.load(state_dir).consensus(), expected)
+            self.assertEqual(GraphSnapshot.load(state_dir).consensus(), expected)
+
+    def assert_snapshot_matches(self, alignments, expected):
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot_dir = os.path.join(directory, "graph")
+            merge_alignments(alignments, "array", snapshot=snapshot_dir)
+            snapshot = GraphSnapshot.load(snapshot_dir)
+            for engine in ("nodes", "array", "banded"):
+                self.assertEqual(snapshot.consensus(engine=engine), expected, engine)
+            self.assertEqual(MergeState.load(snapshot_dir).consensus(), expected)
+
+    def assert_parallel_matches(self, alignments, expected):
+        graph = graph_of(alignments)
+        serial = score_graph(graph, len(alignments))
+        # Split even tiny graphs into stretches, and use a pool on single-CPU machines too
+        with mock.patch.object(segment_scoring, "MIN_STRETCH_EDGES", 1), \
+                mock.patch.object(segment_scoring, "available_cpus", lambda: 4):
+            for workers in (2, 3):
+                self.assertEqual(score_graph(graph, len(alignments), workers), serial, workers)
+            self.assertEqual(merge_alignments(alignments, "array", workers=2)[:2], expected)
+            self.assertEqual(merge_alignments(alignments, "banded", workers=2)[:2], expected)
+
+class RandomEnsemblesTest(MatchesNodeEngine, unittest.TestCase):
+
+    def setUp(self):
+        self.cases = [(alignments, merge_alignments(alignments, "nodes")[:2]) for alignments in random_ensembles()]
+
+    def test_engines(self):
+        for alignments, expected in self.cases:
+            self.assert_engines_match(alignments, expected)
+
+    def test_merge_state(self):
+        for alignments, expected in self.cases:
+            self.assert_state_matches(alignments, expected)
+
+    def test_saved_merge_state(self):
+        for alignments, expected in self.cases[::4]:
+            self.assert_saved_state_matches(alignments, expected)
+
+    def test_graph_snapshot(self):
+        for alignments, expected in self.cases[::2]:
+            self.assert_snapshot_matches(alignments, expected)
+
+    def test_parallel_scoring(self):
+        for alignments, expected in self.cases[::3]:
+            self.assert_parallel_matches(alignments, expected)
+
+    def test_topological_order(self):
+        for alignments, _ in self.cases:
+            nodes = MergeAlign.graph_to_nodes(graph_of(alignments))
+            self.assertEqual(MergeAlign.score_nodes(nodes, len(alignments), order="topological"),
+                             MergeAlign.score_nodes(nodes, len(alignments)))
+
+    def test_hash_collisions(self):
+        # Hashes with few distinct values make CoordinateIndex fall back to exact row comparison
+        def colliding_hashes(rows):
+            return (np.asarray(rows, dtype=np.int64).sum(axis=1) % 3).astype(np.uint64)
+
+        with mock.patch.object(MergeAlign, "row_hashes", colliding_hashes):
+            for alignments, expected in self.cases[::3]:
+                self.assert_engines_match(alignments, expected)
+                self.assert_state_matches(alignments, expected)
+
+class UpdateStateTest(unittest.TestCase):
+    """update_state continues saved states and --save-graph snapshots without counting an alignment twice"""
+
+    def setUp(self):
+        np_rng = np.random.default_rng(7)
+        names, matrix = random_seed(6, 60, np_rng)
+        alignments = ensemble_alignments(names, generate_ensemble(matrix, 6, 0.2, np_rng))
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = []
+        for i, alignment in enumerate(alignments):
+            self.files.append(os.path.join(self.directory.name, f"a{i}.fasta"))
+            with open(self.files[-1], "w") as f:
+                f.write("".join(f">{name}\n{seq}\n" for name, seq in alignment))
+        self.expected = merge_alignments(alignments, "nodes")[:2]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_continue_saved_graph(self):
+        graph_dir = os.path.join(self.directory.name, "graph")
+        combine_alignments(self.files[:3], "array", snapshot=graph_dir)
+        self.assertEqual(GraphSnapshot.load(graph_dir).sources, [os.path.basename(f) for f in self.files[:3]])
+        self.assertEqual(update_state(graph_dir, self.files), self.expected)
+        self.assertEqual(MergeState.load(graph_dir).num_alignments, len(self.files))
+
+    def test_unnamed_snapshot_refused(self):
+        graph_dir = os.path.join(self.directory.name, "graph")
+        merge_alignments(read_alignments(self.files[:3]), "array", snapshot=graph_dir)
+        with self.assertRaises(ValueError):
+            update_state(graph_dir, self.files)
+
+    def test_state_without_sources_refused(self):
+        state_dir = os.path.join(self.directory.name, "state")
+        MergeState.from_alignments(read_alignments(self.files[:3])).save(state_dir)
+        with self.assertRaises(ValueError):
+            update_state(state_dir, self.files)
+
+class WriteOutputTest(unittest.TestCase):
+    """Threshold trimming in write_fasta and the -c column export, on hand-written scores"""
+
+    alignment = {"s0": "AC-DE", "s1": "A-GDE", "s2": "-CGD-"}
+    scores = [0.9, 0.5, 0.2, 1.0, 0.5]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "out")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self):
+        with open(self.filename) as f:
+            return f.read()
+
+    def test_threshold_matches_per_sequence_trimming(self):
+        for threshold in (0.1, 0.5, 0.9, 1.0):
+            expected = "".join(f">{name}\n" + "".join(aa for aa, score in zip(seq, self.scores) if score > threshold)
+                               + "\n" for name, seq in self.alignment.items())
+            write_fasta(self.filename, self.alignment, threshold, self.scores)
+            self.assertEqual(self.read(), expected)
+            write_fasta(self.filename, self.alignment, mask=column_mask(self.scores, threshold))
+            self.assertEqual(self.read(), expected)
+
+    def test_mask_width_checked(self):
+        with self.assertRaises(ValueError):
+            write_fasta(self.filename, self.alignment, mask=column_mask(self.scores[:-1], 0.5))
+
+    def test_columns(self):
+        write_columns(self.filename, column_mask(self.scores, 0.5))
+        self.assertEqual(self.read(), "0\n3\n")
+        write_columns(self.filename, column_mask(self.scores))
+        self.assertEqual(self.read(), "0\n1\n2\n3\n4\n")
+
+@unittest.skipUnless(MAFFT_ALIGNMENTS.is_dir(), "mafft_alignments not present")
+class MafftAlignmentsTest(MatchesNodeEngine, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.alignments = read_alignments([str(MAFFT_ALIGNMENTS / f) for f in sorted(os.listdir(MAFFT_ALIGNMENTS))])
+        cls.expected = merge_alignments(cls.alignments, "nodes")[:2]
+
+    def test_engines(self):
+        self.assert_engines_match(self.alignments, self.expected)
+
+    def test_merge_state(self):
+        state = MergeState.from_alignments(self.alignments[:-2])
+        for alignment in self.alignments[-2:]:
+            state.add_alignments([alignment])
+        self.assertEqual(state.consensus(), self.expected)
+        with tempfile.TemporaryDirectory() as directory:
+            state.save(os.path.join(directory, "state"))
+            self.assertEqual(MergeState.load(os.path.join(directory, "state")).consensus(), self.expected)
+
+    def test_graph_snapshot(self):
+        self.assert_snapshot_matches(self.alignments, self.expected)
+
+    def test_parallel_scoring(self):
+        with mock.patch.object(segment_scoring, "available_cpus", lambda: 4):
+            self.assertEqual(merge_alignments(self.alignments, "array", workers=2)[:2], self.expected)
+
+if __name__ == "__main__":
+    unittest.main()